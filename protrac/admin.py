@@ -1,8 +1,17 @@
+from datetime import timedelta
+
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR
+from django.core.exceptions import ObjectDoesNotExist
 from django.conf.urls.defaults import patterns, url
+from django.forms.models import ModelChoiceField
 from django.template.defaultfilters import force_escape
 
 from models import *
+import keyset
+import refcache
+import search
 from utils import get_change_url
 
 
@@ -12,6 +21,165 @@ from utils import get_change_url
 
 class RunInline(admin.TabularInline):
     model = Run
+    ordering = ['start']
+
+
+#######################
+# Model Admin Helpers #
+#######################
+
+class SearchChangeList(ChangeList):
+    """
+    ChangeList searching with its admin's indexed_search(queryset, query)
+    when it has one, instead of an icontains over every search field
+    """
+
+    def get_query_set(self, request):
+        indexed_search = getattr(self.model_admin, 'indexed_search', None)
+        if indexed_search is None or not self.query:
+            return super(SearchChangeList, self).get_query_set(request)
+        query, self.query = self.query, ''
+        try:
+            qs = super(SearchChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+        return indexed_search(qs, query)
+
+
+# keyset pagination cursors (see KeysetChangeList)
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+
+
+class KeysetChangeList(SearchChangeList):
+    """
+    ChangeList paging by keyset (see protrac.keyset) when its admin has a
+    keyset_ordering, with Previous / Next links instead of page numbers.
+    Sorting by a column or showing all falls back to numbered pages.
+    """
+
+    def get_query_set(self, request):
+        # the cursors aren't filters
+        self.keyset_after = self.params.pop(AFTER_VAR, None)
+        self.keyset_before = self.params.pop(BEFORE_VAR, None)
+        self.keyset = getattr(self.model_admin, 'keyset_ordering', None)
+        if ORDER_VAR in self.params or self.show_all:
+            self.keyset = None
+        return super(KeysetChangeList, self).get_query_set(request)
+
+    def get_ordering(self, request, queryset):
+        if self.keyset:
+            return list(self.keyset)
+        return super(KeysetChangeList, self).get_ordering(request, queryset)
+
+    def get_results(self, request):
+        self.result_count_estimated = False
+        if not self.keyset:
+            return super(KeysetChangeList, self).get_results(request)
+        try:
+            after, before = [ keyset.decode(self.model, self.keyset, cursor)
+                    if cursor else None for cursor in (self.keyset_after,
+                        self.keyset_before) ]
+        except ValueError:
+            raise IncorrectLookupParameters
+        page = keyset.page(self.query_set, self.keyset, self.list_per_page,
+                after, before)
+        # still a queryset, for the list_editable formset
+        self.result_list = self.query_set.filter(pk__in=page.pks)
+
+        if getattr(self.model_admin, 'keyset_estimate_count', False):
+            count = keyset.estimate_count
+        else:
+            count = lambda qs: (qs.count(), False)
+        self.result_count, self.result_count_estimated = count(
+                self.query_set)
+        if self.query_set.query.where:
+            self.full_result_count = count(self.root_query_set)[0]
+        else:
+            self.full_result_count = self.result_count
+        self.can_show_all = False
+        self.multi_page = page.has_previous or page.has_next
+        self.paginator = None
+
+        self.keyset_first_url = self.keyset_previous_url = None
+        self.keyset_next_url = None
+        if page.has_previous:
+            self.keyset_first_url = self.get_query_string()
+            self.keyset_previous_url = self.get_query_string({
+                BEFORE_VAR: keyset.encode(page.first)})
+        if page.has_next:
+            self.keyset_next_url = self.get_query_string({
+                AFTER_VAR: keyset.encode(page.last)})
+
+
+class RefCacheChangeList(KeysetChangeList):
+    """
+    ChangeList filling in each row's production line, customer and product
+    from the reference cache (see protrac.refcache) instead of a join
+    """
+
+    def get_query_set(self, request):
+        qs = super(RefCacheChangeList, self).get_query_set(request)
+        # the stock ChangeList joins every foreign key in list_display unless
+        # the admin's queryset already chose what to join
+        if not self.root_query_set.query.select_related:
+            qs.query.select_related = False
+        return qs
+
+    def get_results(self, request):
+        super(RefCacheChangeList, self).get_results(request)
+        for path in self.model_admin.refcache_related:
+            refcache.attach(self.result_list, path)
+
+
+class RefCacheAdmin(object):
+    """
+    Mixin for admins whose changelist rows show reference objects, listed
+    in refcache_related
+    """
+    refcache_related = ()
+
+    def get_changelist(self, request, **kwargs):
+        return RefCacheChangeList
+
+
+class KeysetAdmin(object):
+    """
+    Mixin for admins of big tables, paging their changelist by keyset_ordering
+    (which must end with the primary key) and, with keyset_estimate_count,
+    showing the database's estimate of the number of rows instead of counting
+    them
+    """
+    keyset_ordering = None
+    keyset_estimate_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+class CycleTimeStatsAdmin(object):
+    """
+    Mixin for admins of models with precomputed cycle time statistics (see
+    protrac.stats), showing them in the avg_cycle_time column
+    """
+
+    def queryset(self, request):
+        # prefetched rather than select_related so that objects without
+        # statistics are known not to have them, instead of querying each
+        return super(CycleTimeStatsAdmin, self).queryset(request
+                ).prefetch_related('cycle_time_stats')
+
+    def avg_cycle_time(self, obj):
+        try:
+            stats = obj.cycle_time_stats
+        except ObjectDoesNotExist:
+            # not refreshed since its first run
+            return obj.avg_cycle_time()
+        return u'<span title="median %.2fs, p90 %.2fs, std dev %.2fs, ' \
+                u'%i runs">%s</span>' % (stats.median, stats.p90,
+                        stats.stddev, stats.runs, stats.mean_cycle_time())
+    avg_cycle_time.allow_tags = True
+    avg_cycle_time.short_description = 'Avg cycle time'
 
 
 ################
@@ -29,7 +197,7 @@ class ProductionLineAdmin(admin.ModelAdmin):
 admin.site.register(ProductionLine, ProductionLineAdmin)
 
 
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(CycleTimeStatsAdmin, admin.ModelAdmin):
     list_display = ['part_number', 'material', 'cycle_time',
             'avg_cycle_time']
     list_display_links = ['part_number']
@@ -60,11 +228,13 @@ JOB_LIST_DISPLAY = ['__unicode__', 'priority', 'production_line',
     'void']
 
 
-class JobAdmin(admin.ModelAdmin):
+class JobAdmin(RefCacheAdmin, KeysetAdmin, CycleTimeStatsAdmin,
+        admin.ModelAdmin):
     list_display = JOB_LIST_DISPLAY
     list_display_links = ['__unicode__']
     list_editable = ['priority', 'production_line']
     list_filter = ['production_line', 'customer', 'product']
+    # searched with the index, see indexed_search
     search_fields = ['refs', 'product__part_number', 'customer__name']
     readonly_fields = ['ctime', 'mtime']
 
@@ -85,6 +255,23 @@ class JobAdmin(admin.ModelAdmin):
 
     inlines = [RunInline]
 
+    refcache_related = ('product', 'customer', 'production_line')
+    keyset_ordering = ('priority', 'id')
+    keyset_estimate_count = True
+
+    def indexed_search(self, queryset, query):
+        return search.search_jobs(queryset, query)
+
+    def get_changelist_formset(self, request, **kwargs):
+        FormSet = super(JobAdmin, self).get_changelist_formset(request,
+                **kwargs)
+        # Evaluate the select choices once, so each list_editable row copies
+        # the list instead of running the same query again
+        for field in FormSet.form.base_fields.values():
+            if isinstance(field, ModelChoiceField):
+                field.choices = list(field.choices)
+        return FormSet
+
     def product_description(self, obj):
         desc = obj.product.description
         if len(desc) > 32:
@@ -117,22 +304,56 @@ class JobAdmin(admin.ModelAdmin):
             style, obj.qty_remaining(), obj.qty)
     remaining.allow_tags = True
 
+    def changelist_view(self, request, extra_context=None):
+        # list_editable saves every row, so only renumber priorities once
+        with Job.deferred_prioritize():
+            return super(JobAdmin, self).changelist_view(request,
+                    extra_context=extra_context)
+
     def get_urls(self):
-        from views import job_schedule
+        from views import (board_events, capacity_json, capacity_report,
+                export_view, import_view, ingest_runs, instrumentation,
+                job_schedule, live_board, optimize_view, sequence_view)
         urls = super(JobAdmin, self).get_urls()
         my_urls = patterns('',
             url(r'^job_schedule', self.admin_site.admin_view(job_schedule),
                 name='job_schedule'),
+            url(r'^capacity/$', self.admin_site.admin_view(capacity_report),
+                name='protrac_capacity'),
+            url(r'^capacity\.json$', self.admin_site.admin_view(capacity_json),
+                name='protrac_capacity_json'),
+            url(r'^export/(?P<name>\w+)\.(?P<format>\w+)$',
+                self.admin_site.admin_view(export_view),
+                name='protrac_export'),
+            url(r'^import/$', self.admin_site.admin_view(import_view),
+                name='protrac_import'),
+            url(r'^optimize/$', self.admin_site.admin_view(optimize_view),
+                name='protrac_optimize'),
+            url(r'^sequence/(?P<line_id>\d+)/$',
+                self.admin_site.admin_view(sequence_view),
+                name='protrac_sequence'),
+            url(r'^board/(?P<line_id>\d+)/$',
+                self.admin_site.admin_view(live_board),
+                name='protrac_board'),
+            url(r'^board/(?P<line_id>\d+)/events$',
+                self.admin_site.admin_view(board_events),
+                name='protrac_board_events'),
+            # controllers authenticate with a token instead of a session
+            url(r'^ingest/runs$', ingest_runs, name='protrac_ingest_runs'),
+            url(r'^instrumentation',
+                self.admin_site.admin_view(instrumentation),
+                name='protrac_instrumentation'),
         )
         return my_urls + urls
 
 admin.site.register(Job, JobAdmin)
 
 
-class RunAdmin(admin.ModelAdmin):
+class RunAdmin(RefCacheAdmin, KeysetAdmin, admin.ModelAdmin):
     list_display = ['__unicode__', 'job_admin_link', 'start', 'end', 'qty',
            'weight', 'cycle_time', 'operator']
     readonly_fields = ['ctime', 'mtime']
+    # searched with the index, see indexed_search
     search_fields = ['job__product__part_number', 'job__customer__name',
            'job__refs', 'operator',]
     fieldsets = (
@@ -145,6 +366,16 @@ class RunAdmin(admin.ModelAdmin):
             }),
         )
 
+    refcache_related = ('job__product',)
+    keyset_ordering = ('-start', '-id')
+    keyset_estimate_count = True
+
+    def indexed_search(self, queryset, query):
+        return search.search_runs(queryset, query)
+
+    def queryset(self, request):
+        return super(RunAdmin, self).queryset(request).select_related('job')
+
     def job_admin_link(self, obj):
         j = obj.job
         return u'<a href="%s">%s</a>' % (
@@ -154,6 +385,25 @@ class RunAdmin(admin.ModelAdmin):
 admin.site.register(Run, RunAdmin)
 
 
+class DailyProductionAdmin(RefCacheAdmin, admin.ModelAdmin):
+    list_display = ['day', 'production_line', 'product', 'operator', 'qty',
+            'run_time', 'weight', 'runs']
+    list_filter = ['production_line', 'operator']
+    date_hierarchy = 'day'
+    search_fields = ['product__part_number', 'operator']
+    readonly_fields = list_display
+
+    refcache_related = ('production_line', 'product')
+
+    def has_add_permission(self, request):
+        # kept up to date from the Runs
+        return False
+
+    def run_time(self, obj):
+        return timedelta(seconds=int(obj.seconds))
+admin.site.register(DailyProduction, DailyProductionAdmin)
+
+
 class ScheduleAdmin(JobAdmin):
     ld = list(JOB_LIST_DISPLAY)
     ld.remove('void')
@@ -0,0 +1,99 @@
+"""
+Duration arithmetic done by the database
+
+Runs store a start and end timestamp. duration_sql() renders "end - start
+in seconds" for the current backend, and SumSeconds aggregates it, so that
+totals come back as one float per group instead of one pair of datetimes
+per Run:
+
+    Run.objects.values('job').annotate(seconds=SumSeconds('end', 'start'))
+
+On any other backend supports_durations() is False, and values_seconds()
+and the totals in rollup subtract the datetimes in Python instead.
+"""
+from django.db import connections
+from django.db.models.aggregates import Aggregate
+from django.db.models.sql.aggregates import Aggregate as SQLAggregate
+
+# "end - start" in (fractional) seconds, by database vendor
+DURATION_SQL = {
+    # whole days apart plus the difference in time of day; the seconds are
+    # read from the stored text ("YYYY-MM-DD HH:MM:SS.ffffff") since
+    # strftime('%f') drops the microseconds, and strftime('%s') would be
+    # taken for a query parameter
+    'sqlite': ("((julianday(date(%(end)s)) - julianday(date(%(start)s))) "
+        "* 86400 + (strftime('%%H', %(end)s) * 3600 + "
+        "strftime('%%M', %(end)s) * 60 + "
+        "CAST(substr(%(end)s, 18) AS REAL)) - "
+        "(strftime('%%H', %(start)s) * 3600 + "
+        "strftime('%%M', %(start)s) * 60 + "
+        "CAST(substr(%(start)s, 18) AS REAL)))"),
+    'postgresql': 'EXTRACT(EPOCH FROM (%(end)s - %(start)s))',
+    'mysql': 'TIMESTAMPDIFF(MICROSECOND, %(start)s, %(end)s) / 1000000.0',
+}
+
+
+def duration_sql(connection, start, end):
+    """
+    Returns SQL for the seconds between two (quoted) column references
+    """
+    try:
+        template = DURATION_SQL[connection.vendor]
+    except KeyError:
+        raise NotImplementedError('Durations are not supported on %s' %
+                connection.vendor)
+    return template % {'start': start, 'end': end}
+
+
+def supports_durations(connection):
+    return connection.vendor in DURATION_SQL
+
+
+def values_seconds(queryset, *fields):
+    """
+    Iterates over queryset.values_list(*fields), where the field 'seconds'
+    is the seconds between the model's start and end fields
+    """
+    connection = connections[queryset.db]
+    if supports_durations(connection):
+        qn = connection.ops.quote_name
+        table = qn(queryset.model._meta.db_table)
+        rows = queryset.extra(select={'seconds': duration_sql(connection,
+            '%s.%s' % (table, qn('start')), '%s.%s' % (table, qn('end')))})
+        return rows.values_list(*fields).iterator()
+    i = fields.index('seconds')
+    names = fields[:i] + fields[i + 1:] + ('start', 'end')
+    return ( row[:i] + ((row[-1] - row[-2]).total_seconds(),) + row[i:-2]
+            for row in queryset.values_list(*names).iterator() )
+
+
+class SQLSumSeconds(SQLAggregate):
+    is_computed = True
+
+    def __init__(self, col, start, **kwargs):
+        super(SQLSumSeconds, self).__init__(col, **kwargs)
+        self.start = start
+
+    def as_sql(self, qn, connection):
+        # the start column is on the same table as the end column
+        alias, end = self.col
+        return 'SUM(%s)' % duration_sql(connection,
+                '%s.%s' % (qn(alias), qn(self.start)),
+                '%s.%s' % (qn(alias), qn(end)))
+
+
+class SumSeconds(Aggregate):
+    """
+    Sum of the seconds between two datetime fields of the same model, given
+    as the lookup of the end field and the name of the start field
+    """
+    name = 'SumSeconds'
+
+    def __init__(self, lookup, start, **extra):
+        super(SumSeconds, self).__init__(lookup, **extra)
+        self.start = start
+
+    def add_to_query(self, query, alias, col, source, is_summary):
+        start = source.model._meta.get_field(self.start).column
+        query.aggregates[alias] = SQLSumSeconds(col, start, source=source,
+                is_summary=is_summary, **self.extra)
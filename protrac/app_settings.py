@@ -9,3 +9,70 @@ LINE_CATEGORY_CHOICES = getattr(settings, 'PROTRAC_LINE_CATEGORY_CHOICES',
             ('X', u'Extrusion'),
             ('I', u'Injection'),
         ])
+
+# How Job priorities are kept in order when a Job is saved:
+#   'respace' renumbers every prioritized Job PRIORITY_STEP apart
+#   'gap' keeps the entered priority and only shifts the Jobs crowding it,
+#         so a Job moved into a free gap is the only row written
+PRIORITY_MODE = getattr(settings, 'PROTRAC_PRIORITY_MODE', 'respace')
+
+# Spacing used when renumbering priorities (Job.prioritize)
+PRIORITY_STEP = getattr(settings, 'PROTRAC_PRIORITY_STEP', 10)
+
+# Record wall time, query count and DB time for protrac's views (see
+# protrac.middleware.InstrumentationMiddleware, which must also be added to
+# MIDDLEWARE_CLASSES)
+INSTRUMENTATION = getattr(settings, 'PROTRAC_INSTRUMENTATION', False)
+
+# Number of instrumented requests kept in memory for the admin page
+INSTRUMENTATION_HISTORY = getattr(settings,
+        'PROTRAC_INSTRUMENTATION_HISTORY', 500)
+
+# Flag a request when the same SQL shape runs at least this many times
+INSTRUMENTATION_REPEAT_THRESHOLD = getattr(settings,
+        'PROTRAC_INSTRUMENTATION_REPEAT_THRESHOLD', 5)
+
+# Production lines per page, and jobs shown per line, on the job schedule
+SCHEDULE_LINES_PER_PAGE = getattr(settings, 'PROTRAC_SCHEDULE_LINES_PER_PAGE',
+        10)
+SCHEDULE_JOBS_PER_LINE = getattr(settings, 'PROTRAC_SCHEDULE_JOBS_PER_LINE',
+        25)
+
+# Cache (a CACHES alias) for projected line timelines. A local memory cache
+# is used if the alias isn't configured.
+CACHE = getattr(settings, 'PROTRAC_CACHE', 'default')
+
+# Seconds a projected line timeline is cached for. Changes to Jobs, Runs and
+# Products invalidate it sooner.
+TIMELINE_CACHE_TIMEOUT = getattr(settings, 'PROTRAC_TIMELINE_CACHE_TIMEOUT',
+        300)
+
+# Rows kept per model, and seconds each is kept for, in the in-process cache
+# of production lines, customers and products (see protrac.refcache)
+REFCACHE_SIZE = getattr(settings, 'PROTRAC_REFCACHE_SIZE', 5000)
+REFCACHE_TIMEOUT = getattr(settings, 'PROTRAC_REFCACHE_TIMEOUT', 300)
+
+# Tokens accepted by the run ingest endpoint, as {token: controller name}.
+# Controllers send "Authorization: Token <token>"; the name is used as the
+# operator of runs that don't give one.
+INGEST_TOKENS = getattr(settings, 'PROTRAC_INGEST_TOKENS', {})
+
+# Write ingested runs from a background thread (True), or before responding
+INGEST_ASYNC = getattr(settings, 'PROTRAC_INGEST_ASYNC', True)
+
+# Most runs written (and rolled up) together by the ingest thread, and the
+# most requests waiting for it before new ones are turned away
+INGEST_BATCH_SIZE = getattr(settings, 'PROTRAC_INGEST_BATCH_SIZE', 1000)
+INGEST_QUEUE_SIZE = getattr(settings, 'PROTRAC_INGEST_QUEUE_SIZE', 1000)
+
+# Seconds the capacity report is cached for (see protrac.capacity)
+CAPACITY_CACHE_TIMEOUT = getattr(settings, 'PROTRAC_CAPACITY_CACHE_TIMEOUT',
+        60)
+
+# Longest the line assignment optimizer's local search runs for, in seconds
+# (see protrac.optimizer)
+OPTIMIZER_TIME_LIMIT = getattr(settings, 'PROTRAC_OPTIMIZER_TIME_LIMIT', 5)
+
+# Seconds a line loses changing over between products with different setups,
+# used to sequence line queues (see protrac.sequencing)
+CHANGEOVER_TIME = getattr(settings, 'PROTRAC_CHANGEOVER_TIME', 30 * 60)
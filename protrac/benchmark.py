@@ -0,0 +1,363 @@
+"""
+Performance benchmarks for protrac's hot paths
+
+generate() fills the database with seeded, factory-scale synthetic data and
+run() times each registered case, counting its queries, and records the
+database's query plan for each registered plan query (to check the indexes
+are used). The protrac_benchmark management command runs both against a
+throwaway test database and writes the results as JSON, so releases can be
+compared.
+"""
+import random
+import time
+from datetime import datetime, timedelta
+
+import django
+from django.core.urlresolvers import NoReverseMatch
+from django.db import connection, reset_queries, transaction
+from django.db.models import Min
+
+from app_settings import LINE_CATEGORY_CHOICES
+from models import Customer, Job, Product, ProductionLine, Run, Schedule
+import history
+import refcache
+import rollup
+import search
+import stats
+import timeline
+
+# Data volumes for each --scale
+SCALES = {
+    'small': dict(lines=5, customers=20, products=200, jobs=1000,
+        runs=10000),
+    'medium': dict(lines=50, customers=100, products=5000, jobs=20000,
+        runs=200000),
+    'factory': dict(lines=500, customers=1000, products=50000, jobs=200000,
+        runs=2000000),
+}
+
+# Rows written per bulk_create call
+CHUNK_SIZE = 5000
+
+# Registered benchmark cases, as (name, function) in run order
+CASES = []
+
+# Registered queries to EXPLAIN, as (name, function returning a queryset)
+PLANS = []
+
+# Statement prefix asking each database vendor for its query plan
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+    'oracle': 'EXPLAIN PLAN FOR ',
+}
+
+
+def case(name):
+    """
+    Decorator registering a benchmark case. The function is called with the
+    context dict built by run() and should exercise one hot path.
+    """
+    def register(func):
+        CASES.append((name, func))
+        return func
+    return register
+
+
+def plan(name):
+    """
+    Decorator registering a query plan. The function is called with the
+    context dict built by run() and should return the queryset to explain.
+    """
+    def register(func):
+        PLANS.append((name, func))
+        return func
+    return register
+
+
+##################
+# DATA GENERATOR #
+##################
+
+def _bulk(model, objs):
+    for i in range(0, len(objs), CHUNK_SIZE):
+        model.objects.bulk_create(objs[i:i + CHUNK_SIZE])
+
+
+@transaction.commit_on_success
+def generate(lines, customers, products, jobs, runs, seed=0):
+    """
+    Creates the given number of each object with deterministic, seeded
+    values. Expects an empty database: primary keys are assigned from 1.
+    """
+    rnd = random.Random(seed)
+    categories = [ c[0] for c in LINE_CATEGORY_CHOICES ]
+    start = datetime(2000, 1, 1)
+
+    _bulk(ProductionLine, [ ProductionLine(pk=i, name='Line %i' % i,
+        category=categories[i % len(categories)])
+        for i in range(1, lines + 1) ])
+    _bulk(Customer, [ Customer(pk=i, name='Customer %i' % i)
+        for i in range(1, customers + 1) ])
+
+    cycle_times = {}
+    product_objs = []
+    for i in range(1, products + 1):
+        cycle_times[i] = round(rnd.uniform(0.5, 60), 2)
+        product_objs.append(Product(pk=i, part_number='P%06i' % i,
+            cycle_time=cycle_times[i],
+            material_wt=round(rnd.uniform(0, 5), 3)))
+    _bulk(Product, product_objs)
+    del product_objs
+
+    # spread the runs over the jobs, and write both a chunk at a time with
+    # the job totals filled in
+    runs_per_job = float(runs) / max(jobs, 1)
+    run_pk = 0
+    for first in range(1, jobs + 1, CHUNK_SIZE):
+        job_objs, run_objs = [], []
+        for pk in range(first, min(first + CHUNK_SIZE, jobs + 1)):
+            product_id = rnd.randint(1, products)
+            qty = rnd.randint(100, 10000)
+            job = Job(pk=pk, product_id=product_id, qty=qty,
+                    customer_id=rnd.randint(1, customers),
+                    refs='PO%i, WO%i' % (rnd.randint(1, 99999), pk),
+                    due_date=(start + timedelta(days=rnd.randint(0, 365))
+                        ).date(),
+                    void=rnd.random() < 0.02)
+            if rnd.random() < 0.9:
+                job.production_line_id = rnd.randint(1, lines)
+            if rnd.random() < 0.5:
+                job.priority = pk * 10
+
+            count = int(runs_per_job * pk) - int(runs_per_job * (pk - 1))
+            run_start = start + timedelta(minutes=rnd.randint(0, 525600))
+            for n in range(min(count, runs - run_pk)):
+                run_pk += 1
+                run_qty = rnd.randint(1, max(qty / max(count, 1), 1))
+                seconds = run_qty * cycle_times[product_id] * rnd.uniform(
+                        0.8, 1.3)
+                run_end = run_start + timedelta(seconds=int(seconds))
+                run_objs.append(Run(pk=run_pk, job_id=pk, qty=run_qty,
+                    start=run_start, end=run_end,
+                    operator='Operator %i' % rnd.randint(1, 200)))
+                job.run_qty += run_qty
+                job.run_seconds += (run_end - run_start).total_seconds()
+                job.run_count += 1
+                run_start = run_end + timedelta(minutes=rnd.randint(1, 600))
+            job_objs.append(job)
+        _bulk(Job, job_objs)
+        _bulk(Run, run_objs)
+
+    # the job totals are already right, so the products are summed from
+    # them rather than from every run
+    rollup.recompute_products()
+    history.backfill()
+    search.reindex()
+    # bulk_create doesn't send the signals that keep the cache in step
+    for model in refcache.KEY_FIELDS:
+        refcache.invalidate(model)
+
+
+##########
+# RUNNER #
+##########
+
+def _measure(func, context, repeat):
+    times, queries = [], []
+    for i in range(repeat):
+        reset_queries()
+        t = time.time()
+        func(context)
+        times.append(time.time() - t)
+        queries.append(len(connection.queries))
+    return {
+        'min_seconds': min(times),
+        'mean_seconds': sum(times) / len(times),
+        'queries': max(queries),
+    }
+
+
+def explain(queryset):
+    """
+    Returns the database's query plan for queryset, one string per row
+
+    Note that on SQLite, Python's sqlite3 module commits any open
+    transaction first.
+    """
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(EXPLAIN.get(connection.vendor, 'EXPLAIN ') + sql, params)
+    return [ u' '.join(unicode(c) for c in row) for row in cursor.fetchall() ]
+
+
+def run(repeat=3, names=None, sample=50, seed=0):
+    """
+    Runs the registered cases (or only those named) and explains the plan
+    queries, and returns the results as a JSON-ready dict
+    """
+    from django.contrib.auth.models import User
+    from django.test.client import Client
+
+    rnd = random.Random(seed)
+    if not User.objects.filter(username='benchmark').exists():
+        User.objects.create_superuser('benchmark', 'benchmark@example.com',
+                'benchmark')
+    client = Client()
+    client.login(username='benchmark', password='benchmark')
+
+    product_ids = list(Product.objects.values_list('pk', flat=True))
+    job_ids = list(Job.objects.values_list('pk', flat=True))
+    context = {
+        'product_ids': rnd.sample(product_ids, min(sample,
+            len(product_ids))),
+        'job_ids': rnd.sample(job_ids, min(sample, len(job_ids))),
+        'line_id': ProductionLine.objects.aggregate(Min('pk'))['pk__min'],
+        'rnd': rnd,
+        'client': client,
+    }
+
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    results = {}
+    try:
+        for name, func in CASES:
+            if names and name not in names:
+                continue
+            try:
+                results[name] = _measure(func, context, repeat)
+            except NoReverseMatch:
+                results[name] = {'skipped': 'admin urls are not installed'}
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+
+    plans = dict((name, explain(func(context))) for name, func in PLANS)
+
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'counts': dict((model.__name__, model.objects.count()) for model in
+            (ProductionLine, Customer, Product, Job, Run)),
+        'repeat': repeat,
+        'cases': results,
+        'plans': plans,
+    }
+
+
+#########
+# CASES #
+#########
+
+@case('schedule')
+def bench_schedule(context):
+    list(Schedule.objects.all())
+
+
+@case('schedule_count')
+def bench_schedule_count(context):
+    Schedule.objects.count()
+
+
+@case('job_is_scheduled')
+def bench_is_scheduled(context):
+    for job in Job.objects.filter(pk__in=context['job_ids']):
+        job.is_scheduled()
+
+
+@case('job_scheduled_status')
+def bench_scheduled_status(context):
+    Job.objects.scheduled_status(context['job_ids'])
+
+
+@case('job_save')
+def bench_job_save(context):
+    job = Job.objects.get(pk=context['rnd'].choice(context['job_ids']))
+    job.priority = context['rnd'].randint(1, job.priority or 1000)
+    job.save()
+
+
+@case('prioritize')
+def bench_prioritize(context):
+    Job.prioritize()
+
+
+@case('product_avg_cycle_time')
+def bench_product_avg_cycle_time(context):
+    for product in Product.objects.filter(pk__in=context['product_ids']):
+        product.avg_cycle_time()
+
+
+@case('job_avg_cycle_time')
+def bench_job_avg_cycle_time(context):
+    for job in Job.objects.filter(pk__in=context['job_ids']):
+        job.avg_cycle_time()
+
+
+@case('timeline_project')
+def bench_timeline_project(context):
+    timeline.project()
+
+
+@case('cycle_time_stats')
+def bench_cycle_time_stats(context):
+    stats.refresh()
+
+
+@case('rollup_verify')
+def bench_rollup_verify(context):
+    rollup.verify()
+
+
+def _admin_get(context, viewname):
+    from django.core.urlresolvers import reverse
+    response = context['client'].get(reverse(viewname))
+    assert response.status_code == 200, response.status_code
+
+
+@case('job_search')
+def bench_job_search(context):
+    list(search.search_jobs(Job.objects.all(),
+        'WO%i' % context['rnd'].choice(context['job_ids'])))
+
+
+@case('admin_job_changelist')
+def bench_admin_job_changelist(context):
+    _admin_get(context, 'admin:protrac_job_changelist')
+
+
+@case('admin_schedule_changelist')
+def bench_admin_schedule_changelist(context):
+    _admin_get(context, 'admin:protrac_schedule_changelist')
+
+
+@case('admin_run_changelist')
+def bench_admin_run_changelist(context):
+    _admin_get(context, 'admin:protrac_run_changelist')
+
+
+#########
+# PLANS #
+#########
+
+@plan('schedule')
+def plan_schedule(context):
+    return Job.objects.scheduled().queue_order()
+
+
+@plan('schedule_line')
+def plan_schedule_line(context):
+    return Job.objects.scheduled().filter(
+            production_line=context['line_id']).queue_order()
+
+
+@plan('run_history')
+def plan_run_history(context):
+    return Run.objects.filter(job=context['job_ids'][0]).order_by('start')
+
+
+@plan('job_search')
+def plan_job_search(context):
+    return search.search_jobs(Job.objects.all(), 'WO%i' %
+            context['job_ids'][0])
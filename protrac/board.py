@@ -0,0 +1,215 @@
+"""
+Change feed for the live schedule board
+
+Job and Run signals (and Job.set_priorities) publish small events to a
+numbered log kept in the PROTRAC_CACHE cache, so every process sharing that
+cache sees them. A board screen loads its line once, then asks for the
+events after the last one it has seen: either held open as server-sent
+events, or as a long poll. Waiting only reads the log's counter from the
+cache; the database is only touched for the occasional event that doesn't
+carry the job's new state.
+
+Event kinds:
+    {'jobs': [state, ...]}          jobs that changed (see job_state)
+    {'refetch': [job id, ...]}      jobs that changed, state not at hand
+    {'priorities': {job id: n}}     priorities renumbered in bulk
+    {'reset': True}                 anything may have changed
+"""
+import json
+import time
+
+from models import Job
+import refcache
+import timeline
+
+# Seconds events are kept for, and the most a client may fall behind by
+# before it's told to reload instead
+EVENT_TIMEOUT = 600
+BACKLOG = 200
+
+# Seconds between checks of the log while a request waits for events
+POLL_INTERVAL = 0.5
+
+# Longest a long poll is held open, and an event stream before the client
+# reconnects (browsers do so by themselves)
+LONG_POLL_TIMEOUT = 25
+STREAM_DURATION = 300
+
+SEQ_KEY = 'protrac:board:seq'
+
+
+def _event_key(seq):
+    return 'protrac:board:%i' % seq
+
+
+def job_state(job):
+    """
+    The fields of a job that the board shows, from the instance in memory,
+    and the line it was on before it was saved
+    """
+    return {
+        'id': job.pk,
+        'line': job.production_line_id,
+        'previous_line': getattr(job, '_previous_line_id',
+            job.production_line_id),
+        'priority': job.priority,
+        'qty': job.qty,
+        'qty_remaining': max(job.qty - job.run_qty, 0),
+        'suspended': job.suspended or '',
+        'scheduled': bool(not job.void and job.production_line_id
+            and job.run_qty < job.qty),
+    }
+
+
+###########
+# PUBLISH #
+###########
+
+def publish(event):
+    """
+    Appends an event to the log and returns its number
+    """
+    cache = timeline.get_timeline_cache()
+    try:
+        seq = cache.incr(SEQ_KEY)
+    except ValueError:
+        cache.add(SEQ_KEY, 0, timeline.GENERATION_TIMEOUT)
+        seq = cache.incr(SEQ_KEY)
+    cache.set(_event_key(seq), event, EVENT_TIMEOUT)
+    return seq
+
+
+def publish_jobs(jobs):
+    return publish({'jobs': [ job_state(job) for job in jobs ]})
+
+
+def publish_refetch(job_ids):
+    return publish({'refetch': list(job_ids)})
+
+
+def publish_priorities(priorities):
+    return publish({'priorities': dict(priorities)})
+
+
+def publish_reset():
+    return publish({'reset': True})
+
+
+########
+# READ #
+########
+
+def current_seq():
+    return timeline.get_timeline_cache().get(SEQ_KEY) or 0
+
+
+def line_delta(line_id, since):
+    """
+    Returns what changed on a line after event number since:
+    {'seq', 'reset', 'jobs': [state, ...], 'priorities': {id: n}}
+
+    Job states are included for jobs on the line, jobs that left it and
+    deleted jobs (to be removed). Priorities are for all jobs, the board
+    ignores the ones it doesn't show.
+    """
+    cache = timeline.get_timeline_cache()
+    seq = current_seq()
+    delta = {'seq': seq, 'reset': False, 'jobs': [], 'priorities': {}}
+    if seq <= since:
+        return delta
+    if seq - since > BACKLOG:
+        delta['reset'] = True
+        return delta
+
+    keys = [ _event_key(n) for n in range(since + 1, seq + 1) ]
+    found = cache.get_many(keys)
+    states, refetch = {}, set()
+    for key in keys:
+        event = found.get(key)
+        if event is None or event.get('reset'):
+            # expired or everything changed
+            delta['reset'] = True
+            return delta
+        for state in event.get('jobs', ()):
+            states[state['id']] = state
+            refetch.discard(state['id'])
+        for job_id in event.get('refetch', ()):
+            states.pop(job_id, None)
+            refetch.add(job_id)
+        for job_id, priority in event.get('priorities', {}).items():
+            delta['priorities'][int(job_id)] = priority
+            if job_id in states:
+                states[job_id]['priority'] = priority
+
+    if refetch:
+        for job in Job.objects.filter(pk__in=refetch):
+            states[job.pk] = job_state(job)
+        for job_id in refetch - set(states):
+            # deleted
+            states[job_id] = {'id': job_id, 'deleted': True,
+                    'scheduled': False}
+    delta['jobs'] = sorted((s for s in states.values()
+        if s.get('deleted') or line_id in (s['line'], s['previous_line'])),
+        key=lambda s: s['id'])
+    return delta
+
+
+def wait_for_delta(line_id, since, timeout=None):
+    """
+    Returns the line's delta as soon as there are events after since, or an
+    empty one after timeout seconds
+    """
+    deadline = time.time() + (LONG_POLL_TIMEOUT if timeout is None
+            else timeout)
+    while current_seq() <= since and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+    return line_delta(line_id, since)
+
+
+def event_stream(line_id, since, duration=None):
+    """
+    Yields the line's changes after event number since as server-sent
+    events, with a comment as a heartbeat while nothing happens
+    """
+    deadline = time.time() + (STREAM_DURATION if duration is None
+            else duration)
+    yield 'retry: 2000\n\n'
+    while time.time() < deadline:
+        delta = wait_for_delta(line_id, since,
+                min(LONG_POLL_TIMEOUT, max(deadline - time.time(), 0)))
+        if delta['seq'] <= since:
+            yield ': keepalive\n\n'
+        elif delta['reset'] or delta['jobs'] or delta['priorities']:
+            since = delta['seq']
+            yield 'id: %i\ndata: %s\n\n' % (since, json.dumps(delta))
+        else:
+            # nothing for this line, but a reconnect can start from here
+            since = delta['seq']
+            yield 'id: %i\n\n' % since
+
+
+#########
+# BOARD #
+#########
+
+def line_rows(line_id):
+    """
+    The line's scheduled jobs in queue order, with their projected start
+    and end
+    """
+    jobs = list(Job.objects.scheduled().filter(production_line=line_id)
+            .queue_order())
+    refcache.attach(jobs, 'product')
+    refcache.attach(jobs, 'customer')
+    projection = timeline.cached_line(line_id)
+    rows = []
+    for job in jobs:
+        entry = projection.entry(job.pk)
+        rows.append({
+            'job': job,
+            'state': job_state(job),
+            'start': entry.start if entry else None,
+            'end': entry.end if entry else None,
+            'late': entry.is_late() if entry else False,
+        })
+    return rows
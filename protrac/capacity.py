@@ -0,0 +1,90 @@
+"""
+Capacity and load report
+
+How much scheduled work is waiting on each production line and each line
+category: remaining hours and weight, the number of jobs and how many of
+them are past their due date. Every figure comes from grouped aggregates
+(Job.objects.remaining_totals), so the report takes the same three queries
+however many jobs and lines there are. It's cached for a short while
+(PROTRAC_CAPACITY_CACHE_TIMEOUT) rather than invalidated on every change.
+"""
+from datetime import date
+
+from django.utils import timezone
+
+import app_settings
+import timeline
+from app_settings import LINE_CATEGORY_CHOICES
+from models import Job, ProductionLine
+
+FIGURES = ('jobs', 'late', 'hours', 'weight')
+
+
+def _figures(totals):
+    totals = totals or {}
+    return {
+        'jobs': totals.get('jobs', 0),
+        'late': totals.get('late', 0),
+        'hours': totals.get('seconds', 0.0) / 3600.0,
+        'weight': totals.get('weight', 0.0),
+    }
+
+
+def report(today=None):
+    """
+    Returns {'date', 'generated', 'lines': [...], 'categories': [...],
+    'total': {...}}, where each line and category has the FIGURES. Lines
+    and categories without scheduled jobs are included, with zeros, and
+    jobs on lines without a known category are under an 'Uncategorized'
+    category (None) when there are any.
+    """
+    today = today or date.today()
+    scheduled = Job.objects.scheduled()
+    by_line = scheduled.remaining_totals(late_before=today)
+    by_category = scheduled.remaining_totals('category', late_before=today)
+
+    lines = []
+    for line in ProductionLine.objects.order_by('name'):
+        row = _figures(by_line.get(line.pk))
+        row.update({'id': line.pk, 'name': line.name,
+            'category': line.category})
+        lines.append(row)
+
+    categories = []
+    for code, name in LINE_CATEGORY_CHOICES:
+        row = _figures(by_category.get(code))
+        row.update({'category': code, 'name': unicode(name)})
+        categories.append(row)
+    # lines without a category, or with one no longer in the settings
+    codes = set(code for code, name in LINE_CATEGORY_CHOICES)
+    other = [ totals for code, totals in by_category.items()
+            if code not in codes ]
+    if other:
+        row = _figures(dict((key, sum(totals[key] for totals in other))
+            for key in other[0]))
+        row.update({'category': None, 'name': u'Uncategorized'})
+        categories.append(row)
+
+    total = dict((figure, sum(row[figure] for row in categories))
+            for figure in FIGURES)
+    return {
+        'date': today.isoformat(),
+        'generated': timezone.now().isoformat(),
+        'lines': lines,
+        'categories': categories,
+        'total': total,
+    }
+
+
+def cached_report():
+    """
+    report() for today, from the cache when it's recent enough
+    """
+    cache = timeline.get_timeline_cache()
+    today = date.today()
+    key = 'protrac:capacity:%s' % today.isoformat()
+    data = cache.get(key)
+    if data is None:
+        data = report(today)
+        cache.set(key, data, app_settings.CAPACITY_CACHE_TIMEOUT)
+    return data
@@ -0,0 +1,164 @@
+"""
+Streaming CSV and JSON exports of Jobs, Runs and the Schedule
+
+Each export is a generator of rows read a chunk at a time (keyset paged on
+pk, or a single server-side iterator for the schedule), so memory use stays
+flat and the first row is available immediately. Remaining quantity,
+weight and duration come from the denormalized Run totals, not from
+per-row aggregates.
+"""
+import csv
+import json
+from datetime import date, datetime
+
+from models import Job, Run
+
+# Rows fetched per query when paging through a table
+CHUNK_SIZE = 2000
+
+JOB_FIELDS = ('pk', 'production_line__name', 'product__part_number',
+        'customer__name', 'refs', 'due_date', 'priority', 'qty', 'run_qty',
+        'product__cycle_time', 'product__material_wt', 'suspended', 'void',
+        'ctime', 'mtime')
+JOB_COLUMNS = ('job', 'production_line', 'part_number', 'customer', 'refs',
+        'due_date', 'priority', 'qty', 'qty_done', 'qty_remaining',
+        'weight_remaining', 'seconds_remaining', 'suspended', 'void',
+        'created', 'modified')
+
+RUN_FIELDS = ('pk', 'job', 'job__product__part_number', 'qty', 'start',
+        'end', 'job__product__material_wt', 'operator')
+RUN_COLUMNS = ('run', 'job', 'part_number', 'qty', 'start', 'end',
+        'seconds', 'weight', 'operator')
+
+
+def _remaining(qty, run_qty):
+    return max(qty - run_qty, 0)
+
+
+def _job_row(r):
+    (pk, line, part_number, customer, refs, due_date, priority, qty, run_qty,
+            cycle_time, material_wt, suspended, void, ctime, mtime) = r
+    remaining = _remaining(qty, run_qty)
+    return (pk, line, part_number, customer, refs, due_date, priority, qty,
+            run_qty, remaining, remaining * material_wt,
+            remaining * cycle_time, suspended, void, ctime, mtime)
+
+
+def _run_row(r):
+    pk, job, part_number, qty, start, end, material_wt, operator = r
+    return (pk, job, part_number, qty, start, end,
+            (end - start).total_seconds(), qty * material_wt, operator)
+
+
+def _chunked(queryset, fields):
+    """
+    Yields values_list rows of queryset in pk order, one chunk per query
+    """
+    last = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        rows = list(chunk.values_list(*fields)[:CHUNK_SIZE])
+        for row in rows:
+            yield row
+        if len(rows) < CHUNK_SIZE:
+            return
+        last = rows[-1][0]
+
+
+def job_rows(queryset=None):
+    if queryset is None:
+        queryset = Job.objects.all()
+    for row in _chunked(queryset, JOB_FIELDS):
+        yield _job_row(row)
+
+
+def run_rows(queryset=None):
+    if queryset is None:
+        queryset = Run.objects.all()
+    for row in _chunked(queryset, RUN_FIELDS):
+        yield _run_row(row)
+
+
+def schedule_rows():
+    # queue order can't be keyset paged on pk, but the schedule only holds
+    # open jobs
+    rows = Job.objects.scheduled().queue_order().values_list(
+            'unprioritized', *JOB_FIELDS)
+    for row in rows.iterator():
+        yield _job_row(row[1:])
+
+
+# export name -> (column names, row generator)
+EXPORTS = {
+    'jobs': (JOB_COLUMNS, job_rows),
+    'runs': (RUN_COLUMNS, run_rows),
+    'schedule': (JOB_COLUMNS, schedule_rows),
+}
+
+# The model each export reads, whose change permission it needs (Django
+# has no view permission)
+MODELS = {
+    'jobs': Job,
+    'runs': Run,
+    'schedule': Job,
+}
+
+FORMATS = ('csv', 'json')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'json': 'application/json',
+}
+
+
+class _Echo(object):
+    """
+    File-like object for csv.writer that hands back what's written
+    """
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return unicode(value).encode('utf-8')
+
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def csv_lines(columns, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([ _csv_value(v) for v in row ])
+
+
+def json_lines(columns, rows):
+    """
+    Yields a JSON array of objects, one object per chunk of output
+    """
+    yield '['
+    separator = '\n'
+    for row in rows:
+        yield separator + json.dumps(dict(zip(columns,
+            [ _json_value(v) for v in row ])), sort_keys=True)
+        separator = ',\n'
+    yield '\n]\n'
+
+
+def stream(name, format='csv'):
+    """
+    Returns a generator of output chunks for the named export
+    """
+    columns, rows = EXPORTS[name]
+    lines = {'csv': csv_lines, 'json': json_lines}[format]
+    return lines(columns, rows())
@@ -0,0 +1,22 @@
+from django import forms
+
+import importer
+from app_settings import LINE_CATEGORY_CHOICES
+
+
+class ImportForm(forms.Form):
+    kind = forms.ChoiceField(label='Import',
+            choices=[ (name, name.title()) for name in
+                sorted(importer.IMPORTERS) ])
+    file = forms.FileField(label='CSV file',
+            help_text='The first row names the columns.')
+
+
+class OptimizeForm(forms.Form):
+    category = forms.ChoiceField(required=False,
+            choices=[('', u'All categories')] + list(LINE_CATEGORY_CHOICES),
+            help_text='Only plan jobs for, and use, lines of this category.')
+    movable = forms.BooleanField(required=False,
+            label='Move assigned jobs',
+            help_text="Also move jobs that are on a line but haven't "
+                "started.")
@@ -0,0 +1,114 @@
+"""
+Daily production history
+
+DailyProduction holds Run totals (qty, run seconds, weight and number of
+runs) per day, production line, product and operator. Run.save() and the
+Run pre_delete signal keep it up to date; add_runs() does the same for
+Runs written with bulk_create, and backfill() rebuilds it from the Runs.
+
+Reports read it with totals(), eg. units per line per day:
+
+    history.totals(['day', 'production_line'], day__gte=since)
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Sum
+
+from aggregates import values_seconds
+from models import DailyProduction, Job, Run, production_day
+
+# Rows written per bulk_create call by backfill()
+CHUNK_SIZE = 2000
+
+TOTALS = ('qty', 'seconds', 'weight', 'runs')
+
+
+def _group(rows):
+    """
+    Sums (day, line, product, operator, qty, seconds, weight) rows into
+    {(day, line, product, operator): [qty, seconds, weight, runs]}
+    """
+    groups = {}
+    for day, line_id, product_id, operator, qty, seconds, weight in rows:
+        key = (day, line_id, product_id, operator)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, 0.0, 0.0, 0]
+        group[0] += qty
+        group[1] += seconds
+        group[2] += weight
+        group[3] += 1
+    return groups
+
+
+def add_runs(runs):
+    """
+    Adds Runs written without Run.save() (eg. with bulk_create), with one
+    query for their jobs and one or two per day, line, product and operator
+    """
+    jobs = dict((pk, (line_id, product_id, material_wt)) for pk, line_id,
+            product_id, material_wt in Job.objects.filter(pk__in=set(
+                run.job_id for run in runs)).values_list('pk',
+                'production_line', 'product', 'product__material_wt'))
+    rows = []
+    for run in runs:
+        line_id, product_id, material_wt = jobs[run.job_id]
+        rows.append((production_day(run.start), line_id, product_id,
+            run.operator, run.qty, run.duration().total_seconds(),
+            run.qty * material_wt))
+    for key, values in _group(rows).items():
+        DailyProduction.adjust(*(key + tuple(values)))
+
+
+def _run_rows(runs):
+    # (day, line, product, operator, qty, seconds, weight) for each Run
+    rows = values_seconds(runs, 'start', 'job__production_line',
+            'job__product', 'operator', 'qty', 'seconds',
+            'job__product__material_wt')
+    for (start, line_id, product_id, operator, qty, seconds,
+            material_wt) in rows:
+        yield (production_day(start), line_id, product_id, operator, qty,
+                seconds, qty * material_wt)
+
+
+@transaction.commit_on_success
+def backfill(since=None):
+    """
+    Rebuilds the history from the Runs, reading them in a single pass, for
+    every day or only from the date since. Returns the number of rows.
+    """
+    runs = Run.objects.order_by()
+    rows = DailyProduction.objects.all()
+    if since is not None:
+        # a day's runs may have started up to a day either side in UTC
+        runs = runs.filter(start__gte=since - timedelta(days=1))
+        rows = rows.filter(day__gte=since)
+    groups = _group(row for row in _run_rows(runs)
+            if since is None or row[0] >= since)
+
+    rows.delete()
+    objs = [ DailyProduction(day=day, production_line_id=line_id,
+        line_key=line_id or 0, product_id=product_id, operator=operator,
+        qty=qty, seconds=seconds, weight=weight, runs=count)
+        for (day, line_id, product_id, operator), (qty, seconds, weight,
+            count) in groups.items() ]
+    for i in range(0, len(objs), CHUNK_SIZE):
+        DailyProduction.objects.bulk_create(objs[i:i + CHUNK_SIZE])
+    return len(objs)
+
+
+def totals(group_by, **filters):
+    """
+    Returns the history summed over the fields in group_by (eg. 'day',
+    'production_line', 'product' or 'operator'), optionally filtered, as a
+    list of dicts in the order of group_by
+    """
+    rows = DailyProduction.objects.filter(**filters).order_by(*group_by) \
+            .values(*group_by).annotate(*[ Sum(name) for name in TOTALS ])
+    results = []
+    for row in rows:
+        for name in TOTALS:
+            row[name] = row.pop('%s__sum' % name)
+        results.append(row)
+    return results
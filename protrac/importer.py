@@ -0,0 +1,286 @@
+"""
+Bulk import of Products, Jobs and Runs
+
+Rows (dicts, eg. from csv.DictReader) are handled a batch at a time: each
+batch resolves its foreign keys (part number, customer name, production
+line name, job id) with at most one query per related model (names come
+from the reference cache), validates the rows
+without touching the database, and writes the valid ones with bulk_create
+inside a transaction. Bad rows are reported with their row number and don't
+stop the rest of the batch.
+
+bulk_create skips Job.save() and Run.save(), so priorities, Run totals,
+the search index and cached timelines are brought up to date once, after
+the last batch (and the daily production history once per batch).
+"""
+import csv
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import (Max, PositiveIntegerField,
+        PositiveSmallIntegerField)
+
+from models import Customer, Job, Product, ProductionLine, Run
+import history
+import refcache
+import rollup
+import search
+import timeline
+
+# Rows validated and written together
+BATCH_SIZE = 1000
+
+PRODUCT_COLUMNS = ('part_number', 'description', 'setup', 'cycle_time',
+        'material_wt')
+JOB_COLUMNS = ('part_number', 'customer', 'qty', 'refs', 'due_date',
+        'production_line', 'priority')
+RUN_COLUMNS = ('job', 'qty', 'start', 'end', 'operator')
+
+
+class ImportResult(object):
+    """
+    Counts of rows read and created, and a list of (row number, message) for
+    the rows that were skipped
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.errors = []
+
+    def __unicode__(self):
+        return u'%i rows read, %i created, %i errors' % (self.rows,
+                self.created, len(self.errors))
+
+    def error(self, row_number, message):
+        self.errors.append((row_number, message))
+
+
+def _batches(rows, size):
+    rows = iter(rows)
+    number = 1
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield [ (number + i, row) for i, row in enumerate(batch) ]
+        number += len(batch)
+
+
+def _clean(row, columns):
+    """
+    Strips the given columns of a row, with blank values as None
+    """
+    values = {}
+    for column in columns:
+        value = row.get(column)
+        if isinstance(value, basestring):
+            value = value.strip()
+        values[column] = value if value not in ('', None) else None
+    return values
+
+
+def _validate(obj, exclude, result, number):
+    """
+    Converts and validates the fields of obj (with no queries), recording
+    any errors against the row. Returns whether it's valid.
+    """
+    try:
+        obj.clean_fields(exclude=exclude)
+        # the model fields leave this to the forms (and the database would
+        # reject the whole batch)
+        negative = dict((f.name, [u'Ensure this value is greater than or '
+            u'equal to 0.']) for f in obj._meta.fields
+            if isinstance(f, (PositiveIntegerField, PositiveSmallIntegerField))
+            and getattr(obj, f.attname) is not None
+            and getattr(obj, f.attname) < 0)
+        if negative:
+            raise ValidationError(negative)
+        obj.clean()
+    except ValidationError, e:
+        if hasattr(e, 'message_dict'):
+            message = u'; '.join(u'%s: %s' % (field, u' '.join(errors))
+                    for field, errors in sorted(e.message_dict.items()))
+        else:
+            message = u' '.join(e.messages)
+        result.error(number, message)
+        return False
+    return True
+
+
+def _lookup(model, values):
+    """
+    Returns {value: pk} for the rows of model whose name (or part number) is
+    in values, from the reference cache
+    """
+    return dict((value, obj.pk) for value, obj in
+            refcache.get_by_key(model, values).items())
+
+
+@transaction.commit_on_success
+def _write(model, objs):
+    if objs:
+        model.objects.bulk_create(objs)
+
+
+############
+# PRODUCTS #
+############
+
+def import_products(rows, batch_size=None):
+    result = ImportResult()
+    for batch in _batches(rows, batch_size or BATCH_SIZE):
+        batch = [ (n, _clean(row, PRODUCT_COLUMNS)) for n, row in batch ]
+        existing = _lookup(Product, [ row['part_number'] for n, row in batch ])
+
+        objs, seen = [], set()
+        for number, row in batch:
+            result.rows += 1
+            part_number = row['part_number']
+            if part_number in existing or part_number in seen:
+                result.error(number, u'part_number: %s already exists' %
+                        part_number)
+                continue
+            if row['material_wt'] is None:
+                del row['material_wt']
+            obj = Product(**row)
+            if _validate(obj, [], result, number):
+                seen.add(part_number)
+                objs.append(obj)
+        _write(Product, objs)
+        result.created += len(objs)
+    return result
+
+
+########
+# JOBS #
+########
+
+def import_jobs(rows, batch_size=None):
+    result = ImportResult()
+    prioritized = False
+    # bulk_create doesn't set the new pks, but they're above the current ones
+    top = Job.objects.aggregate(top=Max('pk'))['top'] or 0
+    for batch in _batches(rows, batch_size or BATCH_SIZE):
+        batch = [ (n, _clean(row, JOB_COLUMNS)) for n, row in batch ]
+        products = _lookup(Product, [ row['part_number'] for n, row in batch ])
+        customers = _lookup(Customer, [ row['customer'] for n, row in batch ])
+        lines = _lookup(ProductionLine,
+                [ row['production_line'] for n, row in batch ])
+
+        objs = []
+        for number, row in batch:
+            result.rows += 1
+            missing = [ u'%s: %s not found' % (column, row[column])
+                    for column, found in (('part_number', products),
+                        ('customer', customers))
+                    if row[column] not in found ]
+            if row['production_line'] is not None \
+                    and row['production_line'] not in lines:
+                missing.append(u'production_line: %s not found' %
+                        row['production_line'])
+            if missing:
+                result.error(number, u'; '.join(missing))
+                continue
+
+            obj = Job(product_id=products[row['part_number']],
+                    customer_id=customers[row['customer']],
+                    production_line_id=lines.get(row['production_line']),
+                    qty=row['qty'], refs=row['refs'] or '',
+                    due_date=row['due_date'], priority=row['priority'] or 0)
+            if _validate(obj, ['product', 'customer', 'production_line'],
+                    result, number):
+                prioritized = prioritized or obj.priority > 0
+                objs.append(obj)
+        _write(Job, objs)
+        result.created += len(objs)
+
+    if prioritized:
+        Job.prioritize_added(Job.objects.filter(pk__gt=top))
+    if result.created:
+        search.reindex(Job.objects.filter(pk__gt=top))
+        timeline.invalidate_lines()
+    return result
+
+
+########
+# RUNS #
+########
+
+def build_runs(batch, result):
+    """
+    Returns valid (unsaved) Runs for a batch of (row number, row) with one
+    query for the jobs, recording the rows that aren't against result
+    """
+    batch = [ (n, _clean(row, RUN_COLUMNS)) for n, row in batch ]
+    pks = []
+    for number, row in batch:
+        try:
+            pks.append(int(row['job']))
+        except (TypeError, ValueError):
+            pass
+    jobs = set(Job.objects.filter(pk__in=pks).values_list('pk', flat=True))
+
+    objs = []
+    for number, row in batch:
+        result.rows += 1
+        try:
+            job_id = int(row['job'])
+        except (TypeError, ValueError):
+            job_id = None
+        if job_id not in jobs:
+            result.error(number, u'job: %s not found' % row['job'])
+            continue
+
+        obj = Run(job_id=job_id, qty=row['qty'], start=row['start'],
+                end=row['end'], operator=row['operator'] or '')
+        if not _validate(obj, ['job'], result, number):
+            continue
+        if obj.end < obj.start:
+            result.error(number, u'end: is before start')
+            continue
+        objs.append(obj)
+    return objs
+
+
+def import_runs(rows, batch_size=None):
+    result = ImportResult()
+    job_ids = set()
+    for batch in _batches(rows, batch_size or BATCH_SIZE):
+        objs = build_runs(batch, result)
+        _write(Run, objs)
+        if objs:
+            history.add_runs(objs)
+        job_ids.update(obj.job_id for obj in objs)
+        result.created += len(objs)
+
+    if job_ids:
+        # also invalidates the cached timelines
+        rollup.rebuild(job_ids)
+    return result
+
+
+IMPORTERS = {
+    'products': (PRODUCT_COLUMNS, import_products),
+    'jobs': (JOB_COLUMNS, import_jobs),
+    'runs': (RUN_COLUMNS, import_runs),
+}
+
+# The model each importer creates, for checking the add permission
+MODELS = {
+    'products': Product,
+    'jobs': Job,
+    'runs': Run,
+}
+
+
+def import_csv(name, f, batch_size=None):
+    """
+    Imports a CSV file (with a header row naming the columns) using the
+    named importer
+    """
+    columns, importer = IMPORTERS[name]
+    rows = ( dict((k, v.decode('utf-8') if isinstance(v, str) else v)
+        for k, v in row.items()) for row in csv.DictReader(f) )
+    return importer(rows, batch_size)
@@ -0,0 +1,193 @@
+"""
+Run ingest for line controllers
+
+Controllers POST completed runs as JSON lines, one object per line with the
+importer's run columns (job, qty, start, end, operator). The request is
+validated with one query for the jobs and acknowledged; the valid Runs are
+handed to a background thread, which writes whatever has queued up (up to
+INGEST_BATCH_SIZE runs) with one bulk_create, and brings Run totals and
+cached timelines up to date once per batch instead of once per run. A batch
+is written in one transaction; if it fails, each request in it is retried
+on its own, so one bad request doesn't lose the others' runs.
+
+The queue is in memory, so runs acknowledged but not yet written are lost
+if the process exits. Set PROTRAC_INGEST_ASYNC = False to write them before
+responding instead.
+"""
+import json
+import logging
+import Queue
+import threading
+
+from django.db import connection, transaction
+from django.utils.crypto import constant_time_compare
+
+import app_settings
+import board
+import history
+import importer
+import rollup
+import timeline
+from models import Job, Run
+
+logger = logging.getLogger('protrac.ingest')
+
+_queue = Queue.Queue(app_settings.INGEST_QUEUE_SIZE)
+_worker = None
+_worker_lock = threading.Lock()
+
+
+class QueueFull(Exception):
+    pass
+
+
+def controller(authorization):
+    """
+    Returns the controller name for an Authorization header value, or None
+    """
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'token' or not token.strip():
+        return None
+    token = token.strip()
+    for key, name in app_settings.INGEST_TOKENS.items():
+        if constant_time_compare(key, token):
+            return name
+    return None
+
+
+def parse(body, operator=''):
+    """
+    Returns (valid unsaved Runs, ImportResult) for a body of JSON lines.
+    Blank lines are skipped; lines are numbered from 1.
+    """
+    result = importer.ImportResult()
+    batch = []
+    for number, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        if not isinstance(row, dict):
+            result.rows += 1
+            result.error(number, u'not a JSON object')
+            continue
+        row = dict((column, row.get(column)) for column in
+                importer.RUN_COLUMNS)
+        row['operator'] = row['operator'] or operator
+        batch.append((number, row))
+    return importer.build_runs(batch, result), result
+
+
+#########
+# WRITE #
+#########
+
+@transaction.commit_on_success
+def _write(runs):
+    # returns {job id: line id} for the jobs written to; runs for jobs
+    # deleted since they were validated can't be written
+    jobs = dict(Job.objects.filter(pk__in=set(run.job_id for run in runs))
+            .values_list('pk', 'production_line'))
+    missing = [ run for run in runs if run.job_id not in jobs ]
+    if missing:
+        logger.warning('Dropped %i ingested runs for deleted jobs %s',
+                len(missing), sorted(set(run.job_id for run in missing)))
+        runs = [ run for run in runs if run.job_id in jobs ]
+    if not runs:
+        return {}
+    Run.objects.bulk_create(runs)
+    history.add_runs(runs)
+    rollup.recompute(jobs)
+    return jobs
+
+
+def write(runs):
+    """
+    Writes a batch of runs and updates their Jobs' and Products' totals and
+    the daily production history, all in one transaction, then the cached
+    timelines of their lines and the live boards
+    """
+    jobs = _write(runs) if runs else {}
+    if jobs:
+        # remaining quantities changed without any signals being sent
+        timeline.invalidate_lines(set(line_id for line_id in jobs.values()
+            if line_id is not None))
+        board.publish_refetch(sorted(jobs))
+
+
+def _take_batch():
+    # waits for a request's runs, then adds whatever else is waiting
+    requests = [_queue.get()]
+    count = len(requests[0])
+    while count < app_settings.INGEST_BATCH_SIZE:
+        try:
+            requests.append(_queue.get_nowait())
+        except Queue.Empty:
+            break
+        count += len(requests[-1])
+    return requests
+
+
+def _write_batch(requests):
+    try:
+        write([ run for runs in requests for run in runs ])
+    except Exception:
+        if len(requests) == 1:
+            logger.exception('Failed to write %i ingested runs',
+                    len(requests[0]))
+            return
+        logger.warning('Failed to write a batch of %i requests, retrying '
+                'each on its own', len(requests), exc_info=True)
+        for runs in requests:
+            _write_batch([runs])
+
+
+def _work():
+    while True:
+        requests = _take_batch()
+        try:
+            _write_batch(requests)
+        finally:
+            # this thread's connection isn't closed at the end of a request
+            connection.close()
+            for i in range(len(requests)):
+                _queue.task_done()
+
+
+def _start_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='protrac-ingest')
+            _worker.daemon = True
+            _worker.start()
+
+
+def enqueue(runs):
+    """
+    Queues runs to be written by the background thread (or writes them now
+    when INGEST_ASYNC is off). Raises QueueFull if too many are waiting.
+    """
+    if not runs:
+        return
+    if not app_settings.INGEST_ASYNC:
+        write(runs)
+        return
+    _start_worker()
+    try:
+        _queue.put_nowait(runs)
+    except Queue.Full:
+        raise QueueFull
+
+
+def flush():
+    """
+    Waits until every queued run has been written
+    """
+    _queue.join()
+
+
+def pending():
+    return _queue.qsize()
@@ -0,0 +1,126 @@
+"""
+Keyset (seek) pagination
+
+Pages through a queryset ordered by a unique key, eg. ('-start', '-id'),
+by filtering on the key of the last row shown instead of skipping rows with
+OFFSET, so the thousandth page costs the same as the first. Pages are
+addressed by a cursor (the key of a row, see encode()) rather than a number.
+
+estimate_count() stands in for COUNT(*) on tables too big to count on every
+page view.
+"""
+import json
+from collections import namedtuple
+from datetime import date, datetime
+
+from django.db import connections
+from django.db.models import Q
+
+Page = namedtuple('Page', 'pks has_previous has_next first last')
+
+
+def _fields(model, ordering):
+    # the model fields of an ordering, which must end with the primary key
+    names = [ name.lstrip('-') for name in ordering ]
+    if names[-1] not in ('pk', model._meta.pk.name):
+        raise ValueError('A keyset ordering must end with the primary key')
+    return [ model._meta.pk if name == 'pk' else model._meta.get_field(name)
+            for name in names ]
+
+
+def encode(values):
+    """
+    Returns the cursor for a row's key values
+    """
+    return json.dumps([ v.isoformat() if isinstance(v, (date, datetime))
+        else v for v in values ], separators=(',', ':'))
+
+
+def decode(model, ordering, cursor):
+    """
+    Returns the key values of a cursor, or raises ValueError
+    """
+    try:
+        values = json.loads(cursor)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor %r' % cursor)
+    fields = _fields(model, ordering)
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise ValueError('Invalid cursor %r' % cursor)
+    try:
+        return tuple(field.to_python(value) for field, value in
+                zip(fields, values))
+    except Exception:
+        raise ValueError('Invalid cursor %r' % cursor)
+
+
+def reverse(ordering):
+    return [ name[1:] if name.startswith('-') else '-' + name
+            for name in ordering ]
+
+
+def seek(ordering, values):
+    """
+    Returns a Q for the rows after the row with the given key values in the
+    given ordering
+    """
+    query = Q()
+    for i, name in enumerate(ordering):
+        field = name.lstrip('-')
+        lookup = '%s__%s' % (field, 'lt' if name.startswith('-') else 'gt')
+        q = Q(**{lookup: values[i]})
+        for previous, value in zip(ordering[:i], values):
+            q &= Q(**{previous.lstrip('-'): value})
+        query |= q
+    return query
+
+
+def page(queryset, ordering, per_page, after=None, before=None):
+    """
+    Returns the Page of per_page rows after (or before) the given key values,
+    or the first page. Only reads the key columns, with one query.
+    """
+    names = [ name.lstrip('-') for name in ordering ]
+    if before is not None:
+        rows = queryset.filter(seek(reverse(ordering), before)).order_by(
+                *reverse(ordering))
+    else:
+        rows = queryset.order_by(*ordering)
+        if after is not None:
+            rows = rows.filter(seek(ordering, after))
+    rows = list(rows.values_list(*names)[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before is not None:
+        rows.reverse()
+        has_previous, has_next = more, True
+    else:
+        has_previous, has_next = after is not None, more
+    return Page([ row[-1] for row in rows ], has_previous and bool(rows),
+            has_next and bool(rows), rows[0] if rows else None,
+            rows[-1] if rows else None)
+
+
+def estimate_count(queryset):
+    """
+    Returns (count, estimated): the planner's estimate of the number of rows
+    on PostgreSQL, the table statistics for a whole table on MySQL, or else
+    the exact count
+    """
+    connection = connections[queryset.db]
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.order_by().query.sql_with_params()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows']), True
+    if connection.vendor == 'mysql' and not queryset.query.where:
+        cursor.execute('SELECT table_rows FROM information_schema.tables '
+                'WHERE table_schema = DATABASE() AND table_name = %s',
+                [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row and row[0] is not None:
+            return int(row[0]), True
+    return queryset.count(), False
@@ -0,0 +1,26 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from protrac import history
+
+
+class Command(NoArgsCommand):
+    help = ('Rebuilds the daily production history (Run totals per day, '
+            'production line, product and operator) from the Runs.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+            help='Only rebuild the days from this date on (YYYY-MM-DD).'),
+    )
+
+    def handle_noargs(self, **options):
+        since = options['since']
+        if since is not None:
+            try:
+                since = datetime.strptime(since, '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--since must be a date like 2013-01-31')
+        count = history.backfill(since)
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('Wrote %i daily production rows.' % count)
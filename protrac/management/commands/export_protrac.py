@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import LabelCommand, CommandError
+
+from protrac import export
+
+
+class Command(LabelCommand):
+    help = ('Streams an export of protrac data. Exports are: %s.' %
+            ', '.join(sorted(export.EXPORTS)))
+    args = '<export>'
+    label = 'export'
+    option_list = LabelCommand.option_list + (
+        make_option('--format', '-f', dest='format', default='csv',
+            choices=export.FORMATS,
+            help='Output format: %s (default: csv).' % ', '.join(
+                export.FORMATS)),
+        make_option('--output', '-o', dest='output',
+            help='Write to this file instead of stdout.'),
+    )
+
+    def handle_label(self, name, **options):
+        if name not in export.EXPORTS:
+            raise CommandError('Unknown export %r, choose from: %s' % (name,
+                ', '.join(sorted(export.EXPORTS))))
+
+        chunks = export.stream(name, options['format'])
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from protrac import importer
+
+
+class Command(BaseCommand):
+    help = ('Imports protrac data from CSV files with a header row. Imports '
+            'are: %s.' % ', '.join(sorted(importer.IMPORTERS)))
+    args = '<import> <file.csv>'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=importer.BATCH_SIZE,
+            help='Rows validated and written per transaction (default: '
+                '%i).' % importer.BATCH_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: import_protrac %s' % self.args)
+        name, path = args
+        if name not in importer.IMPORTERS:
+            raise CommandError('Unknown import %r, choose from: %s' % (name,
+                ', '.join(sorted(importer.IMPORTERS))))
+
+        try:
+            f = open(path, 'rU')
+        except IOError, e:
+            raise CommandError(e)
+        with f:
+            result = importer.import_csv(name, f, options['batch_size'])
+
+        for number, message in result.errors:
+            self.stderr.write(u'row %i: %s' % (number, message))
+        self.stdout.write(unicode(result))
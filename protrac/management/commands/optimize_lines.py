@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from protrac import app_settings, optimizer
+
+
+class Command(NoArgsCommand):
+    help = ('Proposes production lines for unassigned jobs (and with '
+            '--movable, for jobs that haven\'t started) to minimize lateness '
+            'and balance load. Nothing is changed without --apply.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--category', dest='category', default=None,
+            help='Only plan jobs for, and use, lines of this category.'),
+        make_option('--movable', action='store_true', dest='movable',
+            default=False, help='Also move assigned jobs that haven\'t '
+                'started.'),
+        make_option('--time-limit', dest='time_limit', type='float',
+            default=app_settings.OPTIMIZER_TIME_LIMIT,
+            help='Seconds the local search may run for (default: %s).' %
+                app_settings.OPTIMIZER_TIME_LIMIT),
+        make_option('--apply', action='store_true', dest='apply',
+            default=False, help='Write the proposed assignments.'),
+    )
+
+    def handle_noargs(self, **options):
+        plan = optimizer.optimize(options['category'], options['movable'],
+                options['time_limit'])
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity > 1:
+            for pk, old, new in plan.moves:
+                self.stdout.write('job %i: line %s -> %s' % (pk, old, new))
+        self.stdout.write(unicode(plan))
+        if options['apply']:
+            self.stdout.write('Moved %i jobs.' %
+                    optimizer.apply_moves(plan.moves))
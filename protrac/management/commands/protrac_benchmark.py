@@ -0,0 +1,73 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+        teardown_test_environment
+
+from protrac import benchmark
+
+
+class Command(NoArgsCommand):
+    help = ('Generates synthetic production data in a throwaway test '
+            'database, times protrac\'s hot paths against it and reports '
+            'the results as JSON.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--scale', dest='scale', default='small',
+            choices=sorted(benchmark.SCALES.keys()),
+            help='Data volume preset: %s (default: small).' % ', '.join(
+                sorted(benchmark.SCALES.keys()))),
+        make_option('--lines', dest='lines', type='int',
+            help='Override the number of production lines.'),
+        make_option('--customers', dest='customers', type='int',
+            help='Override the number of customers.'),
+        make_option('--products', dest='products', type='int',
+            help='Override the number of products.'),
+        make_option('--jobs', dest='jobs', type='int',
+            help='Override the number of jobs.'),
+        make_option('--runs', dest='runs', type='int',
+            help='Override the number of runs.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='Random seed for the data and samples (default: 0).'),
+        make_option('--repeat', dest='repeat', type='int', default=3,
+            help='Times to run each case (default: 3).'),
+        make_option('--case', dest='cases', action='append', default=[],
+            help='Only run the named case (can be given more than once).'),
+        make_option('--output', '-o', dest='output',
+            help='Write the JSON results to this file instead of stdout.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        names = set(name for name, func in benchmark.CASES)
+        unknown = set(options['cases']) - names
+        if unknown:
+            raise CommandError('Unknown benchmark case(s): %s' %
+                    ', '.join(sorted(unknown)))
+
+        sizes = dict(benchmark.SCALES[options['scale']])
+        for key in sizes:
+            if options.get(key) is not None:
+                sizes[key] = options[key]
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=verbosity,
+                autoclobber=True)
+        try:
+            if verbosity:
+                self.stderr.write('Generating %s...' % ', '.join(
+                    '%i %s' % (sizes[k], k) for k in sorted(sizes)))
+            benchmark.generate(seed=options['seed'], **sizes)
+            results = benchmark.run(repeat=options['repeat'],
+                    names=options['cases'], seed=options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity)
+            teardown_test_environment()
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
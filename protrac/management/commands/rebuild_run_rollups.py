@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from protrac import rollup
+
+
+class Command(NoArgsCommand):
+    help = ('Rebuilds the Run totals (qty, run seconds and run count) stored '
+            'on Jobs and Products.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--verify', action='store_true', dest='verify',
+            default=False,
+            help='Only check the stored totals, and fail if any are wrong.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        if options['verify']:
+            errors = rollup.verify()
+            if verbosity > 1:
+                for model, pk, stored, actual in errors:
+                    self.stdout.write('%s %s: stored %r, actual %r' % (
+                        model.__name__, pk, stored, actual))
+            if errors:
+                raise CommandError('%i run totals are out of date, run '
+                        'rebuild_run_rollups to fix them.' % len(errors))
+            if verbosity:
+                self.stdout.write('Run totals are up to date.')
+            return
+
+        count = rollup.rebuild()
+        if verbosity:
+            self.stdout.write('Updated run totals on %i rows.' % count)
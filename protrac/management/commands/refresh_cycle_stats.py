@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+
+from protrac import stats
+
+
+class Command(NoArgsCommand):
+    help = ('Recomputes the per-unit cycle time statistics of every Product '
+            'and Job shown in the admin.')
+
+    def handle_noargs(self, **options):
+        products, jobs = stats.refresh()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('Computed cycle time statistics for %i '
+                    'products and %i jobs.' % (products, jobs))
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+
+from protrac import search
+
+
+class Command(NoArgsCommand):
+    help = ('Rebuilds the admin search index (the references and search '
+            'text) of every Job.')
+
+    def handle_noargs(self, **options):
+        count = search.reindex()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('Updated the search text of %i jobs.' % count)
@@ -0,0 +1,152 @@
+"""
+Request instrumentation for protrac's views
+
+InstrumentationMiddleware records the wall time, query count and database
+time of each request to a protrac view (the Job, Schedule and other protrac
+admin pages, plus the views in protrac.views). It flags likely N+1 patterns
+by counting queries with the same SQL shape. Records are logged to the
+'protrac.instrumentation' logger as JSON and kept in memory for the
+instrumentation admin page.
+"""
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+import app_settings
+
+logger = logging.getLogger('protrac.instrumentation')
+
+# Most recent request records, newest last
+RECENT = deque(maxlen=app_settings.INSTRUMENTATION_HISTORY)
+_lock = threading.Lock()
+
+# url names of protrac views that shouldn't instrument themselves
+IGNORED_URL_NAMES = ('protrac_instrumentation',)
+
+_string_re = re.compile(r"'(?:[^']|'')*'")
+_number_re = re.compile(r'\b\d+(?:\.\d+)?\b')
+_in_list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def sql_shape(sql):
+    """
+    Reduces an SQL statement to its shape by replacing literal values, so
+    the same query with different parameters compares equal
+    """
+    sql = _string_re.sub('?', sql)
+    sql = _number_re.sub('?', sql)
+    return _in_list_re.sub('(?)', sql)
+
+
+def repeated_queries(queries, threshold):
+    """
+    Returns [(count, shape)] for SQL shapes run at least threshold times,
+    most repeated first
+    """
+    counts = {}
+    for q in queries:
+        shape = sql_shape(q['sql'])
+        counts[shape] = counts.get(shape, 0) + 1
+    return sorted([ (n, shape) for shape, n in counts.items()
+        if n >= threshold ], reverse=True)
+
+
+def is_protrac_view(request, view_func):
+    match = getattr(request, 'resolver_match', None)
+    url_name = getattr(match, 'url_name', None) or ''
+    if url_name in IGNORED_URL_NAMES:
+        return False
+    return (url_name.startswith('protrac_')
+            or getattr(view_func, '__module__', '').startswith('protrac.'))
+
+
+def summary():
+    """
+    Returns per-view totals of the recorded requests, slowest first
+    """
+    with _lock:
+        records = list(RECENT)
+
+    views = {}
+    for r in records:
+        v = views.setdefault(r['view'], {'view': r['view'], 'requests': 0,
+            'total_ms': 0.0, 'max_ms': 0.0, 'total_queries': 0,
+            'max_queries': 0, 'total_db_ms': 0.0, 'flagged': 0})
+        v['requests'] += 1
+        v['total_ms'] += r['time_ms']
+        v['max_ms'] = max(v['max_ms'], r['time_ms'])
+        v['total_queries'] += r['queries']
+        v['max_queries'] = max(v['max_queries'], r['queries'])
+        v['total_db_ms'] += r['db_ms']
+        v['flagged'] += bool(r['repeated'])
+
+    for v in views.values():
+        v['avg_ms'] = v['total_ms'] / v['requests']
+        v['avg_queries'] = float(v['total_queries']) / v['requests']
+        v['avg_db_ms'] = v['total_db_ms'] / v['requests']
+    return sorted(views.values(), key=lambda v: v['total_ms'], reverse=True)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Records timing and queries for protrac views, when the
+    PROTRAC_INSTRUMENTATION setting is on
+    """
+
+    def __init__(self):
+        if not app_settings.INSTRUMENTATION:
+            raise MiddlewareNotUsed
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not is_protrac_view(request, view_func):
+            return None
+        match = getattr(request, 'resolver_match', None)
+        request._protrac_instrumentation = {
+            'view': getattr(match, 'url_name', None) or '%s.%s' % (
+                view_func.__module__, view_func.__name__),
+            'start': time.time(),
+            'first_query': len(connection.queries),
+            'use_debug_cursor': connection.use_debug_cursor,
+        }
+        connection.use_debug_cursor = True
+        return None
+
+    def process_response(self, request, response):
+        state = getattr(request, '_protrac_instrumentation', None)
+        if state is None:
+            return response
+
+        elapsed = time.time() - state['start']
+        queries = connection.queries[state['first_query']:]
+        connection.use_debug_cursor = state['use_debug_cursor']
+        del request._protrac_instrumentation
+
+        repeated = repeated_queries(queries,
+                app_settings.INSTRUMENTATION_REPEAT_THRESHOLD)
+        record = {
+            'timestamp': datetime.now().isoformat(),
+            'view': state['view'],
+            'path': request.path,
+            'method': request.method,
+            'status': response.status_code,
+            'time_ms': round(elapsed * 1000, 3),
+            'queries': len(queries),
+            'db_ms': round(sum(float(q['time']) for q in queries) * 1000, 3),
+            'repeated': [ {'count': n, 'sql': shape}
+                for n, shape in repeated ],
+        }
+        with _lock:
+            RECENT.append(record)
+
+        if repeated:
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
+        return response
@@ -1,8 +1,18 @@
-from datetime import timedelta
+import threading
+from contextlib import contextmanager
+from datetime import date, timedelta
 
-from django.db import models
+from django.db import (IntegrityError, connections, models, router,
+        transaction)
+from django.db.models.query import QuerySet
+from django.db.models.signals import (post_delete, post_init, post_save,
+        pre_delete)
+from django.utils import timezone
 
-from app_settings import LINE_CATEGORY_CHOICES
+from app_settings import LINE_CATEGORY_CHOICES, PRIORITY_MODE, PRIORITY_STEP
+
+# Per-thread state for Job.deferred_prioritize()
+_prioritize_state = threading.local()
 
 
 ###################
@@ -20,6 +30,193 @@ class TimestampModel(models.Model):
         abstract = True
 
 
+class RunRollupModel(models.Model):
+    """
+    Abstract Model Class for models that keep running totals of their Runs
+
+    The totals are maintained incrementally by Run.save() and the Run
+    pre_delete signal, and can be rebuilt with the rebuild_run_rollups
+    management command.
+    """
+    run_qty = models.PositiveIntegerField(default=0, editable=False)
+    run_seconds = models.FloatField(default=0, editable=False)
+    run_count = models.PositiveIntegerField(default=0, editable=False)
+
+    ROLLUP_FIELDS = ('run_qty', 'run_seconds', 'run_count')
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        # Runs update the totals in the database directly, so don't write
+        # back (possibly stale) in-memory totals when updating a row.
+        if (not self._state.adding and not kwargs.get('force_insert')
+                and kwargs.get('update_fields') is None):
+            kwargs['update_fields'] = [ f.name for f in self._meta.fields
+                    if not f.primary_key
+                    and f.name not in self.ROLLUP_FIELDS ]
+        super(RunRollupModel, self).save(*args, **kwargs)
+
+    @classmethod
+    def adjust_rollup(cls, pk, qty, seconds, count):
+        """
+        Adds the given amounts to the totals of the row with the given pk
+        """
+        cls.objects.filter(pk=pk).update(
+                run_qty=models.F('run_qty') + qty,
+                run_seconds=models.F('run_seconds') + seconds,
+                run_count=models.F('run_count') + count)
+
+    def avg_cycle_time(self):
+        if not self.run_count:
+            return None
+        else:
+            return timedelta(seconds=self.run_seconds) / self.run_qty
+
+
+class CycleTimeStatsModel(models.Model):
+    """
+    Abstract Model Class for precomputed per-unit cycle time statistics
+
+    Times are in seconds per unit. mean is total run time over total qty,
+    like avg_cycle_time(); the rest are taken over each Run's own per-unit
+    cycle time. Filled in by stats.refresh() (the refresh_cycle_stats
+    management command).
+    """
+    runs = models.PositiveIntegerField(default=0)
+    mean = models.FloatField(null=True)
+    median = models.FloatField(null=True)
+    p90 = models.FloatField(null=True, verbose_name='90th percentile')
+    stddev = models.FloatField(null=True, verbose_name='standard deviation')
+    trimmed_mean = models.FloatField(null=True)
+    mtime = models.DateTimeField(auto_now=True, verbose_name='Computed')
+
+    class Meta:
+        abstract = True
+
+    def mean_cycle_time(self):
+        if self.mean is None:
+            return None
+        return timedelta(seconds=self.mean)
+
+
+############
+# MANAGERS #
+############
+
+class JobQuerySet(QuerySet):
+    """
+    QuerySet for Jobs with the set-based helpers used by the schedule
+    """
+
+    def scheduled(self):
+        """
+        Jobs that are not void, have a production line and still have a
+        quantity remaining, all in one query
+        """
+        return self.filter(void=False).exclude(production_line=None).filter(
+                run_qty__lt=models.F('qty'))
+
+    def scheduled_status(self, jobs):
+        """
+        Returns a dict of {pk: is scheduled} for the given Jobs (or pks),
+        using one query for the whole list
+        """
+        pks = [ getattr(j, 'pk', j) for j in jobs ]
+        scheduled = set(self.scheduled().filter(pk__in=pks).values_list('pk',
+            flat=True))
+        return dict((pk, pk in scheduled) for pk in pks)
+
+    def queue_order(self):
+        """
+        Orders prioritized jobs by priority, followed by the unprioritized
+        (priority 0) jobs in the order they were entered
+        """
+        qn = connections[self.db].ops.quote_name
+        return self.extra(
+                select={'unprioritized': '%s.%s = 0' % (
+                    qn(Job._meta.db_table), qn('priority'))},
+                order_by=['unprioritized', 'priority', 'pk'])
+
+    def ahead_of(self, job):
+        """
+        The jobs that come before job in queue_order(), as a filter on
+        (priority, pk) rather than a slice, so its cost doesn't grow with
+        the job's position
+        """
+        if job.priority:
+            return self.filter(priority__gt=0).filter(
+                    models.Q(priority__lt=job.priority) |
+                    models.Q(priority=job.priority, pk__lt=job.pk))
+        return self.filter(models.Q(priority__gt=0) |
+                models.Q(priority=0, pk__lt=job.pk))
+
+    def remaining_totals(self, by='production_line', late_before=None):
+        """
+        Sums what's left to make of the jobs in this queryset, grouped by
+        'production_line' (pk) or by line 'category', using one query
+
+        Returns {key: {'jobs', 'qty', 'seconds', 'weight', 'late'}}, where
+        qty, seconds and weight are remaining amounts (overshot jobs count as
+        0) and late counts the jobs due before late_before (default today).
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        job, product, line = (qn(m._meta.db_table)
+                for m in (Job, Product, ProductionLine))
+        key = {
+            'production_line': '%s.%s' % (job, qn('production_line_id')),
+            'category': '%s.%s' % (line, qn('category')),
+        }[by]
+        remaining = 'CASE WHEN %(j)s.%(qty)s > %(j)s.%(done)s ' \
+                'THEN %(j)s.%(qty)s - %(j)s.%(done)s ELSE 0 END' % {
+                    'j': job, 'qty': qn('qty'), 'done': qn('run_qty')}
+
+        if self.query.can_filter():
+            pks, params = self.order_by().values('pk').query.sql_with_params()
+        else:
+            # a sliced queryset can't be reordered, so fetch its pks first
+            params = [ o.pk for o in self.only('pk') ]
+            pks = ', '.join(['%s'] * len(params)) or 'NULL'
+        sql = ('SELECT %(key)s, COUNT(*), SUM(%(rem)s), '
+               'SUM((%(rem)s) * %(p)s.%(cycle)s), '
+               'SUM((%(rem)s) * %(p)s.%(wt)s), '
+               'SUM(CASE WHEN %(j)s.%(due)s < %%s THEN 1 ELSE 0 END) '
+               'FROM %(j)s INNER JOIN %(p)s ON %(p)s.%(id)s = %(j)s.%(pid)s '
+               'LEFT OUTER JOIN %(l)s ON %(l)s.%(id)s = %(j)s.%(lid)s '
+               'WHERE %(j)s.%(id)s IN (%(pks)s) GROUP BY %(key)s') % {
+            'key': key, 'rem': remaining, 'j': job, 'p': product, 'l': line,
+            'id': qn('id'), 'pid': qn('product_id'),
+            'lid': qn('production_line_id'), 'cycle': qn('cycle_time'),
+            'wt': qn('material_wt'), 'due': qn('due_date'), 'pks': pks}
+
+        cursor = connection.cursor()
+        cursor.execute(sql, [late_before or date.today()] + list(params))
+        return dict((row[0], {'jobs': row[1], 'qty': row[2] or 0,
+            'seconds': row[3] or 0.0, 'weight': row[4] or 0.0,
+            'late': row[5] or 0}) for row in cursor.fetchall())
+
+
+class JobManager(models.Manager):
+    def get_query_set(self):
+        return JobQuerySet(self.model, using=self._db)
+
+    def scheduled(self):
+        return self.get_query_set().scheduled()
+
+    def scheduled_status(self, jobs):
+        return self.get_query_set().scheduled_status(jobs)
+
+    def queue_order(self):
+        return self.get_query_set().queue_order()
+
+    def ahead_of(self, job):
+        return self.get_query_set().ahead_of(job)
+
+    def remaining_totals(self, by='production_line', late_before=None):
+        return self.get_query_set().remaining_totals(by, late_before)
+
+
 ##################
 # REGULAR MODELS #
 ##################
@@ -53,7 +250,7 @@ class ProductionLine(models.Model):
         return unicode(self.name)
 
 
-class Product(TimestampModel):
+class Product(TimestampModel, RunRollupModel):
     """
     Products
     """
@@ -77,17 +274,9 @@ class Product(TimestampModel):
     def gross_wt(self, qty=1):
         return self.material_wt * qty
 
-    def avg_cycle_time(self):
-        run_set = Run.objects.filter(job__product=self)
-        if not run_set:
-            return None
-        else:
-            qty = run_set.aggregate(models.Sum('qty'))['qty__sum']
-            duration = sum([ o.duration() for o in run_set ], timedelta())
-            return duration / qty
 
 
-class Job(TimestampModel):
+class Job(TimestampModel, RunRollupModel):
     """
     Bob Loblaw Job Log
 
@@ -106,69 +295,219 @@ class Job(TimestampModel):
     suspended = models.CharField(max_length=32, blank=True, null=True,
             help_text='give reason for suspension, or blank for not suspended')
     void = models.BooleanField(default=False, db_index=True)
+    # references, part number and customer name for the admin search (see
+    # protrac.search)
+    search_text = models.TextField(default='', editable=False)
+
+    # the fields search_text is made from
+    SEARCH_FIELDS = ('refs', 'product', 'customer')
+
+    objects = JobManager()
 
     class Meta:
-        pass
+        # one line's open jobs in priority order, for the schedule (see also
+        # sql/job.<backend>.sql)
+        index_together = [('production_line', 'void', 'priority')]
 
     def __unicode__(self):
         return unicode(self.id).zfill(3)
 
     def save(self, *args, **kwargs):
+        import search
+        adding = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        index = update_fields is None or set(update_fields) & set(
+                self.SEARCH_FIELDS)
+        if index:
+            search.index_job(self)
+            if update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + [
+                        'search_text']
         super(Job, self).save(*args, **kwargs) # Call the "real" save()
-        self.prioritize() # space priority values evenly again
+        loaded_product_id = getattr(self, '_loaded_product_id', None)
+        if (not adding and loaded_product_id is not None
+                and loaded_product_id != self.product_id and (update_fields
+                    is None or 'product' in update_fields)):
+            move_rollups(self.pk, loaded_product_id, self.product_id)
+        self._loaded_product_id = self.product_id
+        if index and (adding or
+                self.refs != getattr(self, '_loaded_refs', None)):
+            search.write_refs({self.pk: self.refs}, new=adding)
+            self._loaded_refs = self.refs
+        if PRIORITY_MODE == 'gap':
+            self.make_room() # only shift the jobs crowding this one
+        elif getattr(_prioritize_state, 'depth', 0):
+            _prioritize_state.pending = True
+        else:
+            self.prioritize() # space priority values evenly again
 
     @classmethod
+    @transaction.commit_on_success
     def prioritize(cls):
         """
-        Re-assigns priority values to be 10 apart for easy ordering by hand
+        Re-assigns priority values to be PRIORITY_STEP (10) apart for easy
+        ordering by hand
+
+        Only the jobs whose priority actually changes are written, with a
+        single UPDATE per batch (see set_priorities).
+        """
+        jobs = cls.objects.filter(priority__gt=0).order_by('priority', 'pk')
+        changes = {}
+        for i, (pk, priority) in enumerate(jobs.values_list('pk',
+                'priority')):
+            if priority != (i + 1) * PRIORITY_STEP:
+                changes[pk] = (i + 1) * PRIORITY_STEP
+        cls.set_priorities(changes)
+
+    def make_room(self):
+        """
+        Keeps this job's priority and bumps the other jobs at or just above
+        it up by one, stopping at the first free key. When there's a gap at
+        this job's priority nothing else is written.
+        """
+        Job._make_room(self.pk, self.priority)
+
+    @classmethod
+    def prioritize_added(cls, jobs):
+        """
+        Brings priorities up to date for Jobs written without save() (eg.
+        with bulk_create), the way save() would: making room for each of
+        them in 'gap' PRIORITY_MODE, otherwise renumbering every job once
+        """
+        if PRIORITY_MODE != 'gap':
+            cls.prioritize()
+            return
+        # in queue order, each one keeping the priority it has by its turn
+        for pk in list(jobs.filter(priority__gt=0).order_by('priority', 'pk')
+                .values_list('pk', flat=True)):
+            priority = cls.objects.filter(pk=pk).values_list('priority',
+                    flat=True)[0]
+            cls._make_room(pk, priority)
+
+    @classmethod
+    @transaction.commit_on_success
+    def _make_room(cls, pk, priority):
+        if not priority:
+            return
+        others = cls.objects.exclude(pk=pk).filter(
+                priority__gte=priority).order_by('priority', 'pk')
+        changes = {}
+        floor = priority
+        for other, value in others.values_list('pk', 'priority').iterator():
+            if value > floor:
+                break
+            floor += 1
+            changes[other] = floor
+        cls.set_priorities(changes)
+
+    @classmethod
+    @contextmanager
+    def deferred_prioritize(cls):
+        """
+        Context manager that holds off prioritize() for Jobs saved inside it,
+        and runs it once on the way out if any were saved. Use it when saving
+        many jobs at once (eg. the admin changelist). In 'gap' PRIORITY_MODE
+        jobs make room as they're saved, so there's nothing to defer.
+        """
+        depth = getattr(_prioritize_state, 'depth', 0)
+        if not depth:
+            _prioritize_state.pending = False
+        _prioritize_state.depth = depth + 1
+        try:
+            yield
+        finally:
+            _prioritize_state.depth = depth
+        if not depth and _prioritize_state.pending:
+            cls.prioritize()
+
+    @classmethod
+    def _case_update(cls, field, values, batch_size):
+        # writes {pk: value} to one field with one CASE UPDATE per batch
+        connection = connections[router.db_for_write(cls)]
+        qn = connection.ops.quote_name
+        items = values.items()
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            params = []
+            for pk, value in batch:
+                params.extend((pk, value))
+            params.extend(pk for pk, value in batch)
+            sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                qn(cls._meta.db_table),
+                qn(cls._meta.get_field(field).column),
+                qn(cls._meta.pk.column),
+                ' '.join(['WHEN %s THEN %s'] * len(batch)),
+                qn(cls._meta.pk.column),
+                ', '.join(['%s'] * len(batch)))
+            connection.cursor().execute(sql, params)
+        if items:
+            transaction.commit_unless_managed(using=connection.alias)
+
+    @classmethod
+    def set_priorities(cls, priorities, batch_size=300):
+        """
+        Writes a dict of {job pk: priority} using one CASE UPDATE per batch,
+        without calling save() on each job
         """
-        for i, o in enumerate(
-                cls.objects.filter(priority__gt=0).order_by('priority')):
-            o.priority = (i + 1) * 10
-            super(Job, o).save() # Call the "real" save()
+        cls._case_update('priority', priorities, batch_size)
+        if priorities:
+            _update_priorities(priorities)
+            _publish_priorities(priorities)
+
+    @classmethod
+    def set_lines(cls, lines, batch_size=300):
+        """
+        Writes a dict of {job pk: production line pk} the same way as
+        set_priorities, and drops every cached timeline
+        """
+        cls._case_update('production_line', lines, batch_size)
+        if lines:
+            # and the live boards reload
+            _invalidate_timelines(None)
 
     def is_scheduled(self):
-        return self.id in [ s.id for s in Schedule.objects.all() ]
-        # Here's the original method, the new one is slower but less
-        # complicated.
-        #if (self.production_line is not None
-        #    and self.qty_remaining() > 0
-        #    and self.void is not True):
-        #    return True
-        #else:
-        #    return False
+        """
+        Checks the schedule conditions for just this job's row (a primary
+        key lookup). Use Job.objects.scheduled_status() for many jobs.
+        """
+        return Job.objects.scheduled().filter(pk=self.pk).exists()
 
     def qty_done(self):
-        qty = self.run_set.aggregate(models.Sum('qty'))['qty__sum']
-        if qty is None:
-            return 0
-        else:
-            return int(qty)
+        return self.run_qty
 
     def qty_remaining(self):
         return self.qty - self.qty_done()
 
+    def cached_product(self):
+        """
+        The Job's Product, from the reference cache unless already loaded
+        """
+        import refcache
+        return refcache.related(self, 'product')
+
     def weight(self):
-        return self.product.gross_wt(self.qty)
+        return self.cached_product().gross_wt(self.qty)
 
     def weight_remaining(self):
-        return self.product.gross_wt(self.qty_remaining())
+        return self.cached_product().gross_wt(self.qty_remaining())
 
     def duration(self):
-        return self.product.duration(self.qty)
+        return self.cached_product().duration(self.qty)
 
     def duration_remaining(self):
-        return self.product.duration(self.qty_remaining())
+        return self.cached_product().duration(self.qty_remaining())
 
-    def avg_cycle_time(self):
-        run_set = self.run_set.all()
-        if not run_set:
-            return None
-        else:
-            qty = run_set.aggregate(models.Sum('qty'))['qty__sum']
-            duration = sum([ t.duration() for t in run_set.all() ],
-                    timedelta())
-            return duration / qty
+
+class JobRef(models.Model):
+    """
+    One of a Job's references (normalized, see protrac.search), for looking
+    up a PO or WO number with an index
+    """
+    job = models.ForeignKey('Job', related_name='ref_set')
+    ref = models.CharField(max_length=128, db_index=True)
+
+    def __unicode__(self):
+        return self.ref
 
 
 class Run(TimestampModel):
@@ -184,11 +523,45 @@ class Run(TimestampModel):
     operator = models.CharField(max_length=32)
 
     class Meta:
-        pass
+        # a job's run history in order, and the run changelist's pages
+        index_together = [('job', 'start'), ('start', 'id')]
 
     def __unicode__(self):
         return unicode(self.id).zfill(3)
 
+    @transaction.commit_on_success
+    def save(self, *args, **kwargs):
+        previous = None
+        if self.pk is not None:
+            previous = Run.objects.filter(pk=self.pk).values_list(
+                    'job', 'job__product', 'qty', 'start', 'end', 'operator',
+                    'job__production_line', 'job__product__material_wt')
+            previous = previous[0] if previous else None
+        super(Run, self).save(*args, **kwargs) # Call the "real" save()
+        self._previous_job_id = previous[0] if previous else None
+        if previous is not None:
+            (job_id, product_id, qty, start, end, operator, line_id,
+                    material_wt) = previous
+            seconds = (end - start).total_seconds()
+            update_rollups(job_id, product_id, -qty, -seconds, -1)
+            DailyProduction.adjust(production_day(start), line_id,
+                    product_id, operator, -qty, -seconds, -qty * material_wt,
+                    -1)
+        seconds = self.duration().total_seconds()
+        weight = self.job.cached_product().gross_wt(self.qty)
+        update_rollups(self.job_id, self.job.product_id, self.qty, seconds, 1,
+                job=self.job)
+        DailyProduction.adjust(production_day(self.start),
+                self.job.production_line_id, self.job.product_id,
+                self.operator, self.qty, seconds, weight, 1)
+        # once the job totals have been updated
+        _update_timelines([self.job.production_line_id,
+            previous and previous[6]], [self.job_id, self._previous_job_id],
+            observed=False)
+        _publish_jobs([self.job])
+        if previous is not None and previous[0] != self.job_id:
+            _publish_refetch([previous[0]])
+
     def weight(self):
         return self.job.product.gross_wt(self.qty)
 
@@ -199,18 +572,118 @@ class Run(TimestampModel):
         return self.duration() / self.qty
 
 
+def production_day(start):
+    """
+    The day a Run counts towards: the (local) date it started
+    """
+    if timezone.is_aware(start):
+        start = timezone.localtime(start)
+    return start.date()
+
+
+class DailyProduction(models.Model):
+    """
+    Daily Production History
+
+    Run totals per day, production line, product and operator, for reports
+    that would otherwise read every Run. Kept up to date by Run.save() and
+    the Run pre_delete signal (runs count towards the line their job is on
+    when they're saved), and rebuilt with the backfill_daily_production
+    management command (which uses each job's current line).
+
+    Runs of jobs without a line have no production_line. Since databases
+    don't enforce uniqueness over NULLs, rows are unique by line_key (the
+    line's pk, or 0) instead, and a deleted line's rows are merged into
+    those without a line.
+    """
+    day = models.DateField()
+    production_line = models.ForeignKey('ProductionLine', blank=True,
+            null=True, on_delete=models.SET_NULL)
+    line_key = models.PositiveIntegerField(default=0, editable=False)
+    product = models.ForeignKey('Product')
+    operator = models.CharField(max_length=32)
+    qty = models.IntegerField(default=0)
+    seconds = models.FloatField(default=0)
+    weight = models.FloatField(default=0)
+    runs = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['-day']
+        unique_together = [('day', 'line_key', 'product', 'operator')]
+        verbose_name_plural = 'daily production'
+
+    def __unicode__(self):
+        return u'%s %s' % (self.day, self.product_id)
+
+    @classmethod
+    def adjust(cls, day, line_id, product_id, operator, qty, seconds, weight,
+            runs):
+        """
+        Adds the given amounts to the row for day, line, product and
+        operator, creating it when there isn't one yet. Rows left without
+        runs are removed.
+        """
+        rows = cls.objects.filter(day=day, line_key=line_id or 0,
+                product=product_id, operator=operator)
+        totals = dict(qty=models.F('qty') + qty,
+                seconds=models.F('seconds') + seconds,
+                weight=models.F('weight') + weight,
+                runs=models.F('runs') + runs)
+        updated = rows.update(**totals)
+        if not updated and runs > 0:
+            # another writer may create the row first, as in get_or_create
+            sid = transaction.savepoint(using=rows.db)
+            try:
+                cls.objects.create(day=day, production_line_id=line_id,
+                        line_key=line_id or 0, product_id=product_id,
+                        operator=operator, qty=qty, seconds=seconds,
+                        weight=weight, runs=runs)
+                transaction.savepoint_commit(sid, using=rows.db)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=rows.db)
+                rows.update(**totals)
+        elif runs < 0:
+            rows.filter(runs__lte=0).delete()
+
+    @classmethod
+    def merge_line(cls, line_id):
+        """
+        Moves a production line's rows to those without a line
+        """
+        rows = cls.objects.filter(line_key=line_id)
+        for (day, product_id, operator, qty, seconds, weight,
+                runs) in rows.values_list('day', 'product', 'operator',
+                        'qty', 'seconds', 'weight', 'runs'):
+            cls.adjust(day, None, product_id, operator, qty, seconds,
+                    weight, runs)
+        rows.delete()
+
+
+class ProductCycleTimeStats(CycleTimeStatsModel):
+    product = models.OneToOneField('Product', primary_key=True,
+            related_name='cycle_time_stats')
+
+    class Meta:
+        verbose_name_plural = 'product cycle time stats'
+
+
+class JobCycleTimeStats(CycleTimeStatsModel):
+    job = models.OneToOneField('Job', primary_key=True,
+            related_name='cycle_time_stats')
+
+    class Meta:
+        verbose_name_plural = 'job cycle time stats'
+
+
 ################
 # PROXY MODELS #
 ################
 
-class ScheduleManager(models.Manager):
+class ScheduleManager(JobManager):
     def get_query_set(self):
-        # use the database to filter on void and production_line, but check
-        # each for qty_remaining.
-        return Job.objects.filter(id__in=(
-            x.id for x in Job.objects.filter(void=False).filter(
-                production_line__isnull=False)
-            if x.qty_remaining() > 0))
+        # void, production_line and qty_remaining are all checked by the
+        # database in a single annotated query.
+        return super(ScheduleManager, self).get_query_set().scheduled()
 
 class Schedule(Job):
     """
@@ -219,7 +692,7 @@ class Schedule(Job):
     Filters Jobs to show only "scheduled jobs". I.E. those that are not void,
     have an assigned production line, and have a quantity remaining to be
     produced (duh). This is accomplished with the ScheduleManager model
-    manager above.
+    manager above, which uses JobQuerySet.scheduled().
     """
 
     objects = ScheduleManager()
@@ -228,3 +701,221 @@ class Schedule(Job):
         proxy = True
         verbose_name = 'Scheduled Job'
         verbose_name_plural = 'Job Schedule'
+
+
+###########
+# ROLLUPS #
+###########
+
+def _cached_related(obj, field_name):
+    """
+    Returns the related object for field_name if it's already been fetched
+    """
+    cache_name = obj._meta.get_field(field_name).get_cache_name()
+    return getattr(obj, cache_name, None)
+
+
+def update_rollups(job_id, product_id, qty, seconds, count, job=None):
+    """
+    Adjusts the Run totals of a Job and its Product
+
+    If the Job instance that the Run was saved with is given, it (and its
+    Product, if already fetched) gets the same adjustment in memory.
+    """
+    Job.adjust_rollup(job_id, qty, seconds, count)
+    Product.adjust_rollup(product_id, qty, seconds, count)
+    _invalidate_refcache(Product, [product_id])
+
+    if job is not None:
+        objs = [job, _cached_related(job, 'product')]
+        for obj in [ o for o in objs if o is not None ]:
+            obj.run_qty += qty
+            obj.run_seconds += seconds
+            obj.run_count += count
+
+
+@transaction.commit_on_success
+def move_rollups(job_id, old_product_id, new_product_id):
+    """
+    Moves a Job's Run totals from the Product it was on to its new one
+    """
+    totals = Job.objects.filter(pk=job_id).values_list(
+            *Job.ROLLUP_FIELDS)
+    if not totals or not totals[0][2]:
+        return
+    qty, seconds, count = totals[0]
+    Product.adjust_rollup(old_product_id, -qty, -seconds, -count)
+    Product.adjust_rollup(new_product_id, qty, seconds, count)
+    _invalidate_refcache(Product, [old_product_id, new_product_id])
+
+
+def run_pre_delete(sender, instance, **kwargs):
+    # before anything is deleted, since a Job (or its line) being deleted
+    # deletes its Runs after the Job
+    job = Job.objects.filter(pk=instance.job_id).values_list('product',
+            'production_line', 'product__material_wt')
+    if job:
+        product_id, line_id, material_wt = job[0]
+        seconds = instance.duration().total_seconds()
+        update_rollups(instance.job_id, product_id, -instance.qty, -seconds,
+                -1)
+        DailyProduction.adjust(production_day(instance.start), line_id,
+                product_id, instance.operator, -instance.qty, -seconds,
+                -instance.qty * material_wt, -1)
+
+
+def run_post_delete(sender, instance, **kwargs):
+    _publish_refetch([instance.job_id])
+pre_delete.connect(run_pre_delete, sender=Run)
+post_delete.connect(run_post_delete, sender=Run)
+
+
+##################
+# TIMELINE CACHE #
+##################
+
+def _invalidate_timelines(line_ids):
+    # the given lines, or every line when line_ids is None
+    import timeline
+    if line_ids is None:
+        timeline.invalidate_lines()
+    else:
+        timeline.invalidate_lines(set(pk for pk in line_ids if pk is not None))
+
+
+def job_post_init(sender, instance, **kwargs):
+    # remember what the job was loaded with: its line, so moving it
+    # invalidates both, its references (unless deferred), so only changes
+    # are reindexed, and its product, whose Run totals follow it
+    instance._loaded_line_id = instance.production_line_id
+    instance._loaded_refs = instance.__dict__.get('refs')
+    instance._loaded_product_id = instance.__dict__.get('product_id')
+
+
+def _update_timelines(line_ids, job_ids, observed=True):
+    import timeline
+    timeline.update_lines([ pk for pk in line_ids if pk is not None ],
+            [ pk for pk in job_ids if pk is not None ], observed)
+
+
+def _update_priorities(priorities):
+    import timeline
+    timeline.update_priorities(priorities)
+
+
+def job_changed(sender, instance, signal, **kwargs):
+    # a job deleted or moved to another product takes its runs with it,
+    # which changes the observed cycle times of the other jobs
+    moved = signal is post_delete or instance.product_id != getattr(
+            instance, '_loaded_product_id', instance.product_id)
+    _update_timelines([instance.production_line_id,
+        getattr(instance, '_loaded_line_id', None)], [instance.pk],
+        observed=not moved)
+    instance._previous_line_id = getattr(instance, '_loaded_line_id', None)
+    instance._loaded_line_id = instance.production_line_id
+
+
+def run_deleted(sender, instance, **kwargs):
+    # Run.save() updates the timelines itself, after the job totals
+    _update_timelines(Job.objects.filter(pk=instance.job_id).values_list(
+        'production_line', flat=True), [instance.job_id], observed=False)
+
+
+def product_post_save(sender, instance, **kwargs):
+    _invalidate_timelines(Job.objects.scheduled().filter(product=instance)
+            .values_list('production_line', flat=True).distinct())
+
+
+def line_post_delete(sender, instance, **kwargs):
+    # after the runs of its jobs have been subtracted, so only the rows of
+    # runs whose jobs have since moved off the line are left
+    DailyProduction.merge_line(instance.pk)
+
+
+for model in (Job, Schedule):
+    post_init.connect(job_post_init, sender=model)
+    post_save.connect(job_changed, sender=model)
+    post_delete.connect(job_changed, sender=model)
+post_delete.connect(run_deleted, sender=Run)
+post_save.connect(product_post_save, sender=Product)
+post_delete.connect(line_post_delete, sender=ProductionLine)
+
+
+################
+# SEARCH INDEX #
+################
+
+# The field of each model that's in its jobs' search_text, and the job field
+# pointing at it
+SEARCH_NAMES = {
+    Product: ('part_number', 'product'),
+    Customer: ('name', 'customer'),
+}
+
+
+def name_post_init(sender, instance, **kwargs):
+    # remember the part number or name, so only renaming reindexes the jobs
+    instance._loaded_name = instance.__dict__.get(SEARCH_NAMES[sender][0])
+
+
+def name_post_save(sender, instance, created, **kwargs):
+    field, job_field = SEARCH_NAMES[sender]
+    name = getattr(instance, field)
+    if not created and name != getattr(instance, '_loaded_name', None):
+        import search
+        search.reindex(Job.objects.filter(**{job_field: instance}),
+                refs=False)
+    instance._loaded_name = name
+
+
+for model in SEARCH_NAMES:
+    post_init.connect(name_post_init, sender=model)
+    post_save.connect(name_post_save, sender=model)
+
+
+##############
+# LIVE BOARD #
+##############
+
+def _publish_jobs(jobs):
+    import board
+    board.publish_jobs(jobs)
+
+
+def _publish_refetch(job_ids):
+    import board
+    board.publish_refetch(job_ids)
+
+
+def _publish_priorities(priorities):
+    import board
+    board.publish_priorities(priorities)
+
+
+def job_saved(sender, instance, **kwargs):
+    _publish_jobs([instance])
+
+
+def job_deleted(sender, instance, **kwargs):
+    _publish_refetch([instance.pk])
+
+
+for model in (Job, Schedule):
+    post_save.connect(job_saved, sender=model)
+    post_delete.connect(job_deleted, sender=model)
+
+
+###################
+# REFERENCE CACHE #
+###################
+
+def _invalidate_refcache(model, pks=None):
+    import refcache
+    refcache.invalidate(model, pks)
+
+
+def reference_changed(sender, instance, **kwargs):
+    _invalidate_refcache(sender, [instance.pk])
+for model in (ProductionLine, Customer, Product):
+    post_save.connect(reference_changed, sender=model)
+    post_delete.connect(reference_changed, sender=model)
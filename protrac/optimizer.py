@@ -0,0 +1,339 @@
+"""
+Job to production line assignment
+
+optimize() proposes a production line for every open job that's unassigned
+(and, with movable=True, for assigned jobs that haven't started), to keep
+jobs from finishing after their due date and to even out the load between
+lines. A job may only go on a line of the category it's already on, or of
+the categories its product has been made on before; a job with neither can
+go on any line.
+
+Each line works through its queue in order (see JobQuerySet.queue_order)
+starting now, taking (qty remaining x product cycle time) per job. The
+heuristic has two steps:
+
+    greedy        jobs in queue order each go to the eligible line that
+                  would finish them soonest
+    local search  a job is moved from one line to another whenever that
+                  lowers the total lateness, or leaves it the same and
+                  evens out the load, until no move helps or time runs out
+
+The data is read with three queries, and the result is a Plan that can be
+previewed and then applied with Job.set_lines.
+"""
+import heapq
+import time
+from bisect import insort
+from datetime import datetime, time as dtime
+
+from django.db.models import F
+
+import app_settings
+from models import Job, ProductionLine
+
+# Latest-finishing jobs of a line, and least loaded lines, tried per move
+CANDIDATES = 10
+TARGETS = 5
+
+# Tardiness (seconds) differences smaller than this are no difference
+EPSILON = 1e-6
+
+# Jobs whose current line apply_moves() reads per query (SQLite allows 999
+# parameters per statement)
+BATCH_SIZE = 900
+
+
+class _Job(object):
+    __slots__ = ('pk', 'line', 'seconds', 'due', 'key', 'movable',
+            'categories')
+
+    def __init__(self, pk, line, seconds, due, priority, movable,
+            categories):
+        self.pk = pk
+        self.line = line # planned line pk, None when unassigned
+        self.seconds = seconds
+        self.due = due # seconds from now, or None
+        self.key = (priority == 0, priority, pk) # queue order
+        self.movable = movable
+        self.categories = categories # eligible categories, None for any
+
+
+class _Line(object):
+    __slots__ = ('pk', 'category', 'queue', 'load', 'tardiness')
+
+    def __init__(self, pk, category):
+        self.pk = pk
+        self.category = category
+        self.queue = [] # [(key, job)] in queue order
+        self.load = 0.0
+        self.tardiness = 0.0
+
+    def add(self, job):
+        insort(self.queue, (job.key, job))
+        self.load += job.seconds
+
+    def remove(self, job):
+        self.queue.remove((job.key, job))
+        self.load -= job.seconds
+
+    def sequence(self, add=None, remove=None):
+        """
+        Yields (job, finish) through the queue, optionally with one job added
+        or removed
+        """
+        finish = 0.0
+        queue = self.queue
+        if add is not None:
+            queue = list(queue)
+            insort(queue, (add.key, add))
+        for key, job in queue:
+            if job is remove:
+                continue
+            finish += job.seconds
+            yield job, finish
+
+    def evaluate(self, add=None, remove=None):
+        """
+        Returns the total lateness in seconds, optionally with one job added
+        or removed
+        """
+        return sum(finish - job.due for job, finish in
+                self.sequence(add, remove)
+                if job.due is not None and finish > job.due)
+
+
+class Plan(object):
+    """
+    Proposed line for each planned job: moves is a list of (job pk, current
+    line pk or None, proposed line pk). before and after are {line pk:
+    {'jobs', 'hours', 'late', 'late_hours'}}, with the unassigned jobs under
+    None.
+    """
+
+    def __init__(self, moves, before, after, elapsed):
+        self.moves = moves
+        self.before = before
+        self.after = after
+        self.elapsed = elapsed
+
+    def __unicode__(self):
+        late = lambda summary: sum(s['late'] for s in summary.values())
+        return u'%i jobs to move, late jobs %i -> %i (%.1fs)' % (
+                len(self.moves), late(self.before), late(self.after),
+                self.elapsed)
+
+    def changes(self):
+        return dict((pk, line) for pk, current, line in self.moves)
+
+
+def _summary(lines, unassigned):
+    summary = {}
+    for line in lines.values():
+        late = [ finish - job.due for job, finish in line.sequence()
+            if job.due is not None and finish > job.due ]
+        summary[line.pk] = {'jobs': len(line.queue),
+            'hours': line.load / 3600.0, 'late': len(late),
+            'late_hours': sum(late) / 3600.0}
+    summary[None] = {'jobs': len(unassigned),
+        'hours': sum(job.seconds for job in unassigned) / 3600.0,
+        'late': 0, 'late_hours': 0.0}
+    return summary
+
+
+#########
+# SETUP #
+#########
+
+def _load(category, movable, now):
+    """
+    Returns ({line pk: _Line}, [_Job]) for the open jobs and the lines they
+    may use
+    """
+    lines = dict((pk, _Line(pk, cat)) for pk, cat in
+            ProductionLine.objects.values_list('pk', 'category'))
+
+    history = {}
+    for product, cat in Job.objects.exclude(production_line=None).values_list(
+            'product', 'production_line__category').distinct().iterator():
+        history.setdefault(product, set()).add(cat)
+
+    midnight = datetime.combine(now.date(), dtime(0))
+    jobs = []
+    rows = Job.objects.filter(void=False, run_qty__lt=F('qty')).values_list(
+            'pk', 'production_line', 'product', 'qty', 'run_qty', 'due_date',
+            'priority', 'product__cycle_time')
+    for (pk, line, product, qty, done, due_date, priority,
+            cycle_time) in rows.iterator():
+        if line is not None:
+            categories = set([lines[line].category])
+        else:
+            categories = history.get(product)
+        if due_date is not None:
+            # the end of the due date
+            due_date = (midnight - now).total_seconds() + (due_date -
+                    now.date()).days * 86400 + 86400
+        jobs.append(_Job(pk, line, (qty - done) * cycle_time, due_date,
+            priority, line is None or (movable and not done),
+            frozenset(categories) if categories is not None else None))
+
+    if category is not None:
+        for job in jobs:
+            if job.categories is not None and category not in job.categories:
+                job.movable = False
+    return lines, jobs
+
+
+def _eligible(lines, category):
+    """
+    Returns a function giving the lines a job may go on, grouped so jobs
+    with the same categories share the list
+    """
+    groups = {}
+
+    def eligible(job):
+        if job.categories not in groups:
+            groups[job.categories] = [ line for line in lines.values()
+                if (job.categories is None or line.category in job.categories)
+                and (category is None or line.category == category) ]
+        return groups[job.categories]
+    return eligible
+
+
+##########
+# GREEDY #
+##########
+
+def _greedy(jobs, eligible):
+    # one heap of (load, pk, line) per group of eligible lines; entries go
+    # stale when a line's load changes and are skipped
+    heaps = {}
+    for job in sorted(jobs, key=lambda job: job.key):
+        candidates = eligible(job)
+        if not candidates:
+            continue
+        heap = heaps.get(job.categories)
+        if heap is None:
+            heap = heaps[job.categories] = [ (line.load, line.pk, line)
+                    for line in candidates ]
+            heapq.heapify(heap)
+        while True:
+            load, pk, line = heap[0]
+            if load == line.load:
+                break
+            heapq.heapreplace(heap, (line.load, pk, line))
+        line.add(job)
+        job.line = line.pk
+        heapq.heapreplace(heap, (line.load, pk, line))
+
+
+################
+# LOCAL SEARCH #
+################
+
+def _improve(line, eligible):
+    """
+    Moves one job off line if that helps. Returns the line it went to, or
+    None.
+    """
+    finishes = dict((job.pk, finish) for job, finish in line.sequence())
+    candidates = sorted((job for key, job in line.queue if job.movable),
+            key=lambda job: finishes[job.pk], reverse=True)[:CANDIDATES]
+    for job in candidates:
+        without = line.evaluate(remove=job)
+        targets = heapq.nsmallest(TARGETS, (target for target in
+            eligible(job) if target is not line),
+            key=lambda target: target.load)
+        for target in targets:
+            with_job = target.evaluate(add=job)
+            change = (without + with_job) - (line.tardiness +
+                    target.tardiness)
+            if change < -EPSILON or (abs(change) <= EPSILON and
+                    target.load + job.seconds < line.load):
+                line.remove(job)
+                target.add(job)
+                job.line = target.pk
+                line.tardiness, target.tardiness = without, with_job
+                return target
+    return None
+
+
+def _local_search(lines, eligible, deadline):
+    for line in lines.values():
+        line.tardiness = line.evaluate()
+    stuck = set()
+    moved = False
+    while time.time() < deadline:
+        order = sorted((line for line in lines.values()
+            if line.pk not in stuck and line.queue),
+            key=lambda line: (line.tardiness, line.load), reverse=True)
+        if not order:
+            if not moved:
+                return
+            # moves since the last full pass may have opened up others
+            stuck.clear()
+            moved = False
+            continue
+        for line in order:
+            if time.time() >= deadline:
+                return
+            target = _improve(line, eligible)
+            if target is None:
+                stuck.add(line.pk)
+            else:
+                stuck.discard(target.pk)
+                moved = True
+                break
+
+
+############
+# OPTIMIZE #
+############
+
+def optimize(category=None, movable=False, time_limit=None, now=None):
+    """
+    Returns a Plan for the unassigned jobs, and with movable for the
+    assigned jobs that haven't started, optionally only using (and only
+    planning jobs for) the lines of one category
+    """
+    started = time.time()
+    now = now or datetime.now()
+    lines, jobs = _load(category, movable, now)
+    eligible = _eligible(lines, category)
+
+    original = dict((job.pk, job.line) for job in jobs)
+    for job in jobs:
+        if job.line is not None:
+            lines[job.line].add(job)
+    before = _summary(lines, [ job for job in jobs if job.line is None ])
+
+    planned = [ job for job in jobs if job.movable and eligible(job) ]
+    for job in planned:
+        if job.line is not None:
+            lines[job.line].remove(job)
+            job.line = None
+    _greedy(planned, eligible)
+    if time_limit is None:
+        time_limit = app_settings.OPTIMIZER_TIME_LIMIT
+    _local_search(lines, eligible, started + time_limit)
+
+    after = _summary(lines, [ job for job in jobs if job.line is None ])
+    moves = sorted((job.pk, original[job.pk], job.line) for job in planned
+            if job.line != original[job.pk])
+    return Plan(moves, before, after, time.time() - started)
+
+
+def apply_moves(moves):
+    """
+    Writes the moves of a Plan (skipping jobs that have been moved since it
+    was made) with a query per BATCH_SIZE moves to read the jobs' lines and
+    a bulk update. Returns the number of jobs moved.
+    """
+    pks = [ pk for pk, old, new in moves ]
+    current = {}
+    for i in range(0, len(pks), BATCH_SIZE):
+        current.update(Job.objects.filter(pk__in=pks[i:i + BATCH_SIZE])
+                .values_list('pk', 'production_line'))
+    changes = dict((pk, new) for pk, old, new in moves
+            if pk in current and current[pk] == old)
+    Job.set_lines(changes)
+    return len(changes)
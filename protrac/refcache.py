@@ -0,0 +1,223 @@
+"""
+In-process cache of the reference tables: ProductionLine, Customer and
+Product
+
+These are small and rarely change, but nearly every Job row needs them.
+Each model gets a size-bounded, least recently used RefCache of its rows by
+pk (and by its unique name or part number). Entries expire after
+PROTRAC_REFCACHE_TIMEOUT seconds, and saving or deleting a row (or changing
+a Product's Run totals) drops it from this process's cache straight away.
+Other processes only see the change once their entry expires.
+
+Callers get their own copy of each cached object, so changing it doesn't
+affect the cache.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import app_settings
+from models import Customer, Product, ProductionLine
+
+# Cached models and the unique field each can also be looked up by
+KEY_FIELDS = {
+    ProductionLine: 'name',
+    Customer: 'name',
+    Product: 'part_number',
+}
+
+
+class RefCache(object):
+    """
+    Least recently used, expiring cache of one model's rows
+    """
+
+    def __init__(self, model, key_field=None, max_size=None, timeout=None):
+        self.model = model
+        self.key_field = key_field
+        self.max_size = max_size or app_settings.REFCACHE_SIZE
+        self.timeout = timeout or app_settings.REFCACHE_TIMEOUT
+        self.hits = self.misses = 0
+        self._entries = OrderedDict() # pk -> (expires, obj)
+        self._keys = {} # key field value -> pk
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _take(self, pk, now):
+        # the cached object for pk, or None; the lock must be held
+        entry = self._entries.pop(pk, None)
+        if entry is None:
+            return None
+        if entry[0] < now:
+            self._forget(pk, entry[1])
+            return None
+        self._entries[pk] = entry # most recently used
+        return entry[1]
+
+    def _forget(self, pk, obj):
+        if self.key_field is not None:
+            self._keys.pop(getattr(obj, self.key_field), None)
+
+    def _put(self, obj, now):
+        with self._lock:
+            old = self._entries.pop(obj.pk, None)
+            if old is not None:
+                self._forget(obj.pk, old[1])
+            self._entries[obj.pk] = (now + self.timeout, obj)
+            if self.key_field is not None:
+                self._keys[getattr(obj, self.key_field)] = obj.pk
+            while len(self._entries) > self.max_size:
+                pk, (expires, evicted) = self._entries.popitem(last=False)
+                self._forget(pk, evicted)
+
+    def get_many(self, pks):
+        """
+        Returns {pk: obj} for the given pks that exist, fetching the ones
+        not cached in a single query
+        """
+        now = time.time()
+        found, missing = {}, set()
+        with self._lock:
+            for pk in set(pks):
+                if pk is None:
+                    continue
+                obj = self._take(pk, now)
+                if obj is None:
+                    missing.add(pk)
+                else:
+                    found[pk] = obj
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            for obj in self.model._default_manager.filter(pk__in=missing):
+                self._put(obj, now)
+                found[obj.pk] = obj
+        return dict((pk, copy.copy(obj)) for pk, obj in found.items())
+
+    def get(self, pk):
+        try:
+            return self.get_many([pk])[pk]
+        except KeyError:
+            raise self.model.DoesNotExist('%s %r does not exist' % (
+                self.model._meta.object_name, pk))
+
+    def get_by_key(self, values):
+        """
+        Returns {value: obj} for the rows whose key field (eg. part number)
+        is one of values, fetching the ones not cached in a single query
+        """
+        now = time.time()
+        found, missing = {}, set()
+        with self._lock:
+            for value in set(values):
+                if value is None:
+                    continue
+                pk = self._keys.get(value)
+                obj = self._take(pk, now) if pk is not None else None
+                if obj is None:
+                    missing.add(value)
+                else:
+                    found[value] = obj
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            for obj in self.model._default_manager.filter(**{
+                    '%s__in' % self.key_field: missing}):
+                self._put(obj, now)
+                found[getattr(obj, self.key_field)] = obj
+        return dict((value, copy.copy(obj)) for value, obj in found.items())
+
+    def invalidate(self, pks=None):
+        """
+        Drops the given pks, or everything
+        """
+        with self._lock:
+            if pks is None:
+                self._entries.clear()
+                self._keys.clear()
+                return
+            for pk in pks:
+                entry = self._entries.pop(pk, None)
+                if entry is not None:
+                    self._forget(pk, entry[1])
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self),
+                'max_size': self.max_size}
+
+
+_caches = dict((model, RefCache(model, key_field))
+        for model, key_field in KEY_FIELDS.items())
+
+
+def get_cache(model):
+    return _caches[model]
+
+
+def get(model, pk):
+    return _caches[model].get(pk)
+
+
+def get_many(model, pks):
+    return _caches[model].get_many(pks)
+
+
+def get_by_key(model, values):
+    return _caches[model].get_by_key(values)
+
+
+def invalidate(model, pks=None):
+    _caches[model].invalidate(pks)
+
+
+def stats():
+    """
+    Returns {model name: {'hits', 'misses', 'size', 'max_size'}}
+    """
+    return dict((model._meta.object_name, cache.stats())
+            for model, cache in _caches.items())
+
+
+#############
+# RELATIONS #
+#############
+
+def attach(objs, path):
+    """
+    Fills in the related object at path ('product', or 'job__product' to go
+    through a relation that's already loaded) on each of objs from the cache
+    """
+    names = path.split('__')
+    for name in names[:-1]:
+        objs = [ getattr(obj, name) for obj in objs ]
+        objs = [ obj for obj in objs if obj is not None ]
+    name = names[-1]
+    if not objs:
+        return
+
+    field = objs[0]._meta.get_field(name)
+    related = get_many(field.rel.to, [ getattr(obj, field.attname)
+        for obj in objs ])
+    for obj in objs:
+        pk = getattr(obj, field.attname)
+        if pk is not None and pk in related:
+            setattr(obj, field.get_cache_name(), related[pk])
+
+
+def related(obj, name):
+    """
+    Returns obj's related object for the field name, from the cache unless
+    it's already loaded
+    """
+    field = obj._meta.get_field(name)
+    cache_name = field.get_cache_name()
+    if not hasattr(obj, cache_name):
+        pk = getattr(obj, field.attname)
+        setattr(obj, cache_name, None if pk is None else
+                get(field.rel.to, pk))
+    return getattr(obj, cache_name)
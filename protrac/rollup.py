@@ -0,0 +1,147 @@
+"""
+Rebuilding and verifying the denormalized Run totals on Jobs and Products
+
+The totals are normally kept up to date by Run.save() and the Run
+pre_delete signal (see models.update_rollups). These helpers recompute
+them from the Run table, for repairing data or after bulk writes that skip
+the per-object save().
+"""
+from django.db import connections, transaction
+from django.db.models import Count, Sum
+
+from aggregates import SumSeconds, supports_durations, values_seconds
+from models import Job, Product, Run
+import refcache
+import timeline
+
+# Allowed difference in run_seconds when verifying (float sums drift)
+SECONDS_TOLERANCE = 0.001
+
+
+def _run_totals(runs, group):
+    """
+    Returns a dict of group -> (qty, seconds, count), summed by the database
+    where it can subtract datetimes
+    """
+    if not supports_durations(connections[runs.db]):
+        totals = {}
+        for key, qty, seconds in values_seconds(runs.order_by(), group,
+                'qty', 'seconds'):
+            total = totals.get(key, (0, 0.0, 0))
+            totals[key] = (total[0] + qty, total[1] + seconds, total[2] + 1)
+        return totals
+    rows = runs.values(group).order_by().annotate(total_qty=Sum('qty'),
+            total_seconds=SumSeconds('end', 'start'), total_count=Count('pk'))
+    return dict((row[group], (row['total_qty'], row['total_seconds'] or 0.0,
+        row['total_count'])) for row in rows.iterator())
+
+
+def compute_job_totals(job_ids=None):
+    """
+    Returns a dict of job id -> (qty, seconds, count) computed from the Run
+    table, optionally limited to the given job ids
+    """
+    runs = Run.objects.all()
+    if job_ids is not None:
+        runs = runs.filter(job__in=job_ids)
+    return _run_totals(runs, 'job')
+
+
+def _rollup_diff(model, totals, queryset):
+    """
+    Yields (pk, stored, actual) for rows of queryset whose stored totals
+    don't match the given totals
+    """
+    for row in queryset.values_list('pk', *model.ROLLUP_FIELDS).iterator():
+        pk, stored = row[0], row[1:]
+        actual = totals.get(pk, (0, 0.0, 0))
+        if (stored[0] != actual[0] or stored[2] != actual[2]
+                or abs(stored[1] - actual[1]) > SECONDS_TOLERANCE):
+            yield pk, stored, actual
+
+
+def _set_rollups(model, changes):
+    for pk, stored, actual in changes:
+        model.objects.filter(pk=pk).update(
+                **dict(zip(model.ROLLUP_FIELDS, actual)))
+    if model is Product and changes:
+        refcache.invalidate(Product, [ pk for pk, s, a in changes ])
+
+
+def _product_totals(product_ids=None):
+    """
+    Sums the (already correct) Job totals per Product
+    """
+    jobs = Job.objects.all()
+    if product_ids is not None:
+        jobs = jobs.filter(product__in=product_ids)
+    rows = jobs.values('product').order_by().annotate(
+            **dict(('total_' + f, Sum(f)) for f in Job.ROLLUP_FIELDS))
+    return dict((row['product'], tuple(row['total_' + f]
+        for f in Job.ROLLUP_FIELDS)) for row in rows.iterator())
+
+
+def verify():
+    """
+    Returns a list of (model, pk, stored, actual) for every Job and Product
+    whose stored totals are wrong
+    """
+    job_totals = compute_job_totals()
+    errors = [ (Job, pk, stored, actual) for pk, stored, actual
+            in _rollup_diff(Job, job_totals, Job.objects.all()) ]
+
+    # product totals are checked against the runs, not the stored job totals
+    product_totals = _run_totals(Run.objects.all(), 'job__product')
+    errors.extend((Product, pk, stored, actual) for pk, stored, actual
+            in _rollup_diff(Product, product_totals, Product.objects.all()))
+    return errors
+
+
+def recompute(job_ids=None):
+    """
+    Does the work of rebuild() inside the caller's transaction, for callers
+    that write the Runs in the same one, and without invalidating the cached
+    timelines. Returns the number of Jobs and of Products updated.
+    """
+    jobs = Job.objects.all()
+    products = Product.objects.all()
+    product_ids = None
+    if job_ids is not None:
+        job_ids = list(job_ids)
+        jobs = jobs.filter(pk__in=job_ids)
+        product_ids = list(set(jobs.values_list('product', flat=True)))
+        products = products.filter(pk__in=product_ids)
+
+    job_changes = list(_rollup_diff(Job, compute_job_totals(job_ids), jobs))
+    _set_rollups(Job, job_changes)
+
+    product_changes = list(_rollup_diff(Product, _product_totals(product_ids),
+        products))
+    _set_rollups(Product, product_changes)
+    return len(job_changes), len(product_changes)
+
+
+def recompute_products():
+    """
+    Recomputes every Product's totals from its Job totals, which must
+    already be right, without reading the Runs. Works inside the caller's
+    transaction. Returns the number of Products updated.
+    """
+    changes = list(_rollup_diff(Product, _product_totals(),
+        Product.objects.all()))
+    _set_rollups(Product, changes)
+    return len(changes)
+
+
+@transaction.commit_on_success
+def rebuild(job_ids=None):
+    """
+    Recomputes the totals for the given Jobs (or all Jobs) and their
+    Products, only writing rows that changed. Returns the number of rows
+    updated.
+    """
+    jobs, products = recompute(job_ids)
+    if jobs:
+        # remaining quantities changed without any signals being sent
+        timeline.invalidate_lines()
+    return jobs + products
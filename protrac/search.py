@@ -0,0 +1,122 @@
+"""
+Indexed admin search for Jobs and Runs
+
+The stock admin search does an icontains over every search field, joining
+the products and customers, which reads the whole table. Instead each Job
+keeps:
+
+    * its references (split on commas, without spaces and in upper case) in
+      JobRef rows, so a PO or WO number is found with an index lookup
+    * search_text, its references, part number and customer name in lower
+      case, for finding any part of them without a join (with a trigram
+      index on PostgreSQL, see sql/job.postgresql_psycopg2.sql)
+
+Job.save() keeps both up to date, as do Product and Customer saves for a
+changed part number or name. Jobs written with bulk_create are indexed with
+reindex() (the reindex_job_search management command).
+
+Every word of a search has to match somewhere, as in the stock admin
+search. A word also matches a reference written with spaces in it (eg.
+"PO1234" finds "PO 1234").
+"""
+from django.db.models import Q
+
+from models import Job, JobRef
+
+# Jobs read per query by reindex()
+CHUNK_SIZE = 2000
+
+
+def normalize_ref(ref):
+    return u''.join(ref.split()).upper()
+
+
+def split_refs(refs):
+    """
+    Returns the distinct normalized references in a comma separated list
+    """
+    refs = [ normalize_ref(ref) for ref in (refs or u'').split(',') ]
+    return sorted(set(ref for ref in refs if ref))
+
+
+def search_text(refs, part_number, customer):
+    words = u' '.join((refs or u'', part_number, customer)).replace(',', ' ')
+    return u' '.join(words.lower().split())
+
+
+def index_job(job):
+    """
+    Sets a Job's search_text, before it's saved
+    """
+    import refcache
+    job.search_text = search_text(job.refs,
+            refcache.related(job, 'product').part_number,
+            refcache.related(job, 'customer').name)
+
+
+def write_refs(refs, new=False):
+    """
+    Replaces the JobRefs of the jobs in a dict of {job pk: refs}, or only
+    adds them for new jobs
+    """
+    if not new:
+        # nothing points at JobRefs, so there's nothing to collect first
+        old = JobRef.objects.filter(job__in=refs.keys())
+        old._raw_delete(old.db)
+    JobRef.objects.bulk_create([ JobRef(job_id=pk, ref=ref)
+        for pk, value in refs.items() for ref in split_refs(value) ])
+
+
+def reindex(jobs=None, refs=True):
+    """
+    Rebuilds the search_text (and unless refs is False, the JobRefs) of the
+    given Jobs, or of every Job, with a query per CHUNK_SIZE jobs and an
+    UPDATE per changed batch. Returns the number of jobs changed.
+    """
+    jobs = (Job.objects.all() if jobs is None else jobs).order_by('pk')
+    changed, last = 0, None
+    while True:
+        chunk = jobs if last is None else jobs.filter(pk__gt=last)
+        rows = list(chunk.values_list('pk', 'refs', 'search_text',
+            'product__part_number', 'customer__name')[:CHUNK_SIZE])
+        if not rows:
+            return changed
+        texts = {}
+        for pk, value, text, part_number, customer in rows:
+            new = search_text(value, part_number, customer)
+            if new != text:
+                texts[pk] = new
+        Job._case_update('search_text', texts, 300)
+        if refs:
+            write_refs(dict((row[0], row[1]) for row in rows))
+        changed += len(texts)
+        if len(rows) < CHUNK_SIZE:
+            return changed
+        last = rows[-1][0]
+
+
+def _job_filter(word):
+    # the jobs with word as a whole reference, or anywhere in their text
+    refs = JobRef.objects.filter(ref=normalize_ref(word)).values('job')
+    return Q(pk__in=refs) | Q(search_text__contains=word.lower())
+
+
+def search_jobs(queryset, query):
+    """
+    Filters a Job queryset by a search
+    """
+    for word in query.split():
+        queryset = queryset.filter(_job_filter(word))
+    return queryset
+
+
+def search_runs(queryset, query):
+    """
+    Filters a Run queryset by a search, matching the runs' jobs or their
+    operator's name
+    """
+    for word in query.split():
+        jobs = Job.objects.filter(_job_filter(word)).values('pk')
+        queryset = queryset.filter(Q(job__in=jobs) |
+                Q(operator__iexact=word))
+    return queryset
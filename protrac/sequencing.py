@@ -0,0 +1,251 @@
+"""
+Setup-aware sequencing of a production line's queue
+
+Switching a line between jobs whose products have different setups costs a
+changeover (PROTRAC_CHANGEOVER_TIME). sequence_line() reorders a line's
+queue so that jobs with the same setup run back to back, without making any
+job with a due date late that the current order finishes on time:
+
+    Jobs are taken in queue order, except that after each job the next job
+    with the same setup is pulled forward, as long as every job it would
+    overtake can absorb the delay. The job at the head of the queue stays
+    there, since the line is presumably set up for it.
+
+Products with the same (non-blank) setup instructions share a setup, and
+each other product has its own. The delays are checked against a segment
+tree of the jobs' slack, so a queue of n jobs takes O(n log n). The result
+is written with Job.set_priorities, one UPDATE.
+"""
+from datetime import datetime, time as dtime
+
+from django.db.models import Max
+
+import app_settings
+from models import Job
+
+INFINITY = float('inf')
+
+
+def setup_key(product_id, setup):
+    """
+    What a changeover is between: the setup instructions (ignoring case and
+    spacing) or, without any, the product
+    """
+    setup = u' '.join((setup or u'').lower().split())
+    return setup or product_id
+
+
+def changeovers(keys):
+    return sum(1 for a, b in zip(keys, keys[1:]) if a != b)
+
+
+class _SlackTree(object):
+    """
+    Minimum over ranges of a list of numbers, with a constant added to a
+    range, both in O(log n)
+    """
+
+    def __init__(self, values):
+        self.n = max(len(values), 1)
+        self.low = [INFINITY] * (4 * self.n)
+        self.add = [0.0] * (4 * self.n)
+        if values:
+            self._build(1, 0, self.n - 1, values)
+
+    def _build(self, node, lo, hi, values):
+        if lo == hi:
+            self.low[node] = values[lo]
+            return
+        mid = (lo + hi) // 2
+        self._build(2 * node, lo, mid, values)
+        self._build(2 * node + 1, mid + 1, hi, values)
+        self.low[node] = min(self.low[2 * node], self.low[2 * node + 1])
+
+    def _update(self, node, lo, hi, start, stop, value):
+        if stop < lo or hi < start:
+            return
+        if start <= lo and hi <= stop:
+            self.low[node] += value
+            self.add[node] += value
+            return
+        mid = (lo + hi) // 2
+        self._update(2 * node, lo, mid, start, stop, value)
+        self._update(2 * node + 1, mid + 1, hi, start, stop, value)
+        self.low[node] = self.add[node] + min(self.low[2 * node],
+                self.low[2 * node + 1])
+
+    def _query(self, node, lo, hi, start, stop):
+        if stop < lo or hi < start:
+            return INFINITY
+        if start <= lo and hi <= stop:
+            return self.low[node]
+        mid = (lo + hi) // 2
+        return self.add[node] + min(
+                self._query(2 * node, lo, mid, start, stop),
+                self._query(2 * node + 1, mid + 1, hi, start, stop))
+
+    def range_add(self, start, stop, value):
+        # start to stop inclusive
+        if start <= stop:
+            self._update(1, 0, self.n - 1, start, stop, value)
+
+    def range_min(self, start, stop):
+        if start > stop:
+            return INFINITY
+        return self._query(1, 0, self.n - 1, start, stop)
+
+    def remove(self, i):
+        # leaves the ith value out of every later minimum
+        self.range_add(i, i, INFINITY)
+
+
+class Sequence(object):
+    """
+    Proposed order of a line's queue: order is a list of job pks, and
+    priorities the {job pk: priority} that puts them in it, made from the
+    queue {job pk: priority}
+    """
+
+    def __init__(self, line_id, order, priorities, changeovers_before,
+            changeovers_after, late_before, late_after, queue=None):
+        self.line_id = line_id
+        self.order = order
+        self.priorities = priorities
+        self.queue = queue
+        self.changeovers_before = changeovers_before
+        self.changeovers_after = changeovers_after
+        self.late_before = late_before
+        self.late_after = late_after
+
+    def __unicode__(self):
+        return (u'%i changeovers instead of %i (%.1f hours saved), %i late '
+                u'jobs instead of %i' % (self.changeovers_after,
+                    self.changeovers_before, self.saved_seconds() / 3600.0,
+                    self.late_after, self.late_before))
+
+    def saved_seconds(self):
+        return ((self.changeovers_before - self.changeovers_after) *
+                app_settings.CHANGEOVER_TIME)
+
+
+def _late(jobs, order):
+    # jobs finishing after their due date, taking changeovers into account
+    finish, late, previous = 0.0, 0, None
+    for i in order:
+        key, seconds, due = jobs[i][1:4]
+        if previous is not None and key != previous:
+            finish += app_settings.CHANGEOVER_TIME
+        finish += seconds
+        previous = key
+        if due is not None and finish > due:
+            late += 1
+    return late
+
+
+def _order(jobs):
+    """
+    Returns the new order of jobs, a list of (pk, setup key, seconds, due)
+    in queue order, as a list of indexes
+    """
+    n = len(jobs)
+    if n < 3:
+        return range(n)
+    changeover = app_settings.CHANGEOVER_TIME
+
+    # the slack of each job if every job needed a changeover, so that
+    # keeping it non-negative keeps on time jobs on time
+    slack, finish = [], 0.0
+    for pk, key, seconds, due in jobs:
+        finish += seconds + changeover
+        slack.append(INFINITY if due is None else due - finish)
+    tree = _SlackTree(slack)
+
+    by_key = {}
+    for i in range(n - 1, 0, -1):
+        by_key.setdefault(jobs[i][1], []).append(i) # next one last
+    placed = [False] * n
+    order = [0]
+    placed[0] = True
+    tree.remove(0)
+    first = 1 # first job not placed yet
+    while len(order) < n:
+        while placed[first]:
+            first += 1
+        key = jobs[order[-1]][1]
+        same = by_key.get(key)
+        while same and placed[same[-1]]:
+            same.pop()
+        i = first
+        if same and same[-1] != first:
+            j = same[-1]
+            delay = jobs[j][2] + changeover
+            if tree.range_min(first, j - 1) >= delay:
+                # every job overtaken finishes that much later
+                tree.range_add(first, j - 1, -delay)
+                i = j
+        placed[i] = True
+        tree.remove(i)
+        order.append(i)
+    return order
+
+
+def sequence_line(line_id, now=None):
+    """
+    Returns the Sequence for a line's scheduled jobs
+    """
+    now = now or datetime.now()
+    midnight = datetime.combine(now.date(), dtime(0))
+    rows = Job.objects.scheduled().filter(production_line=line_id) \
+            .values_list('pk', 'priority', 'qty', 'run_qty', 'due_date',
+                    'product', 'product__setup', 'product__cycle_time')
+    # queue order (see JobQuerySet.queue_order)
+    rows = sorted(rows, key=lambda row: (row[1] == 0, row[1], row[0]))
+    jobs, priorities = [], []
+    for (pk, priority, qty, done, due_date, product, setup,
+            cycle_time) in rows:
+        if due_date is not None:
+            # the end of the due date, in seconds from now
+            due_date = (midnight - now).total_seconds() + (due_date -
+                    now.date()).days * 86400 + 86400
+        jobs.append((pk, setup_key(product, setup),
+            max(qty - done, 0) * cycle_time, due_date))
+        priorities.append(priority)
+
+    order = _order(jobs)
+    keys = [ job[1] for job in jobs ]
+
+    # reuse the line's priorities in the new order, with new ones after every
+    # other job's for the unprioritized jobs
+    changes = {}
+    if order != range(len(jobs)):
+        values = sorted(p for p in priorities if p)
+        if len(values) < len(jobs):
+            top = Job.objects.aggregate(top=Max('priority'))['top'] or 0
+            values.extend(range(top + 1, top + 1 + len(jobs) - len(values)))
+        for position, i in enumerate(order):
+            if priorities[i] != values[position]:
+                changes[jobs[i][0]] = values[position]
+
+    return Sequence(line_id, [ jobs[i][0] for i in order ], changes,
+            changeovers(keys), changeovers([ keys[i] for i in order ]),
+            _late(jobs, range(len(jobs))), _late(jobs, order),
+            queue=dict((row[0], row[1]) for row in rows))
+
+
+def _queue(line_id):
+    return dict(Job.objects.scheduled().filter(production_line=line_id)
+            .values_list('pk', 'priority'))
+
+
+def apply_sequence(sequence):
+    """
+    Writes a Sequence's priorities in one bulk update, unless the line's
+    queue has changed since the Sequence was made. Returns whether it was
+    written.
+    """
+    if sequence.queue is not None and _queue(sequence.line_id) != \
+            sequence.queue:
+        return False
+    # which also reorders the line's cached timelines
+    Job.set_priorities(sequence.priorities)
+    return True
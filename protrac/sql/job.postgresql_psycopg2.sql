@@ -0,0 +1,13 @@
+-- Open jobs on a production line in priority order, for
+-- Job.objects.scheduled(). Void and unassigned jobs are left out, which
+-- keeps the index small as finished work piles up.
+CREATE INDEX "protrac_job_scheduled" ON "protrac_job"
+    ("production_line_id", "priority", "id")
+    WHERE NOT "void" AND "production_line_id" IS NOT NULL;
+
+-- Finds words anywhere in Job.search_text for the admin search (see
+-- protrac.search). Needs the pg_trgm extension, which ships with
+-- PostgreSQL's contrib modules.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX "protrac_job_search_text" ON "protrac_job"
+    USING gin ("search_text" gin_trgm_ops);
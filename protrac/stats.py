@@ -0,0 +1,161 @@
+"""
+Per-unit cycle time statistics for every Product and Job
+
+refresh() reads the Runs as columns (job, product, qty, seconds) in one
+query and computes the statistics for every group in one pass: with NumPy
+when it's installed, sorted once and reduced per group without a Python loop
+over the groups, or in pure Python otherwise. The results replace the
+ProductCycleTimeStats and JobCycleTimeStats tables, which the admin reads.
+"""
+import math
+
+from django.db import transaction
+
+from aggregates import values_seconds
+from models import JobCycleTimeStats, ProductCycleTimeStats, Run
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Fraction of runs dropped from each end for the trimmed mean
+TRIM = 0.1
+
+# Rows written per bulk_create call
+CHUNK_SIZE = 2000
+
+STATS = ('runs', 'mean', 'median', 'p90', 'stddev', 'trimmed_mean')
+
+
+def run_columns():
+    """
+    Returns (job ids, product ids, qtys, seconds) for the Runs with a qty, as
+    parallel lists
+    """
+    rows = values_seconds(Run.objects.filter(qty__gt=0), 'job',
+            'job__product', 'qty', 'seconds')
+    return tuple(map(list, zip(*rows))) or ([], [], [], [])
+
+
+def _trim(n):
+    return int(n * TRIM)
+
+
+###############
+# PURE PYTHON #
+###############
+
+def _percentile(values, q):
+    # linear interpolation between closest ranks of sorted values
+    pos = q * (len(values) - 1)
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def _python_stats(keys, qtys, seconds):
+    groups = {}
+    for key, qty, secs in zip(keys, qtys, seconds):
+        groups.setdefault(key, []).append((qty, secs))
+
+    stats = {}
+    for key, runs in groups.items():
+        units = sorted(secs / qty for qty, secs in runs)
+        n = len(units)
+        average = sum(units) / n
+        k = _trim(n)
+        trimmed = units[k:n - k]
+        stats[key] = {
+            'runs': n,
+            'mean': sum(s for q, s in runs) / sum(q for q, s in runs),
+            'median': _percentile(units, 0.5),
+            'p90': _percentile(units, 0.9),
+            'stddev': math.sqrt(sum((u - average) ** 2 for u in units) / n),
+            'trimmed_mean': sum(trimmed) / len(trimmed),
+        }
+    return stats
+
+
+#########
+# NUMPY #
+#########
+
+def _numpy_stats(keys, qtys, seconds):
+    keys = numpy.asarray(keys)
+    qtys = numpy.asarray(qtys, dtype=float)
+    seconds = numpy.asarray(seconds, dtype=float)
+    units = seconds / qtys
+
+    # sort by group, then by per-unit time within each group
+    order = numpy.lexsort((units, keys))
+    keys, qtys, seconds, units = (keys[order], qtys[order], seconds[order],
+            units[order])
+    starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(keys)])
+
+    def percentile(q):
+        pos = starts + q * (counts - 1)
+        lo = numpy.floor(pos).astype(int)
+        hi = numpy.minimum(lo + 1, starts + counts - 1)
+        return units[lo] + (units[hi] - units[lo]) * (pos - lo)
+
+    sums = numpy.add.reduceat(units, starts)
+    average = sums / counts
+    deviations = (units - numpy.repeat(average, counts)) ** 2
+    k = (counts * TRIM).astype(int)
+    cumulative = numpy.r_[0, numpy.cumsum(units)]
+    trimmed = ((cumulative[starts + counts - k] - cumulative[starts + k])
+            / (counts - 2 * k))
+
+    columns = {
+        'runs': counts,
+        'mean': numpy.add.reduceat(seconds, starts)
+            / numpy.add.reduceat(qtys, starts),
+        'median': percentile(0.5),
+        'p90': percentile(0.9),
+        'stddev': numpy.sqrt(numpy.add.reduceat(deviations, starts)
+            / counts),
+        'trimmed_mean': trimmed,
+    }
+    columns = dict((name, values.tolist()) for name, values in
+            columns.items())
+    return dict((key, dict((name, columns[name][i]) for name in STATS))
+            for i, key in enumerate(keys[starts].tolist()))
+
+
+def group_stats(keys, qtys, seconds):
+    """
+    Returns {key: {stat: value}} over the runs grouped by key
+    """
+    if not keys:
+        return {}
+    if numpy is not None:
+        return _numpy_stats(keys, qtys, seconds)
+    return _python_stats(keys, qtys, seconds)
+
+
+###########
+# REFRESH #
+###########
+
+def _replace(model, field, stats):
+    model.objects.all().delete()
+    objs = [ model(**dict(values, **{'%s_id' % field: key}))
+        for key, values in stats.items() ]
+    for i in range(0, len(objs), CHUNK_SIZE):
+        model.objects.bulk_create(objs[i:i + CHUNK_SIZE])
+
+
+@transaction.commit_on_success
+def refresh():
+    """
+    Recomputes the cycle time statistics of every Product and Job. Returns
+    the number of (products, jobs) with statistics.
+    """
+    job_ids, product_ids, qtys, seconds = run_columns()
+    products = group_stats(product_ids, qtys, seconds)
+    jobs = group_stats(job_ids, qtys, seconds)
+    _replace(ProductCycleTimeStats, 'product', products)
+    _replace(JobCycleTimeStats, 'job', jobs)
+    return len(products), len(jobs)
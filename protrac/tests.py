@@ -1,14 +1,51 @@
+import json
 from datetime import datetime, timedelta
+from StringIO import StringIO
 
 from django.conf import settings
+from django.contrib import admin
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
-from django.test import TestCase
-
-from models import Customer, Job, Product, ProductionLine, Run, Schedule
+from django.db import IntegrityError, connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils.unittest import skipIf
+
+from aggregates import SumSeconds
+import aggregates
+import app_settings
+import board
+import capacity
+import export
+import history
+import importer
+import ingest
+import keyset
+import middleware
+import optimizer
+import models
+import refcache
+import rollup
+import search
+import sequencing
+import stats
+import timeline
+from models import (Customer, DailyProduction, Job, JobRef, Product,
+        ProductionLine, Run, Schedule)
 from app_settings import LINE_CATEGORY_CHOICES
 
 
+def create_staff(username='staff'):
+    # a staff user without any model permissions
+    user = User.objects.create_user(username, '%s@example.com' % username,
+            'password')
+    user.is_staff = True
+    user.save()
+    return user
+
+
 ##########
 # Models #
 ##########
@@ -157,6 +194,25 @@ class JobTest(TestCase):
                 operator='Johnny', qty=1)
         self.assertEqual(Job.objects.get(pk=0).is_scheduled(), False)
 
+    def test_scheduled_status(self):
+        scheduled = Job.objects.create(product=self.p, qty=10,
+                customer=self.c, production_line=self.pl)
+        unassigned = Job.objects.create(product=self.p, qty=10,
+                customer=self.c)
+        done = Job.objects.create(product=self.p, qty=10, customer=self.c,
+                production_line=self.pl)
+        Run.objects.create(job=done, start=datetime.now(),
+                end=datetime.now(), operator='Johnny', qty=10)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(scheduled.is_scheduled())
+
+        with self.assertNumQueries(1):
+            status = Job.objects.scheduled_status(
+                    [scheduled, unassigned, done.pk])
+        self.assertEqual(status, {scheduled.pk: True, unassigned.pk: False,
+            done.pk: False})
+
     def test_prioritize(self):
         def update_priority(pkey, priority):
             o = Job.objects.get(pk=pkey)
@@ -183,6 +239,67 @@ class JobTest(TestCase):
         update_priority(2, 32)
         assert_priority((0, 0, 30, 20, 10))
 
+    def test_prioritize_queries(self):
+        for pk in range(1, 6):
+            Job.objects.create(production_line=self.pl, product=self.p,
+                    qty=1000, customer=self.c, priority=pk * 10, pk=pk)
+
+        # nothing to renumber: just the select
+        with self.assertNumQueries(1):
+            Job.prioritize()
+
+        # one bulk update, no matter how many rows change, and the lines
+        # whose cached timelines get the new priorities
+        Job.objects.filter(pk=1).update(priority=55)
+        with self.assertNumQueries(3):
+            Job.prioritize()
+        self.assertEqual(
+                list(Job.objects.order_by('pk').values_list('priority',
+                    flat=True)), [50, 10, 20, 30, 40])
+
+    def test_deferred_prioritize(self):
+        for pk in range(1, 4):
+            Job.objects.create(production_line=self.pl, product=self.p,
+                    qty=1000, customer=self.c, pk=pk)
+
+        with Job.deferred_prioritize():
+            for pk, priority in ((1, 3), (2, 1), (3, 2)):
+                j = Job.objects.get(pk=pk)
+                j.priority = priority
+                j.save()
+            # not renumbered yet
+            self.assertEqual(Job.objects.get(pk=1).priority, 3)
+
+        self.assertEqual(
+                list(Job.objects.order_by('pk').values_list('priority',
+                    flat=True)), [30, 10, 20])
+
+    def test_gap_priorities(self):
+        priority_mode = models.PRIORITY_MODE
+        models.PRIORITY_MODE = 'gap'
+        try:
+            for pk, priority in enumerate((0, 1000, 2000, 2001, 3000)):
+                Job.objects.create(production_line=self.pl, product=self.p,
+                        qty=1000, customer=self.c, priority=priority, pk=pk)
+
+            def assert_priority(plist):
+                self.assertEqual(list(Job.objects.order_by('pk').values_list(
+                    'priority', flat=True)), plist)
+
+            # moving into a gap only writes the moved job
+            j = Job.objects.get(pk=0)
+            j.priority = 1500
+            with self.assertNumQueries(2):
+                j.save(update_fields=['priority'])
+            assert_priority([1500, 1000, 2000, 2001, 3000])
+
+            # taking a used key shifts the crowded range up, and no further
+            j.priority = 2000
+            j.save()
+            assert_priority([2000, 1000, 2001, 2002, 3000])
+        finally:
+            models.PRIORITY_MODE = priority_mode
+
     def test_avg_cycle_time(self):
         j = Job.objects.create(product=self.p, qty=1000, customer=self.c)
         Run.objects.create(job=j, operator='Bob', qty=60,
@@ -213,6 +330,132 @@ class RunTest(TestCase):
         self.assertEqual(r.weight(), 300) # 100ea * 3lbs
         self.assertEqual(r.cycle_time(), timedelta(seconds=1.8)) # 180s / 100ea
 
+    def test_sum_seconds(self):
+        # overnight, and with a fraction of a second
+        Run.objects.create(job=self.j, operator='Bob', qty=1,
+                start=datetime(1999, 12, 31, 23, 59, 0),
+                end=datetime(2000, 1, 2, 0, 1, 0, 500000))
+        Run.objects.create(job=self.j, operator='Bob', qty=1,
+                start=datetime(2000, 1, 1, 0, 0, 0),
+                end=datetime(2000, 1, 1, 0, 3, 0))
+        total = Run.objects.aggregate(s=SumSeconds('end', 'start'))['s']
+        self.assertAlmostEqual(total, 86400 + 120.5 + 180)
+        self.assertEqual(Job.objects.filter(pk=self.j.pk).aggregate(
+            s=SumSeconds('run__end', 'start'))['s'], total)
+
+    def test_sum_seconds_microseconds(self):
+        start = datetime(2000, 1, 1, 0, 0, 0)
+        for i in range(20):
+            Run.objects.create(job=self.j, operator='Bob', qty=1,
+                    start=start, end=start + timedelta(seconds=1.9998))
+        total = Run.objects.aggregate(s=SumSeconds('end', 'start'))['s']
+        self.assertAlmostEqual(total, 39.996)
+        self.assertEqual(rollup.verify(), [])
+
+    def test_durations_fallback(self):
+        Run.objects.create(job=self.j, operator='Bob', qty=2,
+                start=datetime(1999, 12, 31, 23, 59, 0),
+                end=datetime(2000, 1, 2, 0, 1, 0, 500000))
+        Run.objects.create(job=self.j, operator='Bob', qty=3,
+                start=datetime(2000, 1, 1, 0, 0, 0),
+                end=datetime(2000, 1, 1, 0, 3, 0))
+        def results():
+            return (rollup.compute_job_totals(), stats.run_columns(),
+                    list(history._run_rows(Run.objects.order_by('pk'))))
+        expected = results()
+        # a backend without duration SQL subtracts in Python
+        template = aggregates.DURATION_SQL.pop(connection.vendor)
+        try:
+            self.assertFalse(aggregates.supports_durations(connection))
+            self.assertEqual(results(), expected)
+        finally:
+            aggregates.DURATION_SQL[connection.vendor] = template
+        self.assertEqual(expected[0], {self.j.pk: (5, 86400 + 300.5, 2)})
+
+
+class RunRollupTest(TestCase):
+
+    def setUp(self):
+        self.c = Customer.objects.create(name='cust1')
+        self.p = Product.objects.create(part_number='M1911', cycle_time=2,
+                material_wt=3)
+        self.j1 = Job.objects.create(product=self.p, qty=1000, customer=self.c)
+        self.j2 = Job.objects.create(product=self.p, qty=1000, customer=self.c)
+
+    def assert_rollup(self, obj, qty, seconds, count):
+        obj = obj.__class__.objects.get(pk=obj.pk)
+        self.assertEqual((obj.run_qty, obj.run_seconds, obj.run_count),
+                (qty, seconds, count))
+
+    def test_run_writes(self):
+        r = Run.objects.create(job=self.j1, operator='Bob', qty=100,
+                start=datetime(2000, 1, 1, 0, 0, 0),
+                end=datetime(2000, 1, 1, 0, 3, 0))
+        self.assert_rollup(self.j1, 100, 180, 1)
+        self.assert_rollup(self.p, 100, 180, 1)
+
+        # changing qty and moving the run to another job
+        r = Run.objects.get(pk=r.pk)
+        r.qty = 50
+        r.job = self.j2
+        r.save()
+        self.assert_rollup(self.j1, 0, 0, 0)
+        self.assert_rollup(self.j2, 50, 180, 1)
+        self.assert_rollup(self.p, 50, 180, 1)
+
+        r.delete()
+        self.assert_rollup(self.j2, 0, 0, 0)
+        self.assert_rollup(self.p, 0, 0, 0)
+
+    def test_stale_job_save(self):
+        stale = Job.objects.get(pk=self.j1.pk)
+        Run.objects.create(job=self.j1, operator='Bob', qty=100,
+                start=datetime(2000, 1, 1, 0, 0, 0),
+                end=datetime(2000, 1, 1, 0, 3, 0))
+        stale.save()
+        self.assert_rollup(self.j1, 100, 180, 1)
+
+    def test_job_product_changed(self):
+        Run.objects.create(job=self.j1, operator='Bob', qty=100,
+                start=datetime(2000, 1, 1, 0, 0, 0),
+                end=datetime(2000, 1, 1, 0, 3, 0))
+        p2 = Product.objects.create(part_number='P38', cycle_time=2)
+        job = Job.objects.get(pk=self.j1.pk)
+        job.product = p2
+        job.save()
+        self.assert_rollup(self.p, 0, 0, 0)
+        self.assert_rollup(p2, 100, 180, 1)
+        self.assertEqual(refcache.get(Product, p2.pk).run_qty, 100)
+        job.save()
+        self.assert_rollup(p2, 100, 180, 1)
+        call_command('rebuild_run_rollups', verify=True, verbosity=0)
+
+    def test_job_deleted(self):
+        for job in (self.j1, self.j2):
+            Run.objects.create(job=job, operator='Bob', qty=100,
+                    start=datetime(2000, 1, 1, 0, 0, 0),
+                    end=datetime(2000, 1, 1, 0, 3, 0))
+        # its runs are deleted after the job
+        Job.objects.get(pk=self.j1.pk).delete()
+        self.assert_rollup(self.p, 100, 180, 1)
+        self.assertEqual(rollup.verify(), [])
+
+    def test_rebuild_command(self):
+        Run.objects.create(job=self.j1, operator='Bob', qty=100,
+                start=datetime(2000, 1, 1, 0, 0, 0),
+                end=datetime(2000, 1, 1, 0, 3, 0))
+        call_command('rebuild_run_rollups', verify=True, verbosity=0)
+
+        Job.objects.filter(pk=self.j1.pk).update(run_qty=0)
+        Product.objects.filter(pk=self.p.pk).update(run_count=7)
+        self.assertRaises(CommandError, call_command, 'rebuild_run_rollups',
+                verify=True, verbosity=0)
+
+        call_command('rebuild_run_rollups', verbosity=0)
+        self.assert_rollup(self.j1, 100, 180, 1)
+        self.assert_rollup(self.p, 100, 180, 1)
+        call_command('rebuild_run_rollups', verify=True, verbosity=0)
+
 
 class ScheduleTest(TestCase):
 
@@ -267,6 +510,27 @@ class ScheduleTest(TestCase):
                 raise AssertionError(
                         '%s should not be in Schedule, but it is...' % repr(n))
 
+    def test_manager_single_query(self):
+        for pk in range(1, 11):
+            j = Job.objects.create(product=self.p, qty=10, customer=self.c,
+                    production_line=self.pl, pk=pk)
+            Run.objects.create(job=j, qty=pk, operator='j',
+                    start=datetime.now(), end=datetime.now())
+
+        with self.assertNumQueries(1):
+            schedule = list(Schedule.objects.all())
+        self.assertEqual(sorted(j.pk for j in schedule), range(1, 10))
+
+        # the run totals are read without re-aggregating each job
+        with self.assertNumQueries(0):
+            self.assertEqual([ j.qty_remaining() for j in schedule ],
+                    [ 10 - j.pk for j in schedule ])
+
+    def test_scheduled_queryset(self):
+        j = Job.objects.create(product=self.p, qty=10, customer=self.c,
+                production_line=self.pl)
+        self.assertEqual(list(Job.objects.scheduled()), [j])
+
 
 #########
 # Views #
@@ -324,7 +588,19 @@ class JobScheduleViewTest(TestCase):
         self.assertTemplateUsed(response, 'protrac/admin_schedule.html')
 
     def test_job_schedule_view(self):
-        # TODO: Set up the test DB for the view
+        c = Customer.objects.create(name='cust1')
+        p = Product.objects.create(part_number='M1911', cycle_time=2,
+                material_wt=3)
+        lines = [ ProductionLine.objects.create(name='line %i' % i)
+                for i in range(3) ]
+        for line in lines[:2]:
+            for priority in (0, 20, 10):
+                Job.objects.create(product=p, qty=10, customer=c,
+                        production_line=line, priority=priority)
+        # not scheduled
+        Job.objects.create(product=p, qty=10, customer=c, void=True,
+                production_line=lines[2])
+
         self.assertTrue(self.client.login(username='user',
                 password='password'))
         response = self.client.get(reverse('admin:job_schedule'))
@@ -332,3 +608,1396 @@ class JobScheduleViewTest(TestCase):
         self.assertTrue(response.context['user'].is_authenticated())
         self.assertTemplateNotUsed(response, 'admin/login.html')
         self.assertTemplateUsed(response, 'protrac/admin_schedule.html')
+
+        schedule = response.context['schedule']
+        self.assertEqual([ e['line'] for e in schedule ], lines[:2])
+        entry = schedule[0]
+        # prioritized jobs first, then the unprioritized one
+        priorities = [ r['job'].priority for r in entry['jobs'] ]
+        self.assertTrue(0 < priorities[0] < priorities[1])
+        self.assertEqual(priorities[2], 0)
+        self.assertEqual([ r['cumulative_duration'] for r in entry['jobs'] ],
+                [ timedelta(seconds=20 * n) for n in (1, 2, 3) ])
+        self.assertEqual(entry['duration'], timedelta(seconds=60))
+        self.assertEqual(entry['weight'], 90)
+
+    def test_job_schedule_window(self):
+        c = Customer.objects.create(name='cust1')
+        p = Product.objects.create(part_number='M1911', cycle_time=2,
+                material_wt=3)
+        line = ProductionLine.objects.create(name='line 1')
+        for i in range(5):
+            Job.objects.create(product=p, qty=10, customer=c,
+                    production_line=line)
+
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        per_line = app_settings.SCHEDULE_JOBS_PER_LINE
+        app_settings.SCHEDULE_JOBS_PER_LINE = 2
+        try:
+            response = self.client.get(reverse('admin:job_schedule'),
+                    {'line': line.pk, 'start': 2})
+        finally:
+            app_settings.SCHEDULE_JOBS_PER_LINE = per_line
+        entry = response.context['schedule'][0]
+        self.assertEqual(len(entry['jobs']), 2)
+        # the running totals include the jobs before the window
+        self.assertEqual(entry['jobs'][0]['cumulative_duration'],
+                timedelta(seconds=60))
+        self.assertEqual(entry['next_start'], 4)
+        self.assertEqual(entry['previous_start'], 0)
+
+        response = self.client.get(reverse('admin:job_schedule'),
+                {'line': 'abc'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_ahead_of(self):
+        c = Customer.objects.create(name='cust1')
+        p = Product.objects.create(part_number='M1911', cycle_time=2)
+        line = ProductionLine.objects.create(name='line 1')
+        for priority in (0, 20, 0, 10, 20):
+            Job.objects.create(product=p, qty=10, customer=c,
+                    production_line=line, priority=priority)
+        queue = list(Job.objects.queue_order())
+        for i, job in enumerate(queue):
+            self.assertEqual(sorted(j.pk for j in
+                Job.objects.ahead_of(job)), sorted(j.pk for j in queue[:i]))
+
+
+class ChangelistQueryTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user', 'a@b.com',
+                'password')
+        self.c = Customer.objects.create(name='cust1')
+        self.pl = ProductionLine.objects.create(name='line 1', category='X')
+        self.p = Product.objects.create(part_number='M1911', cycle_time=2,
+                material_wt=3)
+
+    def add_jobs(self, count):
+        for i in range(count):
+            j = Job.objects.create(product=self.p, qty=1000, customer=self.c,
+                    production_line=self.pl)
+            Run.objects.create(job=j, start=datetime.now(),
+                    end=datetime.now(), operator='Johnny', qty=10)
+
+    def count_queries(self, url, cold=True):
+        if cold:
+            # start from an empty reference cache
+            for model in refcache.KEY_FIELDS:
+                refcache.invalidate(model)
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            # queries are reset when the request starts
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+
+    def assert_constant_queries(self, url):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        self.add_jobs(2)
+        few = self.count_queries(url)
+        self.add_jobs(20)
+        self.assertEqual(self.count_queries(url), few)
+
+    def test_job_changelist(self):
+        self.assert_constant_queries(reverse('admin:protrac_job_changelist'))
+
+    def test_refcache(self):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        self.add_jobs(2)
+        url = reverse('admin:protrac_job_changelist')
+        cold = self.count_queries(url)
+        # the line, customer and product come from memory the second time
+        self.assertEqual(self.count_queries(url, cold=False), cold - 3)
+        product = refcache.get_cache(Product)
+        self.assertTrue(product.hits > 0)
+
+    def test_no_join(self):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        self.add_jobs(2)
+        for name in ('job', 'schedule'):
+            cl = self.client.get(reverse('admin:protrac_%s_changelist' %
+                name)).context['cl']
+            self.assertFalse('JOIN' in str(cl.query_set.query))
+            # the jobs, and their prefetched cycle time statistics
+            with self.assertNumQueries(2):
+                jobs = list(cl.query_set)
+            for field in ('product', 'customer', 'production_line'):
+                cache_name = Job._meta.get_field(field).get_cache_name()
+                self.assertFalse(hasattr(jobs[0], cache_name))
+            # the rows shown got them from the reference cache
+            self.assertEqual(cl.result_list[0].customer, self.c)
+
+    def test_schedule_changelist(self):
+        self.assert_constant_queries(
+                reverse('admin:protrac_schedule_changelist'))
+
+    def test_run_changelist(self):
+        self.assert_constant_queries(reverse('admin:protrac_run_changelist'))
+
+    def test_job_schedule(self):
+        self.assert_constant_queries(reverse('admin:job_schedule'))
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('user', 'a@b.com', 'password')
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        self.run_admin = admin.site._registry[Run]
+        self.job_admin = admin.site._registry[Job]
+        self.run_admin.list_per_page = self.job_admin.list_per_page = 2
+        c = Customer.objects.create(name='cust1')
+        self.pl = ProductionLine.objects.create(name='line 1', category='X')
+        p = Product.objects.create(part_number='M1911', cycle_time=2,
+                material_wt=3)
+        self.jobs = [ Job.objects.create(product=p, qty=1000, customer=c,
+            production_line=self.pl, priority=priority)
+            for priority in (3, 1, 2, 1, 0) ]
+        start = datetime(2013, 1, 1, 8)
+        # two runs start together, so the id breaks the tie
+        self.runs = [ Run.objects.create(job=self.jobs[0], start=start +
+            timedelta(hours=i), end=start + timedelta(hours=i, minutes=30),
+            operator='Johnny', qty=10) for i in (0, 1, 1, 2, 3) ]
+
+    def tearDown(self):
+        self.run_admin.list_per_page = self.job_admin.list_per_page = 100
+
+    def pages(self, url):
+        # follows the Next links, returning the pks on each page
+        pages = []
+        while url:
+            cl = self.client.get(url).context['cl']
+            pages.append([ obj.pk for obj in cl.result_list ])
+            url = cl.keyset_next_url and url.split('?')[0] + \
+                    cl.keyset_next_url
+        return pages, cl
+
+    def test_runs(self):
+        url = reverse('admin:protrac_run_changelist')
+        pages, cl = self.pages(url)
+        r = [ run.pk for run in self.runs ]
+        self.assertEqual(pages, [[r[4], r[3]], [r[2], r[1]], [r[0]]])
+        self.assertEqual(cl.result_count, 5)
+        self.assertTrue(cl.multi_page)
+
+        # and back
+        cl = self.client.get(url + cl.keyset_previous_url).context['cl']
+        self.assertEqual([ obj.pk for obj in cl.result_list ], [r[2], r[1]])
+        self.assertEqual(cl.keyset_first_url, '?')
+
+    def test_jobs(self):
+        pages, cl = self.pages(reverse('admin:protrac_job_changelist'))
+        j = list(Job.objects.order_by('priority', 'pk').values_list('pk',
+            flat=True))
+        self.assertEqual(pages, [j[0:2], j[2:4], j[4:]])
+        # estimated where the database can, but SQLite counts
+        self.assertTrue(self.job_admin.keyset_estimate_count)
+        self.assertEqual(cl.result_count, 5)
+        self.assertFalse(cl.result_count_estimated)
+
+    def test_sorted_by_column(self):
+        # numbered pages, as usual
+        cl = self.client.get(reverse('admin:protrac_run_changelist'),
+                {'o': '3'}).context['cl']
+        self.assertEqual(cl.keyset, None)
+        self.assertEqual(cl.paginator.num_pages, 3)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('admin:protrac_run_changelist'),
+                {'after': 'nonsense'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_constant_queries(self):
+        url = reverse('admin:protrac_run_changelist')
+        self.client.get(url) # warm the reference cache
+        connection.use_debug_cursor = True
+        try:
+            self.client.get(url)
+            first = len(connection.queries)
+            cl = self.client.get(url + '?after=' + keyset.encode(
+                (self.runs[2].start, self.runs[2].pk))).context['cl']
+            self.assertEqual(len(connection.queries), first)
+        finally:
+            connection.use_debug_cursor = None
+        self.assertEqual([ obj.pk for obj in cl.result_list ],
+                [self.runs[1].pk, self.runs[0].pk])
+
+    def test_list_editable(self):
+        url = reverse('admin:protrac_job_changelist')
+        line = ProductionLine.objects.create(name='line 2', category='X')
+        cursor = keyset.encode(Job.objects.order_by('priority', 'pk')
+                .values_list('priority', 'pk')[1])
+        cl = self.client.get(url, {'after': cursor}).context['cl']
+        jobs = list(cl.result_list)
+        data = {'form-TOTAL_FORMS': 2, 'form-INITIAL_FORMS': 2,
+                'form-MAX_NUM_FORMS': '', '_save': 'Save'}
+        for i, job in enumerate(jobs):
+            data.update({'form-%i-id' % i: job.pk,
+                'form-%i-priority' % i: job.priority,
+                'form-%i-production_line' % i: line.pk})
+        response = self.client.post(url + '?after=' + cursor, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(set(line.job_set.values_list('pk', flat=True)),
+                set(job.pk for job in jobs))
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('user', 'a@b.com', 'password')
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        self.c = Customer.objects.create(name='Acme Corp')
+        self.p = Product.objects.create(part_number='M1911-A1', cycle_time=2,
+                material_wt=3)
+        self.jobs = [ Job.objects.create(product=self.p, qty=10,
+            customer=self.c, refs=refs) for refs in
+            ('PO 1234, wo5', 'PO12345', '') ]
+
+    def found(self, query, queryset=None):
+        queryset = Job.objects.all() if queryset is None else queryset
+        return sorted(job.pk for job in search.search_jobs(queryset, query))
+
+    def test_index(self):
+        job = self.jobs[0]
+        self.assertEqual(job.search_text, u'po 1234 wo5 m1911-a1 acme corp')
+        self.assertEqual(sorted(job.ref_set.values_list('ref', flat=True)),
+                ['PO1234', 'WO5'])
+        job.refs = 'PO1234'
+        job.save()
+        self.assertEqual(list(job.ref_set.values_list('ref', flat=True)),
+                ['PO1234'])
+
+    def test_search(self):
+        j = [ job.pk for job in self.jobs ]
+        # a whole reference, ignoring case and spaces, or any part of the
+        # references, part number or customer name, like icontains
+        self.assertEqual(self.found('po1234'), [j[0], j[1]])
+        self.assertEqual(self.found('PO 1234'), [j[0], j[1]])
+        self.assertEqual(self.found('PO123'), [j[1]])
+        self.assertEqual(self.found('2345'), [j[1]])
+        self.assertEqual(self.found('911-a'), j)
+        self.assertEqual(self.found('cme'), j)
+        self.assertEqual(self.found('acme wo5'), [j[0]])
+        self.assertEqual(self.found('corp nope'), [])
+        # one query, with the references as a subquery
+        with self.assertNumQueries(1):
+            self.found('po1234 m1911')
+
+    def test_renamed(self):
+        self.c.name = 'Widgets Inc'
+        self.c.save()
+        self.assertEqual(self.found('acme'), [])
+        self.assertEqual(len(self.found('widgets')), 3)
+        self.p.part_number = 'P38'
+        self.p.save()
+        self.assertEqual(len(self.found('p38 widgets')), 3)
+
+    def test_reindex(self):
+        Job.objects.update(search_text='')
+        JobRef.objects.all().delete()
+        self.assertEqual(search.reindex(), 3)
+        self.assertEqual(self.found('po12345'), [self.jobs[1].pk])
+        self.assertEqual(search.reindex(), 0)
+
+    def test_admin(self):
+        response = self.client.get(reverse('admin:protrac_job_changelist'),
+                {'q': 'po12345'})
+        self.assertEqual([ job.pk for job in
+            response.context['cl'].result_list ], [self.jobs[1].pk])
+        self.assertContains(response, 'value="po12345"')
+
+        run = Run.objects.create(job=self.jobs[1], start=datetime.now(),
+                end=datetime.now(), operator='Johnny', qty=10)
+        for query in ('po12345', 'johnny'):
+            response = self.client.get(reverse(
+                'admin:protrac_run_changelist'), {'q': query})
+            self.assertEqual([ obj.pk for obj in
+                response.context['cl'].result_list ], [run.pk])
+
+
+##############
+# Benchmarks #
+##############
+
+class BenchmarkTest(TransactionTestCase):
+    # Python's sqlite3 module commits before running EXPLAIN
+
+    def test_generate_and_run(self):
+        import benchmark
+        benchmark.generate(lines=2, customers=3, products=5, jobs=20,
+                runs=100, seed=1)
+        self.assertEqual(Job.objects.count(), 20)
+        self.assertEqual(Run.objects.count(), 100)
+        # the generated totals are consistent with the runs
+        self.assertEqual(rollup.verify(), [])
+
+        results = benchmark.run(repeat=1, names=['schedule', 'prioritize'])
+        self.assertEqual(sorted(results['cases']), ['prioritize',
+            'schedule'])
+        self.assertEqual(results['cases']['schedule']['queries'], 1)
+
+        # the composite indexes are used
+        plan = u' '.join(results['plans']['run_history'])
+        self.assertTrue('INDEX' in plan.upper(), plan)
+        self.assertFalse('TEMP B-TREE' in plan.upper(), plan)
+        plan = u' '.join(results['plans']['schedule_line'])
+        self.assertTrue('INDEX' in plan.upper(), plan)
+
+
+###################
+# Instrumentation #
+###################
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user', 'a@b.com',
+                'password')
+        self.instrumentation = app_settings.INSTRUMENTATION
+        app_settings.INSTRUMENTATION = True
+        middleware.RECENT.clear()
+
+    def tearDown(self):
+        app_settings.INSTRUMENTATION = self.instrumentation
+
+    def test_sql_shape(self):
+        self.assertEqual(middleware.sql_shape(
+            "SELECT * FROM t WHERE a = 12 AND b = 'x''y' AND c IN (1, 2)"),
+            "SELECT * FROM t WHERE a = ? AND b = ? AND c IN (?)")
+
+        queries = [ {'sql': 'SELECT * FROM t WHERE id = %i' % i}
+                for i in range(5) ]
+        self.assertEqual(middleware.repeated_queries(queries, 5),
+                [(5, 'SELECT * FROM t WHERE id = ?')])
+        self.assertEqual(middleware.repeated_queries(queries, 6), [])
+
+    def test_middleware(self):
+        classes = settings.MIDDLEWARE_CLASSES + (
+                'protrac.middleware.InstrumentationMiddleware',)
+        with override_settings(MIDDLEWARE_CLASSES=classes):
+            self.assertTrue(self.client.login(username='user',
+                    password='password'))
+            self.client.get(reverse('admin:protrac_job_changelist'))
+            self.client.get(reverse('admin:job_schedule'))
+            # not a protrac view
+            self.client.get(reverse('admin:auth_user_changelist'))
+            # doesn't record itself
+            response = self.client.get(
+                    reverse('admin:protrac_instrumentation'))
+
+        self.assertEqual([ r['view'] for r in middleware.RECENT ],
+                ['protrac_job_changelist', 'job_schedule'])
+        self.assertTrue(middleware.RECENT[0]['queries'] > 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['views']), 2)
+        self.assertContains(response, '<title>Instrumentation')
+        self.assertContains(response, '<h2>Reference cache</h2>', count=1)
+
+
+############
+# Timeline #
+############
+
+class TimelineTest(TestCase):
+
+    def setUp(self):
+        timeline.get_timeline_cache().clear()
+        self.c = Customer.objects.create(name='cust1')
+        self.pl = ProductionLine.objects.create(name='line 1', category='X')
+        self.p = Product.objects.create(part_number='M1911', cycle_time=2,
+                material_wt=3)
+        self.start = datetime(2000, 1, 1, 0, 0, 0)
+        self.jobs = [ Job.objects.create(product=self.p, qty=10,
+            customer=self.c, production_line=self.pl, priority=priority,
+            due_date=self.start.date())
+            for priority in (10, 20, 30) ]
+        refcache.get(Product, self.p.pk)
+
+    def assert_ends(self, timeline, ends):
+        self.assertEqual([ (e.job_id, e.end) for e in timeline ],
+                [ (j.pk, self.start + timedelta(seconds=s) if s else None)
+                    for j, s in ends ])
+
+    def test_project(self):
+        with self.assertNumQueries(1):
+            timelines = timeline.project(start=self.start)
+        line = timelines[self.pl.pk]
+        self.assert_ends(line, [(self.jobs[0], 20), (self.jobs[1], 40),
+            (self.jobs[2], 60)])
+        self.assertEqual(line.end(), self.start + timedelta(seconds=60))
+        entry = line.entry(self.jobs[0].pk)
+        self.assertEqual(entry.slack, timedelta(days=1, seconds=-20))
+        self.assertFalse(entry.is_late())
+
+    def test_suspended_and_observed(self):
+        Job.objects.filter(pk=self.jobs[1].pk).update(suspended='No material')
+        Run.objects.create(job=self.jobs[0], operator='Bob', qty=5,
+                start=self.start, end=self.start + timedelta(seconds=20))
+        line = timeline.project_line(self.pl.pk, start=self.start,
+                observed=True)
+        # 5 left at the observed 4s each, then 10 at 4s each
+        self.assert_ends(line, [(self.jobs[0], 20), (self.jobs[1], None),
+            (self.jobs[2], 60)])
+
+    def test_update(self):
+        line = timeline.project_line(self.pl.pk, start=self.start)
+
+        # a run on the last job only recomputes from that job
+        Run.objects.create(job=self.jobs[2], operator='Bob', qty=5,
+                start=self.start, end=self.start)
+        # the job, and the product whose run totals just changed
+        with self.assertNumQueries(2):
+            self.assertEqual(line.update(self.jobs[2].pk), 2)
+        self.assert_ends(line, [(self.jobs[0], 20), (self.jobs[1], 40),
+            (self.jobs[2], 50)])
+
+        # moving a job to the front
+        Job.objects.filter(pk=self.jobs[2].pk).update(priority=5)
+        self.assertEqual(line.update(self.jobs[2].pk), 0)
+        self.assert_ends(line, [(self.jobs[2], 10), (self.jobs[0], 30),
+            (self.jobs[1], 50)])
+
+        # a job leaving the line
+        Job.objects.filter(pk=self.jobs[0].pk).update(production_line=None)
+        self.assertEqual(line.update(self.jobs[0].pk), 1)
+        self.assert_ends(line, [(self.jobs[2], 10), (self.jobs[1], 30)])
+
+        # a job on another line doesn't change this one
+        other = Job.objects.create(product=self.p, qty=10, customer=self.c)
+        self.assertEqual(line.update(other.pk), None)
+
+
+class TimelineCacheTest(TestCase):
+
+    def setUp(self):
+        timeline.get_timeline_cache().clear()
+        self.c = Customer.objects.create(name='cust1')
+        self.pl = ProductionLine.objects.create(name='line 1', category='X')
+        self.pl2 = ProductionLine.objects.create(name='line 2', category='X')
+        self.p = Product.objects.create(part_number='M1911', cycle_time=2,
+                material_wt=3)
+        self.job = Job.objects.create(product=self.p, qty=10,
+                customer=self.c, production_line=self.pl, priority=10)
+
+    def assert_cached(self, line_id, cached=True):
+        connection.use_debug_cursor = True
+        try:
+            before = len(connection.queries)
+            line = timeline.cached_line(line_id)
+            self.assertEqual(len(connection.queries) == before, cached)
+        finally:
+            connection.use_debug_cursor = None
+        return line
+
+    def test_invalidation(self):
+        line = self.assert_cached(self.pl.pk, False)
+        self.assertEqual(line.end() - line.start, timedelta(seconds=20))
+        self.assert_cached(self.pl.pk)
+        self.assert_cached(self.pl2.pk, False)
+        timeline.cached_line(self.pl.pk, observed=True)
+
+        # the cached line is updated rather than recomputed, but the
+        # observed one depends on the product's runs
+        Run.objects.create(job=self.job, operator='Bob', qty=5,
+                start=datetime.now(), end=datetime.now())
+        line = self.assert_cached(self.pl.pk)
+        self.assertEqual(line.end() - line.start, timedelta(seconds=10))
+        self.assertEqual(timeline.get_timeline_cache().get(
+            timeline._keys(timeline.get_timeline_cache(), self.pl.pk,
+                True)[0]), None)
+        self.assert_cached(self.pl2.pk)
+
+        # moving the job updates both lines
+        job = Job.objects.get(pk=self.job.pk)
+        job.production_line = self.pl2
+        job.save()
+        self.assertEqual(len(self.assert_cached(self.pl.pk)), 0)
+        self.assertEqual(len(self.assert_cached(self.pl2.pk)), 1)
+
+        self.p.cycle_time = 4
+        self.p.save()
+        line = self.assert_cached(self.pl2.pk, False)
+        self.assertEqual(line.end() - line.start, timedelta(seconds=20))
+        self.assert_cached(self.pl.pk)
+
+        timeline.invalidate_lines()
+        self.assert_cached(self.pl.pk, False)
+
+    def test_priorities(self):
+        jobs = [ Job.objects.create(product=self.p, qty=10, customer=self.c,
+            production_line=self.pl, priority=priority)
+            for priority in (20, 30) ]
+        self.assert_cached(self.pl.pk, False)
+        # renumbered, then moved between the renumbered jobs
+        Job.set_priorities({self.job.pk: 100, jobs[0].pk: 200,
+            jobs[1].pk: 300})
+        job = Job.objects.get(pk=jobs[1].pk)
+        job.priority = 150
+        with Job.deferred_prioritize():
+            job.save()
+        line = self.assert_cached(self.pl.pk)
+        self.assertEqual([ entry.job_id for entry in line ],
+                [self.job.pk, jobs[1].pk, jobs[0].pk])
+        self.assertEqual([ entry.job_id for entry in line ], [ entry.job_id
+            for entry in timeline.project_line(self.pl.pk) ])
+
+    def test_update_while_recomputing(self):
+        cache = timeline.get_timeline_cache()
+        timeline.cached_line(self.pl.pk)
+        fresh, stale, lock = timeline._keys(cache, self.pl.pk, False)
+        cache.add(lock, 1)
+        try:
+            timeline.update_lines([self.pl.pk], [self.job.pk])
+        finally:
+            cache.delete(lock)
+        # what's being recomputed may predate the change, so it's dropped
+        self.assert_cached(self.pl.pk, False)
+
+    def test_stampede(self):
+        cache = timeline.get_timeline_cache()
+        timeline.cached_line(self.pl.pk)
+        timeline.invalidate_lines([self.pl.pk])
+
+        # someone else is recomputing: the previous projection is served
+        fresh, stale, lock = timeline._keys(cache, self.pl.pk, False)
+        cache.add(lock, 1)
+        try:
+            line = self.assert_cached(self.pl.pk)
+        finally:
+            cache.delete(lock)
+        self.assertEqual(len(line), 1)
+        self.assert_cached(self.pl.pk, False)
+
+
+##########
+# Export #
+##########
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user', 'a@b.com',
+                'password')
+        c = Customer.objects.create(name=u'cust\xe9')
+        pl = ProductionLine.objects.create(name='line 1', category='X')
+        p = Product.objects.create(part_number='M1911', cycle_time=2,
+                material_wt=3)
+        self.jobs = [ Job.objects.create(product=p, qty=10, customer=c,
+            production_line=pl, refs='PO%i' % i) for i in range(5) ]
+        Run.objects.create(job=self.jobs[0], operator='Bob', qty=4,
+                start=datetime(2000, 1, 1, 0, 0, 0),
+                end=datetime(2000, 1, 1, 0, 1, 0))
+
+    def test_chunked(self):
+        chunk_size = export.CHUNK_SIZE
+        export.CHUNK_SIZE = 2
+        try:
+            with self.assertNumQueries(3):
+                rows = list(export.job_rows())
+        finally:
+            export.CHUNK_SIZE = chunk_size
+        self.assertEqual([ r[0] for r in rows ],
+                [ j.pk for j in self.jobs ])
+        # qty done, remaining, weight and seconds remaining
+        self.assertEqual(rows[0][8:12], (4, 6, 18, 12))
+
+    def test_csv(self):
+        lines = ''.join(export.stream('runs', 'csv')).splitlines()
+        self.assertEqual(lines[0], ','.join(export.RUN_COLUMNS))
+        self.assertEqual(lines[1], '%i,%i,M1911,4,2000-01-01T00:00:00,'
+                '2000-01-01T00:01:00,60.0,12.0,Bob' % (
+                    Run.objects.get().pk, self.jobs[0].pk))
+        self.assertTrue(u'cust\xe9'.encode('utf-8')
+                in ''.join(export.stream('jobs', 'csv')))
+
+    def test_view(self):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        response = self.client.get(reverse('admin:protrac_export',
+            kwargs={'name': 'schedule', 'format': 'json'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = json.loads(''.join(response.streaming_content))
+        self.assertEqual([ r['job'] for r in rows ],
+                [ j.pk for j in self.jobs ])
+
+        response = self.client.get(reverse('admin:protrac_export',
+            kwargs={'name': 'nothing', 'format': 'csv'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_view_permission(self):
+        create_staff()
+        self.assertTrue(self.client.login(username='staff',
+                password='password'))
+        response = self.client.get(reverse('admin:protrac_export',
+            kwargs={'name': 'runs', 'format': 'csv'}))
+        self.assertEqual(response.status_code, 403)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('export_protrac', 'jobs', format='json', stdout=out)
+        self.assertEqual(len(json.loads(out.getvalue())), 5)
+
+
+class ImportTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user', 'a@b.com',
+                'password')
+        self.customer = Customer.objects.create(name='cust')
+        self.line = ProductionLine.objects.create(name='line 1',
+                category='X')
+        self.product = Product.objects.create(part_number='M1911',
+                cycle_time=2, material_wt=3)
+
+    def test_products(self):
+        result = importer.import_products([
+            {'part_number': 'P1', 'cycle_time': '1.5', 'material_wt': ''},
+            {'part_number': 'M1911', 'cycle_time': '1'},
+            {'part_number': 'P2', 'cycle_time': 'fast'},
+            {'part_number': 'P1', 'cycle_time': '1'},
+        ])
+        self.assertEqual((result.rows, result.created), (4, 1))
+        self.assertEqual([ n for n, message in result.errors ], [2, 3, 4])
+        self.assertEqual(Product.objects.get(part_number='P1').cycle_time,
+                1.5)
+
+    def test_jobs(self):
+        rows = [ {'part_number': 'M1911', 'customer': 'cust', 'qty': '10',
+            'refs': 'PO%i' % i, 'production_line': 'line 1',
+            'priority': str(30 - i)} for i in range(3) ]
+        rows.append({'part_number': 'nope', 'customer': 'cust', 'qty': '1',
+            'refs': 'PO3'})
+        rows.append({'part_number': 'M1911', 'customer': 'cust', 'qty': '-1',
+            'refs': 'PO4', 'due_date': '2000-01-01'})
+
+        # a lookup per related model and an insert per batch, then one
+        # reprioritization reading and renumbering every job (and reading
+        # the lines, for their cached timelines), and indexing
+        # the new jobs for search (finding them, reading, updating, and
+        # replacing their references). The second batch only has the unknown
+        # part number to look up (the rest are in the reference cache) and
+        # nothing valid to insert.
+        for model in refcache.KEY_FIELDS:
+            refcache.invalidate(model)
+        with self.assertNumQueries(4 + 1 + 3 + 5):
+            result = importer.import_jobs(rows, batch_size=3)
+        self.assertEqual(result.created, 3)
+        self.assertEqual([ n for n, message in result.errors ], [4, 5])
+        self.assertTrue('part_number' in result.errors[0][1])
+        self.assertTrue('qty' in result.errors[1][1])
+        self.assertEqual(list(Job.objects.order_by('priority').values_list(
+            'refs', 'priority')), [('PO2', 10), ('PO1', 20), ('PO0', 30)])
+
+    def test_runs(self):
+        job = Job.objects.create(product=self.product, qty=10,
+                customer=self.customer, production_line=self.line)
+        result = importer.import_runs([
+            {'job': str(job.pk), 'qty': '4', 'operator': 'Bob',
+                'start': '2000-01-01 00:00', 'end': '2000-01-01 00:01'},
+            {'job': str(job.pk), 'qty': '1', 'operator': 'Bob',
+                'start': '2000-01-01 00:01', 'end': '2000-01-01 00:00'},
+            {'job': 'x', 'qty': '1', 'operator': 'Bob',
+                'start': '2000-01-01 00:01', 'end': '2000-01-01 00:02'},
+        ])
+        self.assertEqual(result.created, 1)
+        self.assertEqual([ n for n, message in result.errors ], [2, 3])
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((job.run_qty, job.run_seconds, job.run_count),
+                (4, 60, 1))
+        self.assertEqual(Product.objects.get().run_qty, 4)
+
+    def test_view_and_command(self):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        url = reverse('admin:protrac_import')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        f = StringIO('part_number,customer,qty,refs\nM1911,cust,5,PO1\n'
+                'M1911,x,5,PO2\n')
+        f.name = 'jobs.csv'
+        response = self.client.post(url, {'kind': 'jobs', 'file': f})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['result'].created, 1)
+        self.assertContains(response, 'customer: x not found')
+
+        self.assertRaises(CommandError, call_command, 'import_protrac',
+                'things', 'none.csv')
+
+    def test_view_permission(self):
+        create_staff()
+        self.assertTrue(self.client.login(username='staff',
+                password='password'))
+        f = StringIO('part_number,customer,qty,refs\nM1911,cust,5,PO1\n')
+        f.name = 'jobs.csv'
+        response = self.client.post(reverse('admin:protrac_import'),
+                {'kind': 'jobs', 'file': f})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Job.objects.exists())
+
+    def test_gap_priorities(self):
+        priority_mode = models.PRIORITY_MODE
+        models.PRIORITY_MODE = 'gap'
+        try:
+            job = Job.objects.create(product=self.product, qty=1,
+                    customer=self.customer, priority=1005)
+            importer.import_jobs([ {'part_number': 'M1911',
+                'customer': 'cust', 'qty': '1', 'refs': 'PO%i' % i,
+                'priority': '1005'} for i in range(2) ])
+        finally:
+            models.PRIORITY_MODE = priority_mode
+        # no renumbering: the new jobs make room for themselves in turn, as
+        # if each had been saved
+        self.assertEqual(list(Job.objects.order_by('pk').values_list(
+            'priority', flat=True)), [1006, 1005, 1007])
+
+
+class CycleTimeStatsTest(TestCase):
+
+    def setUp(self):
+        c = Customer.objects.create(name='cust')
+        self.p = Product.objects.create(part_number='M1911', cycle_time=2)
+        self.jobs = [ Job.objects.create(product=self.p, qty=100, customer=c,
+            refs='PO%i' % i) for i in range(2) ]
+        start = datetime(2000, 1, 1, 0, 0, 0)
+        # per-unit cycle times of 1..10 seconds, and one 100 second outlier
+        for i, seconds in enumerate(range(1, 11) + [100]):
+            Run.objects.create(job=self.jobs[i % 2], operator='Bob', qty=2,
+                    start=start, end=start + timedelta(seconds=seconds * 2))
+        # qty 0 runs have no per-unit time
+        Run.objects.create(job=self.jobs[0], operator='Bob', qty=0,
+                start=start, end=start + timedelta(seconds=10))
+
+    def test_group_stats(self):
+        keys = [1, 1, 1, 2]
+        result = stats._python_stats(keys, [1, 1, 2, 4],
+                [1.0, 2.0, 6.0, 10.0])
+        self.assertEqual(result[1]['runs'], 3)
+        self.assertEqual(result[1]['mean'], 9.0 / 4)
+        self.assertEqual(result[1]['median'], 2.0)
+        self.assertAlmostEqual(result[1]['p90'], 2.8)
+        self.assertAlmostEqual(result[1]['stddev'], (2.0 / 3) ** 0.5)
+        self.assertEqual(result[2], {'runs': 1, 'mean': 2.5, 'median': 2.5,
+            'p90': 2.5, 'stddev': 0.0, 'trimmed_mean': 2.5})
+        self.assertEqual(stats.group_stats([], [], []), {})
+
+    @skipIf(stats.numpy is None, 'NumPy is not installed')
+    def test_numpy_stats(self):
+        # groups of one, a few and enough runs to be trimmed, out of order
+        keys = [3, 1, 2, 1, 3] + [2] * 11
+        qtys = [2, 1, 5, 3, 1] + range(1, 12)
+        seconds = [7.0, 2.0, 9.0, 4.5, 1.0] + [ 3.0 * q + (q % 4)
+                for q in range(1, 12) ]
+        expected = stats._python_stats(keys, qtys, seconds)
+        result = stats._numpy_stats(keys, qtys, seconds)
+        self.assertEqual(sorted(result), [1, 2, 3])
+        for key in expected:
+            self.assertEqual(result[key]['runs'], expected[key]['runs'])
+            for name in stats.STATS:
+                self.assertAlmostEqual(result[key][name],
+                        expected[key][name])
+
+    def test_refresh(self):
+        self.assertEqual(stats.refresh(), (1, 2))
+        product = models.ProductCycleTimeStats.objects.get(product=self.p)
+        self.assertEqual(product.runs, 11)
+        self.assertEqual(product.mean, 155.0 / 11)
+        self.assertEqual(product.median, 6)
+        self.assertAlmostEqual(product.p90, 10)
+        # the outlier and the fastest run are trimmed
+        self.assertEqual(product.trimmed_mean, 54.0 / 9)
+        self.assertEqual(product.mean_cycle_time(),
+                timedelta(seconds=155.0 / 11))
+        self.assertEqual(models.JobCycleTimeStats.objects.get(
+            job=self.jobs[1]).runs, 5)
+
+        # refreshing replaces the old statistics
+        Run.objects.all().delete()
+        self.assertEqual(stats.refresh(), (0, 0))
+        self.assertFalse(models.ProductCycleTimeStats.objects.exists())
+
+    def test_admin_and_command(self):
+        out = StringIO()
+        call_command('refresh_cycle_stats', stdout=out)
+        self.assertTrue('1 products and 2 jobs' in out.getvalue())
+        User.objects.create_superuser('user', 'a@b.com', 'password')
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        response = self.client.get(reverse('admin:protrac_product_changelist'))
+        self.assertContains(response, 'p90 10.00s')
+
+
+class RefCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = refcache.RefCache(Customer, 'name', max_size=2,
+                timeout=60)
+        self.customers = [ Customer.objects.create(name='cust%i' % i)
+                for i in range(3) ]
+
+    def test_get_many(self):
+        pks = [ c.pk for c in self.customers[:2] ]
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(self.cache.get_many(pks)), sorted(pks))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get(pks[0]).name, 'cust0')
+            self.assertEqual(self.cache.get_by_key(['cust1'])['cust1'].pk,
+                    pks[1])
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+        self.assertRaises(Customer.DoesNotExist, self.cache.get, 0)
+
+    def test_bounds(self):
+        c0, c1, c2 = self.customers
+        self.cache.get_many([c0.pk, c1.pk])
+        self.cache.get(c0.pk) # c1 is now the least recently used
+        self.cache.get(c2.pk)
+        self.assertEqual(sorted(self.cache._entries), sorted([c0.pk, c2.pk]))
+        self.assertFalse('cust1' in self.cache._keys)
+
+        self.cache.timeout = -1
+        self.cache.get(c1.pk)
+        with self.assertNumQueries(1):
+            self.cache.get(c1.pk) # expired
+
+    def test_signals(self):
+        c = self.customers[0]
+        self.assertEqual(refcache.get(Customer, c.pk).name, 'cust0')
+        c.name = 'renamed'
+        c.save()
+        self.assertEqual(refcache.get(Customer, c.pk).name, 'renamed')
+        self.assertEqual(refcache.get_by_key(Customer, ['cust0']), {})
+
+
+##############
+# Live Board #
+##############
+
+class BoardTest(TestCase):
+
+    def setUp(self):
+        timeline.get_timeline_cache().clear()
+        self.user = User.objects.create_superuser('user', 'a@b.com',
+                'password')
+        c = Customer.objects.create(name='cust1')
+        self.pl = ProductionLine.objects.create(name='line 1', category='X')
+        self.pl2 = ProductionLine.objects.create(name='line 2', category='X')
+        p = Product.objects.create(part_number='M1911', cycle_time=2)
+        self.jobs = [ Job.objects.create(product=p, qty=10, customer=c,
+            production_line=self.pl, priority=10 * (i + 1))
+            for i in range(3) ]
+        self.other = Job.objects.create(product=p, qty=10, customer=c,
+                production_line=self.pl2)
+        self.seq = board.current_seq()
+
+    def test_delta(self):
+        Run.objects.create(job=self.jobs[0], operator='Bob', qty=4,
+                start=datetime.now(), end=datetime.now())
+        self.other.suspended = 'No material'
+        self.other.save()
+
+        # only this line's jobs, from the events without querying
+        with self.assertNumQueries(0):
+            delta = board.line_delta(self.pl.pk, self.seq)
+        self.assertFalse(delta['reset'])
+        self.assertEqual([ (s['id'], s['qty_remaining']) for s in
+            delta['jobs'] ], [(self.jobs[0].pk, 6)])
+
+        # a job leaving the line is sent so it can be removed
+        self.jobs[1].production_line = self.pl2
+        self.jobs[1].save()
+        Run.objects.get().delete()
+        Job.set_priorities({self.jobs[2].pk: 25})
+        delta = board.line_delta(self.pl.pk, delta['seq'])
+        self.assertEqual([ (s['id'], s['line'], s['qty_remaining'])
+            for s in delta['jobs'] ], [(self.jobs[0].pk, self.pl.pk, 10),
+                (self.jobs[1].pk, self.pl2.pk, 10)])
+        # bulk renumbering
+        self.assertEqual(delta['priorities'], {self.jobs[2].pk: 25})
+
+        self.assertEqual(board.line_delta(self.pl.pk, delta['seq'])['jobs'],
+                [])
+        timeline.invalidate_lines()
+        self.assertTrue(board.line_delta(self.pl.pk, delta['seq'])['reset'])
+        self.assertTrue(board.line_delta(self.pl.pk, -1000)['reset'])
+
+    def test_views(self):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        response = self.client.get(reverse('admin:protrac_board',
+            args=[self.pl.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['rows']), 3)
+
+        url = reverse('admin:protrac_board_events', args=[self.pl.pk])
+        self.jobs[0].suspended = 'Tooling'
+        self.jobs[0].save()
+        response = self.client.get(url, {'since': self.seq})
+        delta = json.loads(response.content)
+        self.assertEqual(delta['jobs'][0]['suspended'], 'Tooling')
+
+        response = self.client.get(url, {'since': self.seq},
+                HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = iter(response.streaming_content)
+        self.assertEqual(next(chunks), 'retry: 2000\n\n')
+        self.assertTrue(next(chunks).startswith('id: %i\ndata: {' %
+            delta['seq']))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class IngestTest(TestCase):
+
+    def setUp(self):
+        self.settings = (app_settings.INGEST_TOKENS, app_settings.INGEST_ASYNC)
+        # the test database isn't visible to the ingest thread
+        app_settings.INGEST_TOKENS = {'secret': 'press 4'}
+        app_settings.INGEST_ASYNC = False
+        c = Customer.objects.create(name='cust1')
+        self.pl = ProductionLine.objects.create(name='line 1', category='X')
+        p = Product.objects.create(part_number='M1911', cycle_time=2)
+        self.job = Job.objects.create(product=p, qty=10, customer=c,
+                production_line=self.pl)
+        self.url = reverse('admin:protrac_ingest_runs')
+
+    def tearDown(self):
+        app_settings.INGEST_TOKENS, app_settings.INGEST_ASYNC = self.settings
+
+    def post(self, lines, token='secret'):
+        body = '\n'.join(json.dumps(line) if isinstance(line, dict) else line
+                for line in lines)
+        return self.client.post(self.url, body, content_type='text/plain',
+                HTTP_AUTHORIZATION='Token %s' % token)
+
+    def test_ingest(self):
+        run = {'job': self.job.pk, 'qty': 3, 'start': '2000-01-01 00:00',
+                'end': '2000-01-01 00:01'}
+        seq = board.current_seq()
+        response = self.post([run, '', dict(run, operator='Bob'),
+            '{oops', dict(run, job=0)])
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.content)
+        self.assertEqual(data['queued'], 2)
+        self.assertEqual([ n for n, message in data['errors'] ], [4, 5])
+
+        self.assertEqual(sorted(Run.objects.values_list('operator',
+            flat=True)), ['Bob', 'press 4'])
+        job = Job.objects.get(pk=self.job.pk)
+        self.assertEqual((job.run_qty, job.run_count), (6, 2))
+
+        # the boards get the job, rather than reloading
+        delta = board.line_delta(self.pl.pk, seq)
+        self.assertFalse(delta['reset'])
+        self.assertEqual([ (state['id'], state['qty_remaining']) for state in
+            delta['jobs'] ], [(self.job.pk, 4)])
+
+    def test_auth(self):
+        run = {'job': self.job.pk, 'qty': 3, 'start': '2000-01-01 00:00',
+                'end': '2000-01-01 00:01'}
+        self.assertEqual(self.post([run], token='wrong').status_code, 401)
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+        self.assertFalse(Run.objects.exists())
+
+    def test_deleted_job(self):
+        other = Job.objects.create(product=self.job.product, qty=10,
+                customer=self.job.customer)
+        runs, result = ingest.parse('\n'.join(json.dumps({'job': pk,
+            'qty': 3, 'start': '2000-01-01 00:00', 'end': '2000-01-01 00:01'})
+            for pk in (self.job.pk, other.pk)), operator='press 4')
+        self.assertEqual(len(runs), 2)
+        other.delete()
+        ingest.write(runs)
+        self.assertEqual(list(Run.objects.values_list('job', flat=True)),
+                [self.job.pk])
+        self.assertEqual(Job.objects.get(pk=self.job.pk).run_qty, 3)
+
+
+class IngestBatchTest(TransactionTestCase):
+
+    def setUp(self):
+        c = Customer.objects.create(name='cust1')
+        p = Product.objects.create(part_number='M1911', cycle_time=2)
+        self.job = Job.objects.create(product=p, qty=10, customer=c)
+
+    def make_run(self, qty):
+        return Run(job_id=self.job.pk, qty=qty, operator='Bob',
+                start=datetime(2000, 1, 1), end=datetime(2000, 1, 1, 0, 1))
+
+    def test_retry_each_request(self):
+        # the batch fails on the second request's run, which is left out
+        # without losing the first's
+        ingest._write_batch([[self.make_run(3)], [self.make_run(None)]])
+        self.assertEqual(list(Run.objects.values_list('qty', flat=True)),
+                [3])
+        job = Job.objects.get(pk=self.job.pk)
+        self.assertEqual((job.run_qty, job.run_count), (3, 1))
+        self.assertEqual(DailyProduction.objects.get().runs, 1)
+
+
+class CapacityTest(TestCase):
+
+    def setUp(self):
+        timeline.get_timeline_cache().clear()
+        self.user = User.objects.create_superuser('user', 'a@b.com',
+                'password')
+        c = Customer.objects.create(name='cust1')
+        self.pl = ProductionLine.objects.create(name='line 1', category='X')
+        ProductionLine.objects.create(name='line 2', category='A')
+        p = Product.objects.create(part_number='M1911', cycle_time=36,
+                material_wt=2)
+        yesterday = datetime.now().date() - timedelta(days=1)
+        for due_date in (yesterday, None, yesterday):
+            Job.objects.create(product=p, qty=100, customer=c,
+                    production_line=self.pl, due_date=due_date)
+        Job.objects.create(product=p, qty=100, customer=c, void=True,
+                production_line=self.pl, due_date=yesterday)
+
+    def test_report(self):
+        with self.assertNumQueries(3):
+            data = capacity.report()
+        lines = dict((row['name'], row) for row in data['lines'])
+        self.assertEqual(lines['line 1'], {'id': self.pl.pk, 'name': 'line 1',
+            'category': 'X', 'jobs': 3, 'late': 2, 'hours': 3.0,
+            'weight': 600.0})
+        self.assertEqual(lines['line 2']['jobs'], 0)
+        categories = dict((row['category'], row) for row in
+                data['categories'])
+        self.assertEqual(categories['X']['hours'], 3.0)
+        self.assertEqual(categories['I']['jobs'], 0)
+        self.assertFalse(None in categories)
+        self.assertEqual(data['total']['late'], 2)
+
+    def test_uncategorized(self):
+        line = ProductionLine.objects.create(name='line 3')
+        Job.objects.create(product=Product.objects.get(), qty=100,
+                customer=Customer.objects.get(), production_line=line)
+        data = capacity.report()
+        categories = dict((row['category'], row) for row in
+                data['categories'])
+        self.assertEqual(categories[None]['name'], 'Uncategorized')
+        self.assertEqual(categories[None]['jobs'], 1)
+        self.assertEqual(data['total']['jobs'], 4)
+        self.assertEqual(data['total']['hours'], 4.0)
+
+    def test_remaining_totals(self):
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        totals = Job.objects.remaining_totals(late_before=tomorrow)
+        # the void job is counted too, it's not filtered by scheduled()
+        self.assertEqual(totals[self.pl.pk]['late'], 3)
+
+    def test_views(self):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        response = self.client.get(reverse('admin:protrac_capacity'))
+        self.assertContains(response, 'line 2')
+        # cached
+        Job.objects.update(void=True)
+        response = self.client.get(reverse('admin:protrac_capacity_json'))
+        self.assertEqual(json.loads(response.content)['total']['jobs'], 3)
+
+
+class OptimizerTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user', 'a@b.com',
+                'password')
+        c = Customer.objects.create(name='cust1')
+        self.lines = [ ProductionLine.objects.create(name='line %i' % i,
+            category=category) for i, category in enumerate('XXA') ]
+        # an hour per job
+        p = Product.objects.create(part_number='M1911', cycle_time=36)
+        p2 = Product.objects.create(part_number='M1', cycle_time=36)
+        Job.objects.create(product=p, qty=100, customer=c,
+                production_line=self.lines[0], void=True)
+        today = datetime.now().date()
+        self.jobs = [ Job.objects.create(product=p, qty=100, customer=c,
+            due_date=today + timedelta(days=1)) for i in range(4) ]
+        self.started = Job.objects.create(product=p, qty=100, customer=c,
+                production_line=self.lines[0], run_qty=1)
+        self.anywhere = Job.objects.create(product=p2, qty=100, customer=c)
+
+    def test_optimize(self):
+        with self.assertNumQueries(3):
+            plan = optimizer.optimize(time_limit=1)
+        changes = plan.changes()
+        # only X lines for the product made on X before, evenly loaded
+        self.assertEqual(sorted(changes[job.pk] for job in self.jobs),
+                [self.lines[0].pk] * 2 + [self.lines[1].pk] * 2)
+        self.assertEqual(changes[self.anywhere.pk], self.lines[2].pk)
+        self.assertFalse(self.started.pk in changes)
+        self.assertEqual(plan.before[None]['jobs'], 5)
+        self.assertEqual(plan.after[None]['jobs'], 0)
+        self.assertEqual(plan.after[self.lines[1].pk]['late'], 0)
+
+        plan = optimizer.optimize(category='A', time_limit=1)
+        self.assertEqual(plan.changes(), {self.anywhere.pk: self.lines[2].pk})
+
+        # a job moved since the plan was made is left alone
+        moves = optimizer.optimize(time_limit=1).moves
+        Job.objects.filter(pk=self.anywhere.pk).update(
+                production_line=self.lines[0])
+        with self.assertNumQueries(2):
+            self.assertEqual(optimizer.apply_moves(moves), 4)
+        self.assertEqual(Job.objects.get(pk=self.anywhere.pk).production_line,
+                self.lines[0])
+        self.assertFalse(Job.objects.filter(void=False,
+            production_line=None).exists())
+
+    def test_view(self):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        url = reverse('admin:protrac_optimize')
+        response = self.client.get(url, {'preview': 1})
+        self.assertEqual(len(response.context['plan'].moves), 5)
+        response = self.client.post(url,
+                {'plan': response.context['plan_id']})
+        self.assertEqual(response.context['applied'], 5)
+        response = self.client.post(url, {'plan': 'nope'})
+        self.assertTrue(response.context['expired'])
+
+        out = StringIO()
+        call_command('optimize_lines', apply=True, stdout=out)
+        self.assertTrue('Moved 0 jobs.' in out.getvalue())
+
+    def test_view_permission(self):
+        create_staff()
+        self.assertTrue(self.client.login(username='staff',
+                password='password'))
+        url = reverse('admin:protrac_optimize')
+        response = self.client.get(url, {'preview': 1})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(url,
+                {'plan': response.context['plan_id']})
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(Job.objects.filter(void=False,
+            production_line=None).exists())
+
+    def test_apply_batches(self):
+        moves = optimizer.optimize(time_limit=1).moves
+        batch_size = optimizer.BATCH_SIZE
+        optimizer.BATCH_SIZE = 2
+        try:
+            # a query per 2 jobs read, and the update
+            with self.assertNumQueries(4):
+                self.assertEqual(optimizer.apply_moves(moves), 5)
+        finally:
+            optimizer.BATCH_SIZE = batch_size
+
+
+class SequencingTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user', 'a@b.com',
+                'password')
+        c = Customer.objects.create(name='cust1')
+        self.pl = ProductionLine.objects.create(name='line 1', category='X')
+        # an hour per job, two products sharing a setup
+        a = Product.objects.create(part_number='A', cycle_time=36,
+                setup='Die 7')
+        a2 = Product.objects.create(part_number='A2', cycle_time=36,
+                setup='die  7')
+        b = Product.objects.create(part_number='B', cycle_time=36)
+        today = datetime.now().date()
+        self.jobs = [ Job.objects.create(product=product, qty=100,
+            customer=c, production_line=self.pl, priority=10 * (i + 1),
+            due_date=due_date) for i, (product, due_date) in enumerate([
+                (a, None), (b, None), (a2, None), (b, today + timedelta(3)),
+                (a, None)]) ]
+        # unprioritized, goes last
+        self.jobs.append(Job.objects.create(product=b, qty=100, customer=c,
+            production_line=self.pl))
+
+    def test_slack_tree(self):
+        tree = sequencing._SlackTree([5, 3, 8, 1])
+        self.assertEqual(tree.range_min(0, 2), 3)
+        tree.range_add(1, 3, 10)
+        self.assertEqual(tree.range_min(0, 3), 5)
+        tree.remove(0)
+        self.assertEqual(tree.range_min(0, 3), 11)
+
+    def test_sequence(self):
+        sequence = sequencing.sequence_line(self.pl.pk)
+        pks = [ job.pk for job in self.jobs ]
+        self.assertEqual(sequence.order, [ pks[i] for i in (0, 2, 4, 1, 3,
+            5) ])
+        self.assertEqual((sequence.changeovers_before,
+            sequence.changeovers_after), (5, 1))
+        self.assertEqual(sequence.saved_seconds(),
+                4 * app_settings.CHANGEOVER_TIME)
+        self.assertEqual(sequence.late_after, 0)
+
+        # checking the queue is unchanged, the update, and the lines whose
+        # cached timelines get the new priorities
+        with self.assertNumQueries(3):
+            self.assertTrue(sequencing.apply_sequence(sequence))
+        self.assertEqual([ job.pk for job in Job.objects.filter(
+            production_line=self.pl).queue_order() ], sequence.order)
+        self.assertEqual(sequencing.sequence_line(self.pl.pk).priorities, {})
+
+    def test_due_dates(self):
+        # pulling the 22 hour third job forward would make the second late
+        due = datetime.now().date()
+        Job.objects.update(due_date=due)
+        Job.objects.filter(pk=self.jobs[2].pk).update(qty=2200)
+        sequence = sequencing.sequence_line(self.pl.pk,
+                now=datetime.combine(due, datetime.min.time()))
+        self.assertEqual(sequence.order[:2], [ job.pk for job in
+            self.jobs[:2] ])
+
+    def test_view(self):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        url = reverse('admin:protrac_sequence', args=[self.pl.pk])
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['jobs']), 6)
+        previewed = response.context['sequence']
+        response = self.client.post(url,
+                {'sequence': response.context['sequence_id']})
+        self.assertTrue(response.context['applied'])
+        self.assertEqual([ job.pk for job in Job.objects.filter(
+            production_line=self.pl).queue_order() ], previewed.order)
+        response = self.client.post(url, {'sequence': 'nope'})
+        self.assertTrue(response.context['expired'])
+
+    def test_view_queue_changed(self):
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        url = reverse('admin:protrac_sequence', args=[self.pl.pk])
+        sequence_id = self.client.get(url).context['sequence_id']
+        Job.objects.filter(pk=self.jobs[5].pk).update(production_line=None)
+        response = self.client.post(url, {'sequence': sequence_id})
+        # the order nobody saw isn't written
+        self.assertTrue(response.context['changed'])
+        self.assertEqual([ job.pk for job in Job.objects.filter(
+            production_line=self.pl).queue_order() ], [ job.pk for job in
+                self.jobs[:5] ])
+
+    def test_view_permission(self):
+        create_staff()
+        self.assertTrue(self.client.login(username='staff',
+                password='password'))
+        url = reverse('admin:protrac_sequence', args=[self.pl.pk])
+        sequence_id = self.client.get(url).context['sequence_id']
+        response = self.client.post(url, {'sequence': sequence_id})
+        self.assertEqual(response.status_code, 403)
+
+
+class DailyProductionTest(TestCase):
+
+    def setUp(self):
+        c = Customer.objects.create(name='cust1')
+        self.pl = ProductionLine.objects.create(name='line 1', category='X')
+        p = Product.objects.create(part_number='M1911', cycle_time=2,
+                material_wt=0.5)
+        self.job = Job.objects.create(product=p, qty=100, customer=c,
+                production_line=self.pl)
+        self.day = datetime(2013, 1, 31, 8)
+
+    def run_at(self, hours, qty=10, operator='Bob'):
+        return Run.objects.create(job=self.job, qty=qty, operator=operator,
+                start=self.day + timedelta(hours=hours),
+                end=self.day + timedelta(hours=hours, minutes=1))
+
+    def rows(self):
+        return sorted(DailyProduction.objects.values_list('day', 'operator',
+            'qty', 'seconds', 'weight', 'runs'))
+
+    def test_incremental(self):
+        self.run_at(0)
+        run = self.run_at(1)
+        self.run_at(24, operator='Al')
+        day = self.day.date()
+        self.assertEqual(self.rows(), [(day, 'Bob', 20, 120, 10, 2),
+            (day + timedelta(1), 'Al', 10, 60, 5, 1)])
+
+        run.qty = 4
+        run.operator = 'Al'
+        run.save()
+        run.delete()
+        self.assertEqual(self.rows()[0], (day, 'Bob', 10, 60, 5, 1))
+        Run.objects.filter(operator='Al').delete()
+        self.assertEqual(len(self.rows()), 1)
+
+        # bulk writes go through add_runs
+        importer.import_runs([{'job': str(self.job.pk), 'qty': '2',
+            'operator': 'Bob', 'start': '2013-01-31 10:00',
+            'end': '2013-01-31 10:00:30'}])
+        self.assertEqual(self.rows(), [(day, 'Bob', 12, 90, 6, 2)])
+
+    def test_backfill_and_totals(self):
+        self.run_at(0)
+        self.run_at(48, operator='Al')
+        expected = self.rows()
+        DailyProduction.objects.all().delete()
+        self.assertEqual(history.backfill(), 2)
+        self.assertEqual(self.rows(), expected)
+        DailyProduction.objects.update(qty=0)
+        out = StringIO()
+        call_command('backfill_daily_production', since='2013-02-01',
+                stdout=out)
+        self.assertEqual([ row[2] for row in self.rows() ], [0, 10])
+
+        self.assertEqual(history.totals(['production_line']),
+                [{'production_line': self.pl.pk, 'qty': 10, 'seconds': 120,
+                    'weight': 10, 'runs': 2}])
+
+        User.objects.create_superuser('user', 'a@b.com', 'password')
+        self.assertTrue(self.client.login(username='user',
+                password='password'))
+        response = self.client.get(reverse(
+            'admin:protrac_dailyproduction_changelist'))
+        self.assertContains(response, '0:01:00')
+
+    def test_job_deleted(self):
+        self.run_at(0)
+        self.run_at(24)
+        self.job.delete()
+        self.assertEqual(self.rows(), [])
+
+    def test_line_deleted(self):
+        unassigned = Job.objects.create(product=self.job.product, qty=100,
+                customer=self.job.customer)
+        moved = Job.objects.create(product=self.job.product, qty=100,
+                customer=self.job.customer, production_line=self.pl)
+        self.run_at(0)
+        for job, qty in ((unassigned, 5), (moved, 3)):
+            Run.objects.create(job=job, qty=qty, operator='Bob',
+                    start=self.day, end=self.day + timedelta(minutes=1))
+        # its run still counts towards the line
+        moved.production_line = None
+        moved.save()
+        self.assertEqual(DailyProduction.objects.count(), 2)
+
+        # the line's job and its run go with it, and the moved job's run is
+        # merged into the row without a line, instead of a duplicate key
+        self.pl.delete()
+        row = DailyProduction.objects.get()
+        self.assertEqual((row.production_line, row.line_key, row.qty,
+            row.runs), (None, 0, 8, 2))
+        self.assertRaises(IntegrityError, DailyProduction.objects.create,
+                day=row.day, product=row.product, operator='Bob')
+        rows = self.rows()
+        history.backfill()
+        self.assertEqual(self.rows(), rows)
+
+    def test_concurrent_create(self):
+        create = DailyProduction.objects.create
+        def racing_create(**kwargs):
+            # another writer creates the row just before this one
+            del DailyProduction.objects.create
+            create(**dict(kwargs, qty=1, seconds=1, weight=1, runs=1))
+            return create(**kwargs)
+        DailyProduction.objects.create = racing_create
+        try:
+            self.run_at(0)
+        finally:
+            DailyProduction.objects.__dict__.pop('create', None)
+        self.assertEqual(self.rows(), [(self.day.date(), 'Bob', 11, 61, 6,
+            2)])
@@ -0,0 +1,356 @@
+"""
+Projected start and finish times for each production line's queue
+
+A line's scheduled jobs are laid end to end in queue order (see
+JobQuerySet.queue_order), starting now. Each job takes its remaining qty
+times its product's cycle time, or the observed average cycle time when
+`observed` is set. Suspended jobs are listed but don't hold up the line.
+
+project() fetches every line's queue in a single query (with the products
+from the reference cache) and walks each one once. After a job changes,
+LineTimeline.update() re-reads just that job and recomputes the part of the
+line from it onwards.
+
+cached_line() keeps each line's projection in the PROTRAC_CACHE cache, and
+only one process at a time recomputes a line (the others serve the previous
+projection meanwhile). Job and Run signals call update_lines(), which
+applies LineTimeline.update() to the cached projections, and
+Job.set_priorities() calls update_priorities(). Product changes and bulk
+writes call invalidate_lines() for the lines they affect instead.
+"""
+import time as _time
+from bisect import bisect_left
+from operator import attrgetter
+from datetime import datetime, time, timedelta
+
+from django.core.cache import get_cache
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.utils import timezone
+
+import app_settings
+from models import Job, Product, ProductionLine
+import refcache
+
+# Seconds a recompute may hold a line's lock, and the longest another
+# request waits for it when there's no stale projection to serve instead
+LOCK_TIMEOUT = 10
+
+# Generation counters must outlive the projections stored under them
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+_cache = None
+
+# Job columns (and extra select) read for each timeline entry. Products come
+# from the reference cache.
+FIELDS = ('unprioritized', 'pk', 'production_line', 'priority', 'qty',
+        'run_qty', 'due_date', 'suspended', 'product')
+
+
+class TimelineEntry(object):
+    """
+    One job's place on its line's timeline
+    """
+
+    def __init__(self, row, product, observed=False):
+        (unprioritized, self.job_id, self.line_id, self.priority, qty,
+                run_qty, self.due_date, self.suspended, product_id) = row
+        self.sort_key = (bool(unprioritized), self.priority, self.job_id)
+        self.qty_remaining = max(qty - run_qty, 0)
+        cycle_time = product.cycle_time
+        if observed and product.run_qty:
+            cycle_time = product.run_seconds / product.run_qty
+        self.cycle_time = cycle_time
+        self.duration = timedelta(seconds=cycle_time * self.qty_remaining)
+        self.start = self.end = self.slack = None
+
+    def __repr__(self):
+        return '<TimelineEntry job %s: %s - %s>' % (self.job_id, self.start,
+                self.end)
+
+    def due(self):
+        """
+        The end of the due date, comparable with start/end
+        """
+        if self.due_date is None:
+            return None
+        due = datetime.combine(self.due_date + timedelta(days=1), time(0))
+        if timezone.is_aware(self.end):
+            due = timezone.make_aware(due, timezone.get_current_timezone())
+        return due
+
+    def is_late(self):
+        return self.slack is not None and self.slack < timedelta(0)
+
+
+class LineTimeline(object):
+    """
+    Projection of one production line's queue
+    """
+
+    def __init__(self, line_id, entries, start, observed=False):
+        self.line_id = line_id
+        self.entries = list(entries)
+        self.start = start
+        self.observed = observed
+        self._compute(0)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rebase(self, start):
+        """
+        Moves the whole projection to begin at start
+        """
+        self.start = start
+        self._compute(0)
+
+    def end(self):
+        """
+        When the last job on the line is projected to finish
+        """
+        for entry in reversed(self.entries):
+            if entry.end is not None:
+                return entry.end
+        return self.start
+
+    def entry(self, job_id):
+        for entry in self.entries:
+            if entry.job_id == job_id:
+                return entry
+        return None
+
+    def _compute(self, index):
+        """
+        Recomputes the entries from index to the end of the queue
+        """
+        t = self.start
+        for entry in reversed(self.entries[:index]):
+            if entry.end is not None:
+                t = entry.end
+                break
+        for entry in self.entries[index:]:
+            if entry.suspended:
+                entry.start = entry.end = entry.slack = None
+                continue
+            entry.start = t
+            entry.end = t = t + entry.duration
+            due = entry.due()
+            entry.slack = due - entry.end if due is not None else None
+
+    def update(self, job_id):
+        """
+        Re-reads one job and recomputes the line from the earlier of its old
+        and new positions. Returns the index recomputing started from, or
+        None if nothing on this line changed.
+        """
+        old = None
+        for i, entry in enumerate(self.entries):
+            if entry.job_id == job_id:
+                old = i
+                break
+        if old is not None:
+            del self.entries[old]
+
+        new = None
+        rows = Job.objects.scheduled().queue_order().filter(pk=job_id,
+                production_line=self.line_id).values_list(*FIELDS)
+        if rows:
+            product = refcache.get(Product, rows[0][-1])
+            entry = TimelineEntry(rows[0], product, self.observed)
+            new = bisect_left([ e.sort_key for e in self.entries ],
+                    entry.sort_key)
+            self.entries.insert(new, entry)
+
+        if old is None and new is None:
+            return None
+        index = min(i for i in (old, new) if i is not None)
+        self._compute(index)
+        return index
+
+    def set_priorities(self, priorities):
+        """
+        Applies renumbered priorities ({job pk: priority}) to the entries,
+        recomputing the line if that changed their order
+        """
+        for entry in self.entries:
+            if entry.job_id in priorities:
+                entry.priority = priorities[entry.job_id]
+                entry.sort_key = (not entry.priority, entry.priority,
+                        entry.job_id)
+        entries = sorted(self.entries, key=attrgetter('sort_key'))
+        if entries != self.entries:
+            self.entries = entries
+            self._compute(0)
+
+
+def project(line_ids=None, start=None, observed=False):
+    """
+    Returns {line id: LineTimeline} for the given lines (or all lines with
+    scheduled jobs), fetching every queue in one query
+    """
+    if start is None:
+        start = timezone.now()
+    jobs = Job.objects.scheduled().queue_order()
+    if line_ids is not None:
+        jobs = jobs.filter(production_line__in=line_ids)
+
+    rows = list(jobs.values_list(*FIELDS).iterator())
+    products = refcache.get_many(Product, [ row[-1] for row in rows ])
+    queues = {}
+    for row in rows:
+        entry = TimelineEntry(row, products[row[-1]], observed)
+        queues.setdefault(entry.line_id, []).append(entry)
+    return dict((line_id, LineTimeline(line_id, entries, start, observed))
+            for line_id, entries in queues.items())
+
+
+def project_line(line_id, start=None, observed=False):
+    """
+    Returns the LineTimeline for one line (empty if nothing is scheduled)
+    """
+    if start is None:
+        start = timezone.now()
+    timelines = project([line_id], start, observed)
+    return timelines.get(line_id) or LineTimeline(line_id, [], start,
+            observed)
+
+
+###########
+# CACHING #
+###########
+
+def get_timeline_cache():
+    global _cache
+    if _cache is None:
+        try:
+            _cache = get_cache(app_settings.CACHE)
+        except InvalidCacheBackendError:
+            _cache = get_cache(
+                    'django.core.cache.backends.locmem.LocMemCache',
+                    LOCATION='protrac')
+    return _cache
+
+
+def _generation(cache, key):
+    return cache.get(key) or 0
+
+
+def _bump(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, GENERATION_TIMEOUT)
+
+
+def _keys(cache, line_id, observed):
+    base = 'protrac:timeline:%s:%s' % (line_id, int(bool(observed)))
+    generations = cache.get_many(['protrac:timeline:gen',
+        'protrac:timeline:%s:gen' % line_id])
+    fresh = '%s:%s:%s' % (base, generations.get('protrac:timeline:gen', 0),
+            generations.get('protrac:timeline:%s:gen' % line_id, 0))
+    return fresh, base + ':stale', fresh + ':lock'
+
+
+def invalidate_lines(line_ids=None):
+    """
+    Drops the cached projections of the given lines, or of every line
+    """
+    cache = get_timeline_cache()
+    if line_ids is None:
+        _bump(cache, 'protrac:timeline:gen')
+        # and the live boards reload
+        import board
+        board.publish_reset()
+    else:
+        for line_id in line_ids:
+            _bump(cache, 'protrac:timeline:%s:gen' % line_id)
+
+
+def _edit_cached(line_ids, edit, observed=True):
+    # applies edit(line) to the cached projections of the given lines, under
+    # their locks; one being recomputed may be from before the change, so
+    # the line is dropped instead
+    cache = get_timeline_cache()
+    for line_id in line_ids:
+        for kind in (False, True):
+            fresh_key, stale_key, lock_key = _keys(cache, line_id, kind)
+            if not cache.add(lock_key, 1, LOCK_TIMEOUT):
+                invalidate_lines([line_id])
+                break
+            try:
+                line = cache.get(fresh_key)
+                if line is None:
+                    continue
+                if kind and not observed:
+                    cache.delete(fresh_key)
+                    continue
+                edit(line)
+                cache.set(fresh_key, line,
+                        app_settings.TIMELINE_CACHE_TIMEOUT)
+                cache.set(stale_key, line,
+                        app_settings.TIMELINE_CACHE_TIMEOUT * 2)
+            finally:
+                cache.delete(lock_key)
+
+
+def update_lines(line_ids, job_ids, observed=True):
+    """
+    Brings the cached projections of the given lines up to date after the
+    given jobs changed, re-reading just those jobs. When observed is False
+    (their runs changed their products' observed cycle times) the observed
+    projections are dropped instead.
+    """
+    def edit(line):
+        for job_id in job_ids:
+            line.update(job_id)
+    _edit_cached(set(line_ids), edit, observed)
+
+
+def update_priorities(priorities):
+    """
+    Applies renumbered priorities ({job pk: priority}) to the cached
+    projections, which update_lines() relies on being in order
+    """
+    _edit_cached(ProductionLine.objects.values_list('pk', flat=True),
+            lambda line: line.set_priorities(priorities))
+
+
+def cached_line(line_id, observed=False):
+    """
+    Returns the LineTimeline for one line starting now, from the cache when
+    it's still valid
+
+    When it isn't, one caller takes a lock and recomputes it. Meanwhile the
+    other callers get the previous projection, or wait for the new one if
+    there is no previous one.
+    """
+    cache = get_timeline_cache()
+    now = timezone.now()
+    fresh_key, stale_key, lock_key = _keys(cache, line_id, observed)
+
+    line = cache.get(fresh_key)
+    if line is None:
+        if cache.add(lock_key, 1, LOCK_TIMEOUT):
+            try:
+                line = project_line(line_id, now, observed)
+                cache.set(fresh_key, line,
+                        app_settings.TIMELINE_CACHE_TIMEOUT)
+                cache.set(stale_key, line,
+                        app_settings.TIMELINE_CACHE_TIMEOUT * 2)
+            finally:
+                cache.delete(lock_key)
+            return line
+
+        line = cache.get(stale_key)
+        deadline = _time.time() + LOCK_TIMEOUT
+        while line is None and _time.time() < deadline:
+            _time.sleep(0.05)
+            line = cache.get(fresh_key)
+        if line is None:
+            return project_line(line_id, now, observed)
+
+    line.rebase(now)
+    return line
@@ -1,10 +1,39 @@
 import datetime
+import json
+import uuid
 
-from django.http import HttpResponse
-from django.shortcuts import render_to_response
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import EmptyPage, Paginator
+from django.http import (Http404, HttpResponse, HttpResponseNotAllowed,
+        StreamingHttpResponse)
+from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
+from django.views.decorators.csrf import csrf_exempt
 
-from models import Job
+import app_settings
+import board
+import capacity
+import export
+import importer
+import ingest
+import middleware
+import optimizer
+import refcache
+import sequencing
+import timeline
+from forms import ImportForm, OptimizeForm
+from models import Job, ProductionLine
+
+
+def _check_permission(request, model, action):
+    """
+    Raises PermissionDenied (a 403) unless the user has the model's add,
+    change or delete permission, as the admin's own views do
+    """
+    opts = model._meta
+    codename = getattr(opts, 'get_%s_permission' % action)()
+    if not request.user.has_perm('%s.%s' % (opts.app_label, codename)):
+        raise PermissionDenied
 
 
 def admin_custom_view(request):
@@ -16,6 +45,293 @@ def admin_custom_view(request):
 
 
 def job_schedule(request):
-    jobs = Job.objects.all()
-    return render_to_response('protrac/admin_schedule.html', locals(),
+    """
+    Scheduled jobs grouped by production line in queue order, with running
+    totals of the remaining duration and weight
+
+    Lines are paginated (?page=), and each line shows a window of its queue.
+    ?line=<pk>&start=<n> shows a single line's queue from the nth job on.
+    The number of queries only depends on the number of lines per page.
+    """
+    scheduled = Job.objects.scheduled()
+    totals = scheduled.remaining_totals()
+    lines = ProductionLine.objects.filter(pk__in=totals.keys())
+
+    per_line = app_settings.SCHEDULE_JOBS_PER_LINE
+    start = 0
+    if request.GET.get('line'):
+        try:
+            lines = lines.filter(pk=int(request.GET['line']))
+            start = max(int(request.GET.get('start', 0)), 0)
+        except ValueError:
+            raise Http404
+
+    paginator = Paginator(lines, app_settings.SCHEDULE_LINES_PER_PAGE)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except (EmptyPage, ValueError):
+        raise Http404
+
+    schedule = []
+    for line in page.object_list:
+        queue = scheduled.filter(production_line=line)
+        window = list(queue.queue_order().select_related('product',
+            'customer')[start:start + per_line])
+        line_totals = totals[line.pk]
+        duration, weight = datetime.timedelta(0), 0.0
+        if start:
+            if window:
+                before = queue.ahead_of(window[0]).remaining_totals().get(
+                        line.pk)
+            else:
+                # past the end of the queue
+                before = line_totals
+            if before:
+                duration = datetime.timedelta(seconds=before['seconds'])
+                weight = before['weight']
+
+        jobs = []
+        for job in window:
+            duration += job.duration_remaining()
+            weight += job.weight_remaining()
+            jobs.append({'job': job, 'cumulative_duration': duration,
+                'cumulative_weight': weight})
+
+        schedule.append({
+            'line': line,
+            'jobs': jobs,
+            'job_count': line_totals['jobs'],
+            'duration': datetime.timedelta(seconds=line_totals['seconds']),
+            'weight': line_totals['weight'],
+            'start': start,
+            'has_previous': start > 0,
+            'previous_start': max(start - per_line, 0),
+            'next_start': start + per_line
+                if start + per_line < line_totals['jobs'] else None,
+        })
+
+    return render_to_response('protrac/admin_schedule.html', {
+            'schedule': schedule,
+            'page': page,
+            'paginator': paginator,
+        }, context_instance=RequestContext(request))
+
+
+def instrumentation(request):
+    views = middleware.summary()
+    recent = list(reversed(middleware.RECENT))[:50]
+    enabled = app_settings.INSTRUMENTATION
+    caches = sorted(refcache.stats().items())
+    return render_to_response('protrac/admin_instrumentation.html', locals(),
             context_instance=RequestContext(request))
+
+
+def capacity_report(request):
+    """
+    Remaining work per production line and per line category
+    """
+    return render_to_response('protrac/admin_capacity.html', {
+            'report': capacity.cached_report(),
+        }, context_instance=RequestContext(request))
+
+
+def capacity_json(request):
+    return HttpResponse(json.dumps(capacity.cached_report()),
+            content_type='application/json')
+
+
+def export_view(request, name, format):
+    if name not in export.EXPORTS or format not in export.FORMATS:
+        raise Http404
+    _check_permission(request, export.MODELS[name], 'change')
+    response = StreamingHttpResponse(export.stream(name, format),
+            content_type=export.CONTENT_TYPES[format])
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (name,
+            format)
+    return response
+
+
+def import_view(request):
+    """
+    Uploads a CSV of products, jobs or runs and lists the rows that were
+    skipped
+    """
+    result = None
+    if request.method == 'POST':
+        form = ImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            kind = form.cleaned_data['kind']
+            _check_permission(request, importer.MODELS[kind], 'add')
+            result = importer.import_csv(kind, request.FILES['file'])
+    else:
+        form = ImportForm()
+    columns = sorted((name, ', '.join(c[0])) for name, c in
+            importer.IMPORTERS.items())
+    return render_to_response('protrac/admin_import.html', {
+            'form': form,
+            'result': result,
+            'columns': columns,
+        }, context_instance=RequestContext(request))
+
+
+def optimize_view(request):
+    """
+    Previews the optimizer's line assignments (?preview) and applies a
+    previewed plan (POST), which is kept in the cache in between
+    """
+    cache = timeline.get_timeline_cache()
+    plan = plan_id = applied = None
+    expired = False
+    if request.method == 'POST':
+        _check_permission(request, Job, 'change')
+        moves = cache.get('protrac:optimizer:%s' % request.POST.get('plan'))
+        if moves is None:
+            expired = True
+        else:
+            applied = optimizer.apply_moves(moves)
+        form = OptimizeForm()
+    elif 'preview' in request.GET:
+        form = OptimizeForm(request.GET)
+        if form.is_valid():
+            plan = optimizer.optimize(form.cleaned_data['category'] or None,
+                    form.cleaned_data['movable'])
+            plan_id = uuid.uuid4().hex
+            cache.set('protrac:optimizer:%s' % plan_id, plan.moves,
+                    app_settings.TIMELINE_CACHE_TIMEOUT)
+    else:
+        form = OptimizeForm()
+
+    summary, moves = [], []
+    if plan is not None:
+        names = dict((pk, line.name) for pk, line in
+                refcache.get_many(ProductionLine, plan.after).items())
+        for pk, after in plan.after.items():
+            before = plan.before[pk]
+            if before['jobs'] or after['jobs']:
+                summary.append((names.get(pk, u'(unassigned)'), before,
+                    after))
+        summary.sort()
+        moves = [ (pk, names.get(old, u''), names.get(new))
+            for pk, old, new in plan.moves[:200] ]
+    return render_to_response('protrac/admin_optimize.html', {
+            'form': form,
+            'plan': plan,
+            'plan_id': plan_id,
+            'summary': summary,
+            'moves': moves,
+            'applied': applied,
+            'expired': expired,
+        }, context_instance=RequestContext(request))
+
+
+def sequence_view(request, line_id):
+    """
+    Previews a line's queue reordered to save changeovers, and applies the
+    previewed order (POST), which is kept in the cache in between
+    """
+    line = get_object_or_404(ProductionLine, pk=line_id)
+    cache = timeline.get_timeline_cache()
+    applied = expired = changed = False
+    if request.method == 'POST':
+        _check_permission(request, Job, 'change')
+        previewed = cache.get('protrac:sequence:%s' %
+                request.POST.get('sequence'))
+        if previewed is None or previewed.line_id != line.pk:
+            expired = True
+        elif sequencing.apply_sequence(previewed):
+            applied = True
+        else:
+            changed = True
+
+    sequence = sequencing.sequence_line(line.pk)
+    sequence_id = None
+    if sequence.priorities:
+        sequence_id = uuid.uuid4().hex
+        cache.set('protrac:sequence:%s' % sequence_id, sequence,
+                app_settings.TIMELINE_CACHE_TIMEOUT)
+
+    shown = sequence.order[:app_settings.SCHEDULE_JOBS_PER_LINE * 4]
+    jobs = Job.objects.in_bulk(shown)
+    refcache.attach(jobs.values(), 'product')
+    return render_to_response('protrac/admin_sequence.html', {
+            'line': line,
+            'sequence': sequence,
+            'jobs': [ jobs[pk] for pk in shown if pk in jobs ],
+            'more': len(sequence.order) - len(shown),
+            'sequence_id': sequence_id,
+            'applied': applied,
+            'expired': expired,
+            'changed': changed,
+        }, context_instance=RequestContext(request))
+
+
+def live_board(request, line_id):
+    """
+    One production line's queue, kept up to date by board_events
+    """
+    line = get_object_or_404(ProductionLine, pk=line_id)
+    seq = board.current_seq()
+    rows = board.line_rows(line.pk)
+    return render_to_response('protrac/admin_board.html', {
+            'line': line,
+            'rows': rows,
+            'seq': seq,
+            'poll_timeout': board.LONG_POLL_TIMEOUT,
+        }, context_instance=RequestContext(request))
+
+
+def board_events(request, line_id):
+    """
+    Changes to a line after event number ?since= (or Last-Event-ID): a
+    stream of server-sent events if the client accepts them, otherwise one
+    long-polled JSON delta
+    """
+    line = get_object_or_404(ProductionLine, pk=line_id)
+    try:
+        since = int(request.META.get('HTTP_LAST_EVENT_ID')
+                or request.GET.get('since', ''))
+    except ValueError:
+        raise Http404
+
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        response = StreamingHttpResponse(board.event_stream(line.pk, since),
+                content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        return response
+    return HttpResponse(json.dumps(board.wait_for_delta(line.pk, since)),
+            content_type='application/json')
+
+
+def _json_response(data, status=200):
+    return HttpResponse(json.dumps(data), status=status,
+            content_type='application/json')
+
+
+@csrf_exempt
+def ingest_runs(request):
+    """
+    Accepts completed runs from a line controller as JSON lines (see
+    protrac.ingest), authenticated by an "Authorization: Token" header
+    rather than a session. Responds 202 with the number queued and the
+    lines that were rejected.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    name = ingest.controller(request.META.get('HTTP_AUTHORIZATION'))
+    if name is None:
+        return _json_response({'error': 'invalid token'}, status=401)
+    try:
+        body = request.body.decode('utf-8')
+    except UnicodeDecodeError:
+        return _json_response({'error': 'body is not UTF-8'}, status=400)
+
+    runs, result = ingest.parse(body, operator=name)
+    try:
+        ingest.enqueue(runs)
+    except ingest.QueueFull:
+        return _json_response({'error': 'too many runs waiting, retry later'},
+                status=503)
+    return _json_response({
+            'queued': len(runs),
+            'errors': result.errors,
+        }, status=202)
@@ -44,7 +44,8 @@ template_patterns = [
         'templates/*/*/*/*/*.html',]
 
 package_data = dict(
-        (package_name, template_patterns) for package_name in packages)
+        (package_name, template_patterns + ['sql/*.sql'])
+        for package_name in packages)
 
 
 setup(name='django-protrac',